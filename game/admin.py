@@ -1,18 +1,42 @@
+from contextlib import nullcontext
+
 from django.contrib import admin
 from django.utils.html import format_html
-from django.urls import reverse
-from django.http import JsonResponse
+from django.urls import path, reverse
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.views import View
-from .models import Room, Player, GameState, Question, Answer, StandaloneRequest
+from django.db.models import Count
+from .models import Room, Player, GameState, Question, QuestionText, Answer, StandaloneRequest, ProfileRecord
 from .services import TurnManagementService
+from .sqlite import exclusive_writes
+
+
+class SerializedWriteAdmin(admin.ModelAdmin):
+    """Holds the single writer while a view writes, since it commits its own transaction."""
+
+    def changeform_view(self, request, *args, **kwargs):
+        with self.writing(request):
+            return super().changeform_view(request, *args, **kwargs)
+
+    def changelist_view(self, request, *args, **kwargs):
+        with self.writing(request):
+            return super().changelist_view(request, *args, **kwargs)
+
+    def delete_view(self, request, *args, **kwargs):
+        with self.writing(request):
+            return super().delete_view(request, *args, **kwargs)
+
+    def writing(self, request):
+        return exclusive_writes() if request.method == 'POST' else nullcontext()
 
 
 @admin.register(Room)
-class RoomAdmin(admin.ModelAdmin):
-    list_display = ['code', 'created_at', 'is_active', 'player_count', 'current_round', 'current_player', 'action_buttons']
+class RoomAdmin(SerializedWriteAdmin):
+    list_display = ['code', 'created_at', 'is_active', 'capacity', 'player_count', 'current_round', 'current_player', 'action_buttons']
     list_filter = ['is_active', 'created_at']
     search_fields = ['code']
     readonly_fields = ['code', 'created_at']
@@ -37,7 +61,7 @@ class RoomAdmin(admin.ModelAdmin):
     current_player.short_description = 'Current Player'
     
     def action_buttons(self, obj):
-        if obj.is_active and obj.players.count() == 2:
+        if obj.is_active and obj.is_full():
             return format_html(
                 '<a class="button" href="#" onclick="injectQuestion(\'{}\'); return false;">Inject Question</a>',
                 obj.code
@@ -50,32 +74,61 @@ class RoomAdmin(admin.ModelAdmin):
 
 
 @admin.register(Player)
-class PlayerAdmin(admin.ModelAdmin):
+class PlayerAdmin(SerializedWriteAdmin):
     list_display = ['name', 'room', 'join_order', 'created_at']
     list_filter = ['room', 'created_at']
     search_fields = ['name', 'room__code']
+    
+    def delete_model(self, request, obj):
+        # Take the player out of the turn order before deleting them
+        TurnManagementService.remove_player(obj)
+    
+    def delete_queryset(self, request, queryset):
+        for player in queryset.select_related('room'):
+            TurnManagementService.remove_player(player)
 
 
 @admin.register(GameState)
-class GameStateAdmin(admin.ModelAdmin):
+class GameStateAdmin(SerializedWriteAdmin):
     list_display = ['room', 'current_turn_player', 'round_number', 'current_choice', 'created_at']
     list_filter = ['round_number', 'created_at']
     search_fields = ['room__code']
 
 
 @admin.register(Question)
-class QuestionAdmin(admin.ModelAdmin):
+class QuestionAdmin(SerializedWriteAdmin):
     list_display = ['room', 'question_type', 'source', 'text_preview', 'is_answered', 'created_at']
     list_filter = ['question_type', 'source', 'is_answered', 'created_at']
-    search_fields = ['room__code', 'text']
+    list_select_related = ['room', 'question_text']
+    search_fields = ['room__code', 'question_text__text']
+    raw_id_fields = ['question_text']
+    
+    def text_preview(self, obj):
+        return obj.text[:50] + '...' if len(obj.text) > 50 else obj.text
+    text_preview.short_description = 'Question'
+
+
+@admin.register(QuestionText)
+class QuestionTextAdmin(SerializedWriteAdmin):
+    list_display = ['text_preview', 'question_count', 'created_at']
+    search_fields = ['text', 'digest']
+    readonly_fields = ['digest', 'created_at']
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(question_count=Count('questions'))
     
     def text_preview(self, obj):
         return obj.text[:50] + '...' if len(obj.text) > 50 else obj.text
     text_preview.short_description = 'Question'
+    
+    def question_count(self, obj):
+        return obj.question_count
+    question_count.short_description = 'Times asked'
+    question_count.admin_order_field = 'question_count'
 
 
 @admin.register(Answer)
-class AnswerAdmin(admin.ModelAdmin):
+class AnswerAdmin(SerializedWriteAdmin):
     list_display = ['player', 'question', 'answer_preview', 'created_at']
     list_filter = ['created_at']
     search_fields = ['player__name', 'answer_text']
@@ -86,10 +139,12 @@ class AnswerAdmin(admin.ModelAdmin):
 
 
 @admin.register(StandaloneRequest)
-class StandaloneRequestAdmin(admin.ModelAdmin):
+class StandaloneRequestAdmin(SerializedWriteAdmin):
     list_display = ['user_name', 'question_type', 'question_source', 'question_preview', 'is_active', 'updated_at']
     list_filter = ['is_active', 'question_type', 'question_source', 'created_at']
-    search_fields = ['user_name', 'session_id', 'current_question']
+    list_select_related = ['current_question_text']
+    search_fields = ['user_name', 'session_id', 'current_question_text__text']
+    raw_id_fields = ['current_question_text']
     readonly_fields = ['session_id', 'created_at', 'updated_at']
     
     def question_preview(self, obj):
@@ -97,3 +152,44 @@ class StandaloneRequestAdmin(admin.ModelAdmin):
             return obj.current_question[:50] + '...' if len(obj.current_question) > 50 else obj.current_question
         return '-'
     question_preview.short_description = 'Current Question'
+
+
+@admin.register(ProfileRecord)
+class ProfileRecordAdmin(SerializedWriteAdmin):
+    list_display = ['path', 'kind', 'room_code', 'duration_ms', 'query_count', 'requested_by', 'created_at', 'download_link']
+    list_filter = ['kind', 'created_at']
+    search_fields = ['path', 'room_code', 'requested_by']
+    readonly_fields = ['kind', 'path', 'room_code', 'requested_by', 'duration_ms', 'query_count', 'query_log', 'stats_preview', 'created_at', 'download_link']
+    exclude = ['profile_data', 'stats_text']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def get_urls(self):
+        urls = [
+            path(
+                '<int:record_id>/download/',
+                self.admin_site.admin_view(self.download_view),
+                name='game_profilerecord_download',
+            ),
+        ]
+        return urls + super().get_urls()
+    
+    def download_view(self, request, record_id):
+        record = get_object_or_404(ProfileRecord, pk=record_id)
+        response = HttpResponse(bytes(record.profile_data), content_type='application/octet-stream')
+        response['Content-Disposition'] = f'attachment; filename="profile-{record.id}.prof"'
+        return response
+    
+    def download_link(self, obj):
+        if not obj.pk or not obj.profile_data:
+            return '-'
+        return format_html(
+            '<a href="{}">Download .prof</a>',
+            reverse('admin:game_profilerecord_download', args=[obj.pk])
+        )
+    download_link.short_description = 'Profile'
+    
+    def stats_preview(self, obj):
+        return format_html('<pre style="white-space: pre; overflow-x: auto;">{}</pre>', obj.stats_text)
+    stats_preview.short_description = 'Top functions (cumulative)'
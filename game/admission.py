@@ -0,0 +1,99 @@
+"""
+Per-worker admission control.
+
+Caps concurrent WebSocket connections, rooms with open sockets, in-flight
+HTTP requests and in-flight sync executor work, configured in
+``GAME_ADMISSION``. Once a cap is hit new work is turned away with a
+retry hint, so latency for what was already admitted stays bounded.
+
+The sync executor cap also applies to sockets already admitted: while it
+is reached, each client event that would queue executor work is answered
+with an ``overloaded`` error frame instead of being handled.
+"""
+import threading
+
+from django.conf import settings
+
+from . import metrics
+
+DEFAULT_ADMISSION = {
+    'max_connections': 2000,
+    'max_rooms': 1000,
+    'max_http_in_flight': 200,
+    'max_sync_in_flight': 100,
+    'retry_after': 5,
+}
+
+
+def get_limit(name):
+    return getattr(settings, 'GAME_ADMISSION', DEFAULT_ADMISSION).get(name, DEFAULT_ADMISSION[name])
+
+
+def sync_in_flight():
+    """Calls queued for or running on the sync executor."""
+    return metrics.get_gauge('sync_executor.queued') + metrics.get_gauge('sync_executor.busy')
+
+
+class AdmissionController:
+    """Tracks admitted sockets and requests on this worker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.rooms = {}
+        self.http_in_flight = 0
+
+    def admit_socket(self, room_code):
+        """Admit a socket to a room; return True, or False if the worker is full."""
+        with self._lock:
+            if (
+                self.connections >= get_limit('max_connections')
+                or (room_code not in self.rooms and len(self.rooms) >= get_limit('max_rooms'))
+                or sync_in_flight() >= get_limit('max_sync_in_flight')
+            ):
+                metrics.incr('admission.rejected.ws')
+                return False
+            self.connections += 1
+            self.rooms[room_code] = self.rooms.get(room_code, 0) + 1
+            metrics.set_gauge('admission.connections', self.connections)
+            metrics.set_gauge('admission.rooms', len(self.rooms))
+            return True
+
+    def release_socket(self, room_code):
+        with self._lock:
+            self.connections -= 1
+            remaining = self.rooms.get(room_code, 1) - 1
+            if remaining:
+                self.rooms[room_code] = remaining
+            else:
+                self.rooms.pop(room_code, None)
+            metrics.set_gauge('admission.connections', self.connections)
+            metrics.set_gauge('admission.rooms', len(self.rooms))
+
+    def admit_request(self):
+        """Admit an HTTP request; return True, or False if the worker is full."""
+        with self._lock:
+            if (
+                self.http_in_flight >= get_limit('max_http_in_flight')
+                or sync_in_flight() >= get_limit('max_sync_in_flight')
+            ):
+                metrics.incr('admission.rejected.http')
+                return False
+            self.http_in_flight += 1
+            metrics.set_gauge('admission.http_in_flight', self.http_in_flight)
+            return True
+
+    def admit_event(self):
+        """Admit a client event from an open socket; return True, or False if the executor is full."""
+        if sync_in_flight() >= get_limit('max_sync_in_flight'):
+            metrics.incr('admission.rejected.event')
+            return False
+        return True
+
+    def release_request(self):
+        with self._lock:
+            self.http_in_flight -= 1
+            metrics.set_gauge('admission.http_in_flight', self.http_in_flight)
+
+
+controller = AdmissionController()
@@ -4,3 +4,18 @@ from django.apps import AppConfig
 class GameConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'game'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_delete, post_save
+        from .models import Answer, GameState, Player, Question, QuestionText, Room, StandaloneRequest, forget_interned
+        from .replicas import record_model_write, replica_enabled
+        from .sqlite import configure_connection
+        from .writebehind import install_shutdown_hooks
+        connection_created.connect(configure_connection)
+        post_delete.connect(forget_interned, sender=QuestionText)
+        if replica_enabled():
+            for model in (Room, Player, GameState, Question, Answer, StandaloneRequest):
+                post_save.connect(record_model_write, sender=model)
+                post_delete.connect(record_model_write, sender=model)
+        install_shutdown_hooks()
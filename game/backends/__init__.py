@@ -0,0 +1,4 @@
+"""
+Pooled variants of the Django database backends, selected in settings when
+``GAME_DB_POOL_ENABLED`` is set; see ``game.dbpool``.
+"""
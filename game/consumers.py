@@ -1,20 +1,101 @@
-import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import Room, Player, GameState, Question
-from .services import TurnManagementService
+from . import admission, encoding, metrics, presence, spectators
+from .engine import engine_enabled, get_engine
+from .metrics import traced_sync_to_async
+from .profiling import ProfileSession, is_truthy, profiling_enabled
+from .ratelimit import player_buckets, socket_bucket
+from .prefetch import prefetcher
+from .push import EPOCH, event_buffer, mark_room_dirty, publish, publisher
+from .models import Room, Player
+from .services import TurnManagementService, RoomStateService
+from .tokens import cached_revocation, is_revoked, read_player_token
 
+# Client events that change game state and are also limited per player
+MUTATION_EVENTS = {'join_room', 'start_game', 'choose_truth_dare', 'submit_answer'}
 
-class GameConsumer(AsyncWebsocketConsumer):
+
+class FrameConsumer(AsyncWebsocketConsumer):
+    """
+    Base consumer that speaks JSON text frames by default, or MessagePack
+    binary frames when the client negotiates the td.msgpack.v1 subprotocol.
+    """
+    binary = False
+    
+    async def accept_negotiated(self):
+        """Accept the socket with the best subprotocol the client offered."""
+        subprotocol = encoding.negotiate_subprotocol(self.scope.get('subprotocols', []))
+        self.binary = subprotocol == encoding.MSGPACK_SUBPROTOCOL
+        await self.accept(subprotocol=subprotocol)
+        if self.binary:
+            await self.send(bytes_data=encoding.protocol_hello())
+    
+    def overloaded_frame(self):
+        return {
+            'type': 'error',
+            'code': 'overloaded',
+            'message': 'Server is busy, please retry shortly',
+            'retry_after': admission.get_limit('retry_after')
+        }
+    
+    async def reject_overloaded(self):
+        """Tell the client the worker is at capacity and close with 1013 (try again later)."""
+        await self.accept_negotiated()
+        await self.send_frame(self.overloaded_frame())
+        await self.close(code=1013)
+    
+    def decode(self, text_data=None, bytes_data=None):
+        """Decode an incoming frame in the negotiated format."""
+        if bytes_data is not None:
+            return encoding.unpack(bytes_data)
+        return encoding.loads(text_data)
+    
+    async def send_frame(self, frame):
+        """Encode and send a frame in the negotiated format."""
+        if self.binary:
+            await self.send(bytes_data=encoding.pack(frame))
+        else:
+            await self.send(text_data=encoding.dumps(frame))
+    
+    async def forward(self, event):
+        """Forward a broadcast frame that the sender already encoded."""
+        if self.binary:
+            packed = event.get('packed')
+            if packed is None:
+                packed = encoding.pack(encoding.loads(event['text']))
+            await self.send(bytes_data=packed)
+        else:
+            await self.send(text_data=event['text'])
+
+
+class GameConsumer(FrameConsumer):
     """WebSocket consumer for real-time game updates."""
+    present = False
+    admitted = False
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limit = socket_bucket()
     
     async def connect(self):
         self.room_code = self.scope['url_route']['kwargs']['room_code']
         self.room_group_name = f'game_{self.room_code}'
         
-        # Check if room exists
-        room = await self.get_room()
-        if not room:
+        # Turn the socket away before doing any work if this worker is full
+        if not admission.controller.admit_socket(self.room_code):
+            await self.reject_overloaded()
+            return
+        self.admitted = True
+        
+        # Resolve room and player identity once for the whole connection; a
+        # player's token carries both, so only spectators need a lookup
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        identity = await self.read_token(query.get('token', [None])[0])
+        if identity:
+            self.room_id, self.player_id = identity.room_id, identity.player_id
+        else:
+            self.room_id, self.player_id = await self.load_room_id(), None
+        if not self.room_id:
             await self.close()
             return
         
@@ -24,260 +105,415 @@ class GameConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
+        await self.accept_negotiated()
+        
+        # Replay missed events to a resuming client, or send the full state
+        await self.resume(query.get('epoch', [None])[0], query.get('last_seq', [None])[0])
         
-        # Send current room state
-        await self.send_room_state()
+        if self.player_id:
+            await self.mark_present()
+        presence.ensure_sweeper()
+    
+    async def dispatch(self, message):
+        """Trace group events the same way as client events."""
+        if message['type'].startswith('websocket.'):
+            await super().dispatch(message)
+            return
+        with metrics.span(f"group.{message['type']}"):
+            await super().dispatch(message)
+    
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """Send a frame, attributing the time to the current span."""
+        with metrics.timed('send'):
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
     
     async def disconnect(self, close_code):
+        if not self.admitted:
+            return
+        admission.controller.release_socket(self.room_code)
+        
+        if self.present and presence.tracker.disconnect(self.room_code, self.player_id):
+            await presence.broadcast_presence(self.room_code)
+        
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
     
-    async def receive(self, text_data):
+    def check_rate_limit(self, event_type):
+        """Charge the connection's bucket, and the player's for mutations."""
+        retry_after = self.rate_limit.consume()
+        if not retry_after and event_type in MUTATION_EVENTS and self.player_id:
+            retry_after = player_buckets.consume(f'player:{self.player_id}')
+        return retry_after
+    
+    async def mark_present(self):
+        """Register this socket in the presence map and announce if it changed."""
+        self.present = True
+        if presence.tracker.connect(self.room_code, self.room_id, self.player_id):
+            await presence.broadcast_presence(self.room_code)
+    
+    async def receive(self, text_data=None, bytes_data=None):
         """Handle messages from WebSocket."""
         try:
-            data = json.loads(text_data)
+            data = self.decode(text_data, bytes_data)
             event_type = data.get('type')
             
-            if event_type == 'join_room':
-                await self.handle_join_room(data)
-            elif event_type == 'start_game':
-                await self.handle_start_game()
-            elif event_type == 'choose_truth_dare':
-                await self.handle_choose_truth_dare(data)
-            elif event_type == 'submit_answer':
-                await self.handle_submit_answer(data)
-            elif event_type == 'get_state':
-                await self.send_room_state()
+            # Any frame from the client counts as a heartbeat
+            if self.player_id and presence.tracker.touch(self.room_code, self.player_id):
+                await presence.broadcast_presence(self.room_code)
+            if event_type == 'heartbeat':
+                await self.send_frame({'type': 'heartbeat_ack'})
+                return
+            
+            retry_after = self.check_rate_limit(event_type)
+            if retry_after:
+                metrics.incr('ratelimit.throttled.ws')
+                await self.send_frame({
+                    'type': 'error',
+                    'code': 'rate_limited',
+                    'message': 'Too many messages',
+                    'retry_after': round(retry_after, 2)
+                })
+                return
+            
+            # The token was checked at connect; the player may have been removed since
+            if event_type in MUTATION_EVENTS and self.player_id and await self.is_revoked(self.room_id, self.player_id):
+                await self.send_frame({
+                    'type': 'error',
+                    'code': 'revoked',
+                    'message': 'Invalid or expired player token'
+                })
+                await self.close(code=4003)
+                return
+            
+            # Sockets admitted earlier must not pile up executor work either
+            if not admission.controller.admit_event():
+                await self.send_frame(self.overloaded_frame())
+                return
+            
+            with metrics.span(f'ws.{event_type}'):
+                if is_truthy(data.get('profile')) and self.can_profile():
+                    await self.handle_event_profiled(event_type, data)
+                else:
+                    await self.handle_event(event_type, data)
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'error',
                 'message': str(e)
-            }))
+            })
+    
+    async def handle_event(self, event_type, data):
+        """Dispatch a client event to its handler."""
+        if event_type == 'join_room':
+            await self.handle_join_room(data)
+        elif event_type == 'start_game':
+            await self.handle_start_game()
+        elif event_type == 'choose_truth_dare':
+            await self.handle_choose_truth_dare(data)
+        elif event_type == 'submit_answer':
+            await self.handle_submit_answer(data)
+        elif event_type == 'get_state':
+            await self.send_room_state()
+        elif event_type == 'resume':
+            await self.resume(data.get('epoch'), data.get('last_seq'))
+    
+    def can_profile(self):
+        """Only staff users may ask for an event to be profiled."""
+        user = self.scope.get('user')
+        return bool(profiling_enabled() and user and user.is_staff)
+    
+    async def handle_event_profiled(self, event_type, data):
+        """
+        Handle a client event under the profiler and store the result.
+        
+        Only the event's sync executor hops are profiled: each one captures
+        its own thread while it runs (``traced_sync_to_async``). Profiling
+        the event loop across the handler's awaits would also record every
+        other socket's work that ran in between.
+        """
+        session = ProfileSession()
+        with session.activate():
+            await self.handle_event(event_type, data)
+        await traced_sync_to_async(session.save)(
+            'WS',
+            f'ws/room/{self.room_code}/{event_type}',
+            room_code=self.room_code.upper(),
+            requested_by=self.scope['user'].get_username(),
+        )
+    
+    async def read_token(self, token):
+        """Return the identity a player token carries, if valid and not revoked."""
+        identity = read_player_token(token, self.room_code, check_revoked=False)
+        if identity and await self.is_revoked(identity.room_id, identity.player_id):
+            metrics.incr('player_token.revoked')
+            return None
+        return identity
+    
+    async def is_revoked(self, room_id, player_id):
+        """Check a revocation in the cache, asking the database only when it doesn't know."""
+        revoked = cached_revocation(room_id, player_id)
+        if revoked is None:
+            revoked = await traced_sync_to_async(is_revoked)(room_id, player_id)
+        return revoked
+    
+    async def resolve_player(self, token):
+        """Return this connection's player id, taking it from a player token if needed."""
+        if self.player_id is None and token:
+            identity = await self.read_token(token)
+            if identity and identity.room_id == self.room_id:
+                self.player_id = identity.player_id
+                await self.mark_present()
+        return self.player_id
+    
+    def mark_dirty(self):
+        """Schedule a coalesced room state push to the whole room."""
+        mark_room_dirty(self.room_code, self.room_id)
     
     async def handle_join_room(self, data):
         """Handle player joining room."""
-        room = await self.get_room()
-        if room:
-            # Check if room is now full and game should start
-            if room.is_full():
-                # Initialize game if not already started
-                existing_game_state = await self.get_game_state(room)
-                if not existing_game_state:
-                    await self.handle_start_game()
-            
-            await self.send_room_state()
-            # Broadcast to group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'player_joined',
-                    'room_code': self.room_code
-                }
-            )
+        await self.resolve_player(data.get('token'))
+        
+        # Initialize game if the room is now full and not already started
+        await self.start_game(when_full=True)
+        self.mark_dirty()
     
     async def handle_start_game(self):
         """Handle game start."""
-        room = await self.get_room()
-        if room and room.is_full():
-            game_state = await database_sync_to_async(TurnManagementService.initialize_game)(room)
-            if game_state:
-                await self.send_room_state()
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'game_started',
-                        'room_code': self.room_code
-                    }
-                )
+        game_state_id, created = await self.start_game()
+        if game_state_id:
+            self.mark_dirty()
     
     async def handle_choose_truth_dare(self, data):
         """Handle truth/dare choice."""
-        player_id = data.get('player_id')
-        choice = data.get('choice')
-        
-        room = await self.get_room()
-        if not room:
+        player_id = await self.resolve_player(data.get('token'))
+        if not player_id:
             return
         
-        player = await self.get_player(player_id)
-        if not player:
-            return
-        
-        game_state = await self.get_game_state(room)
-        if not game_state or game_state.current_turn_player_id != player.id:
-            return
-        
-        # Update game state
-        game_state.current_choice = choice
-        game_state.is_waiting_for_question = True
-        await database_sync_to_async(game_state.save)()
-        
-        # Create question
-        question = await database_sync_to_async(
-            TurnManagementService.create_question_from_api
-        )(room, choice)
-        
+        question = await self.apply_choice(player_id, data.get('choice'))
         if question:
-            await self.send_room_state()
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'question_sent',
-                    'room_code': self.room_code,
-                    'question': {
-                        'id': question.id,
-                        'text': question.text,
-                        'type': question.question_type,
-                        'source': question.source
-                    }
-                }
+            self.mark_dirty()
+            await publish(
+                self.room_code,
+                'question_sent',
+                {'type': 'question_sent', 'question': question}
             )
     
     async def handle_submit_answer(self, data):
         """Handle answer submission."""
-        player_id = data.get('player_id')
-        answer_text = data.get('answer_text')
-        
-        room = await self.get_room()
-        if not room:
+        player_id = await self.resolve_player(data.get('token'))
+        if not player_id:
             return
         
-        player = await self.get_player(player_id)
-        if not player:
-            return
-        
-        answer = await database_sync_to_async(
-            TurnManagementService.submit_answer
-        )(room, player, answer_text)
-        
-        if answer:
-            await self.send_room_state()
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'answer_submitted',
-                    'room_code': self.room_code,
-                    'next_turn': answer.question.game_state.current_turn_player.name if answer.question.game_state.current_turn_player else None
-                }
+        result = await self.apply_answer(player_id, data.get('answer_text'))
+        if result:
+            self.mark_dirty()
+            await publish(
+                self.room_code,
+                'answer_submitted',
+                {'type': 'answer_submitted', 'next_turn': result['next_turn']}
             )
     
     async def send_room_state(self):
-        """Send current room state to client."""
-        room = await self.get_room()
-        if not room:
+        """Send current room state to this client only."""
+        # Read the sequence head first so the client never skips an event
+        # broadcast while the snapshot was being built
+        seq = event_buffer.head(self.room_code)
+        state = await self.get_room_state()
+        if state:
+            state['seq'] = seq
+            state['epoch'] = EPOCH
+            state['connected_player_ids'] = presence.tracker.connected(self.room_code)
+            await self.send_frame(state)
+    
+    async def resume(self, epoch, last_seq):
+        """Replay the events a reconnecting client missed, or fall back to a snapshot."""
+        if not epoch or not str(last_seq).isdigit():
+            await self.send_room_state()
             return
         
-        players_data = []
-        for player in await self.get_players(room):
-            players_data.append({
-                'id': player.id,
-                'name': player.name,
-                'join_order': player.join_order
-            })
-        
-        game_state = await self.get_game_state(room)
-        game_state_data = None
-        current_question = None
-        
-        if game_state:
-            current_player = await self.get_player(game_state.current_turn_player_id) if game_state.current_turn_player_id else None
-            game_state_data = {
-                'round_number': game_state.round_number,
-                'current_turn_player_id': game_state.current_turn_player_id,
-                'current_turn_player_name': current_player.name if current_player else None,
-                'current_choice': game_state.current_choice,
-                'is_waiting_for_question': game_state.is_waiting_for_question,
-                'is_waiting_for_answer': game_state.is_waiting_for_answer
-            }
-            
-            question = await self.get_current_question(room)
-            if question:
-                current_question = {
-                    'id': question.id,
-                    'text': question.text,
-                    'type': question.question_type,
-                    'source': question.source
-                }
-        
-        await self.send(text_data=json.dumps({
-            'type': 'room_state',
-            'room': {
-                'code': room.code,
-                'is_active': room.is_active,
-                'is_full': room.is_full()
-            },
-            'players': players_data,
-            'game_state': game_state_data,
-            'current_question': current_question
-        }))
+        events = event_buffer.since(self.room_code, epoch, int(last_seq))
+        if events is None:
+            metrics.incr('resume.snapshot')
+            await self.send_room_state()
+            return
+        metrics.incr('resume.replayed')
+        metrics.incr('resume.events', len(events))
+        for event in events:
+            await self.forward(event)
     
     # WebSocket event handlers
-    async def player_joined(self, event):
-        """Handle player joined event."""
-        await self.send_room_state()
-    
-    async def game_started(self, event):
-        """Handle game started event."""
-        await self.send_room_state()
+    # Broadcast frames arrive pre-encoded by the sender and are forwarded
+    async def room_state(self, event):
+        """Handle a coalesced room state push."""
+        await self.forward(event)
     
     async def question_sent(self, event):
         """Handle question sent event."""
-        await self.send(text_data=json.dumps({
-            'type': 'question_sent',
-            'question': event['question']
-        }))
+        await self.forward(event)
     
     async def answer_submitted(self, event):
         """Handle answer submitted event."""
-        await self.send(text_data=json.dumps({
-            'type': 'answer_submitted',
-            'next_turn': event.get('next_turn')
-        }))
+        await self.forward(event)
+    
+    async def presence_changed(self, event):
+        """Handle presence change event."""
+        await self.forward(event)
     
     async def admin_question_injected(self, event):
         """Handle admin question injection."""
-        await self.send(text_data=json.dumps({
-            'type': 'admin_question_injected',
-            'question': event['question']
-        }))
-        await self.send_room_state()
+        await self.forward(event)
+        self.mark_dirty()
     
     # Database helpers
-    @database_sync_to_async
-    def get_room(self):
-        try:
-            room = Room.objects.get(code=self.room_code, is_active=True)
-            # Refresh players count
-            room.refresh_from_db()
-            return room
-        except Room.DoesNotExist:
+    # Each helper is a single hop to the sync executor. Nothing touches the
+    # ORM from the event loop.
+    @traced_sync_to_async
+    def load_room_id(self):
+        return Room.objects.filter(
+            code=self.room_code, is_active=True
+        ).values_list('id', flat=True).first()
+    
+    @traced_sync_to_async
+    def get_room_state(self):
+        return RoomStateService.build_snapshot(self.room_id)
+    
+    @traced_sync_to_async
+    def start_game(self, when_full=False):
+        """
+        Initialize the game once enough players have joined, or only once the
+        room is full if ``when_full``. Returns (game_state_id, created).
+        """
+        if engine_enabled():
+            engine = get_engine(self.room_id)
+            return engine.start(when_full) if engine else (None, False)
+        
+        room = Room.objects.filter(id=self.room_id, is_active=True).first()
+        if not room or not (room.is_full() if when_full else room.can_start()):
+            return None, False
+        existing_game_state = room.get_current_game_state()
+        if existing_game_state:
+            return existing_game_state.id, False
+        game_state = TurnManagementService.initialize_game(room)
+        return (game_state.id, True) if game_state else (None, False)
+    
+    @traced_sync_to_async
+    def apply_choice(self, player_id, choice):
+        if engine_enabled():
+            engine = get_engine(self.room_id)
+            if not engine or not engine.is_turn(player_id):
+                return None
+            picked = prefetcher.take(self.room_id, player_id, choice)
+            question = engine.choose(player_id, choice, picked.text, picked.source)
+            if not question:
+                prefetcher.give_back(picked)
+            return question
+        
+        room = Room.objects.filter(id=self.room_id, is_active=True).first()
+        if not room:
+            return None
+        
+        game_state = room.get_current_game_state()
+        if not game_state or game_state.current_turn_player_id != player_id:
+            return None
+        
+        picked = prefetcher.take(self.room_id, player_id, choice)
+        question = TurnManagementService.choose(room, player_id, choice, picked.text, picked.source)
+        if not question:
+            # The turn passed after the check above
+            prefetcher.give_back(picked)
             return None
+        return {
+            'id': question.id,
+            'text': question.text,
+            'type': question.question_type,
+            'source': question.source
+        }
     
-    @database_sync_to_async
-    def get_player(self, player_id):
-        try:
-            return Player.objects.get(id=player_id)
-        except Player.DoesNotExist:
+    @traced_sync_to_async
+    def apply_answer(self, player_id, answer_text):
+        if engine_enabled():
+            engine = get_engine(self.room_id)
+            result = engine.submit_answer(player_id, answer_text) if engine else None
+            return {'next_turn': result['next_turn']} if result else None
+        
+        room = Room.objects.filter(id=self.room_id, is_active=True).first()
+        if not room:
             return None
+        
+        # The player id came from a signed token, so it needs no lookup
+        player = Player(id=player_id, room_id=self.room_id)
+        answer = TurnManagementService.submit_answer(room, player, answer_text)
+        if not answer:
+            return None
+        current_player = answer.question.game_state.current_turn_player
+        return {'next_turn': current_player.name if current_player else None}
+
+
+class SpectatorConsumer(FrameConsumer):
+    """
+    Read-only WebSocket consumer for watching a room.
+    
+    Spectators are sent the latest room state the publisher already holds
+    and then every broadcast, relayed by the worker's ``SpectatorHub``
+    rather than through a group membership of their own. Nothing is
+    queried per spectator and moves are refused.
+    """
+    admitted = False
+    watching = False
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limit = socket_bucket()
     
-    @database_sync_to_async
-    def get_players(self, room):
-        return list(room.get_players())
+    async def connect(self):
+        self.room_code = self.scope['url_route']['kwargs']['room_code']
+        
+        if not admission.controller.admit_socket(self.room_code):
+            await self.reject_overloaded()
+            return
+        self.admitted = True
+        
+        # The kept state is only current while this worker relays the room
+        message = await publisher.latest(self.room_code, fresh=not spectators.hub.count(self.room_code))
+        if message is None:
+            await self.close()
+            return
+        
+        await self.accept_negotiated()
+        # Join before sending the state so no broadcast falls in between
+        await spectators.hub.join(self.room_code, self)
+        self.watching = True
+        await self.forward(message)
+        metrics.gauge_add('spectators.connections', 1)
     
-    @database_sync_to_async
-    def get_game_state(self, room):
-        return room.get_current_game_state()
+    async def disconnect(self, close_code):
+        if not self.admitted:
+            return
+        admission.controller.release_socket(self.room_code)
+        if self.watching:
+            await spectators.hub.leave(self.room_code, self)
+            metrics.gauge_add('spectators.connections', -1)
     
-    @database_sync_to_async
-    def get_current_question(self, room):
-        return TurnManagementService.get_current_question(room)
+    async def receive(self, text_data=None, bytes_data=None):
+        """Answer heartbeats; spectators can't send anything else."""
+        try:
+            data = self.decode(text_data, bytes_data)
+        except Exception as e:
+            await self.send_frame({'type': 'error', 'message': str(e)})
+            return
+        if data.get('type') == 'heartbeat':
+            await self.send_frame({'type': 'heartbeat_ack'})
+        elif not self.rate_limit.consume():
+            await self.send_frame({
+                'type': 'error',
+                'code': 'read_only',
+                'message': 'Spectators cannot send moves'
+            })
 
 
-class StandaloneConsumer(AsyncWebsocketConsumer):
+class StandaloneConsumer(FrameConsumer):
     """WebSocket consumer for standalone truth/dare requests."""
     
     async def connect(self):
@@ -290,7 +526,7 @@ class StandaloneConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
+        await self.accept_negotiated()
     
     async def disconnect(self, close_code):
         # Leave group
@@ -299,20 +535,17 @@ class StandaloneConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """Handle messages from WebSocket."""
         try:
-            data = json.loads(text_data)
+            data = self.decode(text_data, bytes_data)
             # Handle any client messages if needed
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'error',
                 'message': str(e)
-            }))
+            })
     
     async def admin_question_injected(self, event):
         """Handle admin question injection."""
-        await self.send(text_data=json.dumps({
-            'type': 'admin_question_injected',
-            'question': event['question']
-        }))
+        await self.forward(event)
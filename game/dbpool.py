@@ -0,0 +1,221 @@
+"""
+Bounded database connection pool shared across threads.
+
+Django keeps one connection per thread, so every executor thread that
+runs ORM calls for the consumers, the write-behind thread and the request
+threads each hold (and, as connections age out, reopen) their own. With
+``GAME_DB_POOL_ENABLED`` the database backends are swapped for pooled
+variants (``game.backends.*``) whose connections come from one pool per
+database and process, capped at ``GAME_DB_POOL_SIZE``. ``CONN_MAX_AGE`` is
+set to 0, so a connection goes back to the pool at the end of every
+request and every consumer database call instead of idling on its thread.
+
+A connection idle for more than ``GAME_DB_POOL_CHECK_IDLE_SECONDS`` is
+pinged before it is handed out, and one older than
+``GAME_DB_POOL_RECYCLE_SECONDS`` is replaced. Checkouts, waits, timeouts
+and new connects are recorded as ``db_pool.<alias>.*`` metrics.
+"""
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import metrics
+
+
+class PoolTimeout(Exception):
+    """No connection became free within the checkout timeout."""
+
+
+class PooledConnection:
+    """A raw DB-API connection and the bookkeeping the pool keeps for it."""
+    __slots__ = ('raw', 'created', 'returned')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created = self.returned = time.monotonic()
+
+
+class ConnectionPool:
+    """At most ``size`` open connections, handed out to one thread at a time."""
+
+    def __init__(self, alias, size, timeout, recycle, check_idle):
+        self.alias = alias
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.check_idle = check_idle
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._in_use = {}
+        self._open = 0
+
+    def _metric(self, name):
+        return f'db_pool.{self.alias}.{name}'
+
+    def acquire(self, connect):
+        """Check out a connection, calling ``connect()`` when a new one is needed."""
+        metrics.incr(self._metric('checkouts'))
+        while True:
+            with self._cond:
+                pooled = self._take()
+            if pooled is None:
+                return self._connect(connect)
+            # Pinged outside the lock; the connection is already marked in use
+            if self._healthy(pooled):
+                return pooled.raw
+            self.release(pooled.raw, discard=True)
+
+    def _take(self):
+        """
+        Reserve an idle connection, or a slot for a new one (None), waiting
+        up to ``timeout`` for either.
+        """
+        waited_from = None
+        while True:
+            if self._idle or self._open < self.size:
+                break
+            now = time.monotonic()
+            if waited_from is None:
+                waited_from = now
+                metrics.incr(self._metric('waits'))
+            remaining = waited_from + self.timeout - now
+            if remaining <= 0:
+                metrics.incr(self._metric('timeouts'))
+                raise PoolTimeout(
+                    f'No connection to {self.alias!r} free within {self.timeout}s '
+                    f'({self.size} in use)'
+                )
+            self._cond.wait(remaining)
+        if waited_from is not None:
+            metrics.observe(self._metric('wait'), time.monotonic() - waited_from)
+
+        if not self._idle:
+            self._open += 1
+            return None
+        pooled = self._idle.pop()
+        self._in_use[id(pooled.raw)] = pooled
+        metrics.set_gauge(self._metric('in_use'), len(self._in_use))
+        return pooled
+
+    def _connect(self, connect):
+        # Outside the lock so other threads can keep checking out meanwhile
+        try:
+            raw = connect()
+        except BaseException:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        metrics.incr(self._metric('connects'))
+        pooled = PooledConnection(raw)
+        with self._cond:
+            self._in_use[id(raw)] = pooled
+            metrics.set_gauge(self._metric('in_use'), len(self._in_use))
+        return raw
+
+    def _healthy(self, pooled):
+        now = time.monotonic()
+        if now - pooled.created > self.recycle:
+            metrics.incr(self._metric('recycled'))
+            return False
+        if now - pooled.returned > self.check_idle:
+            try:
+                cursor = pooled.raw.cursor()
+                cursor.execute('SELECT 1')
+                cursor.close()
+            except Exception:
+                metrics.incr(self._metric('failed_checks'))
+                return False
+        return True
+
+    def _discard(self, pooled):
+        self._open -= 1
+        try:
+            pooled.raw.close()
+        except Exception:
+            pass
+
+    def release(self, raw, discard=False):
+        """Return a checked out connection, or close it when ``discard`` is set."""
+        with self._cond:
+            pooled = self._in_use.pop(id(raw), None)
+            metrics.set_gauge(self._metric('in_use'), len(self._in_use))
+            if pooled is None:
+                return
+            if discard:
+                self._discard(pooled)
+            else:
+                pooled.returned = time.monotonic()
+                self._idle.append(pooled)
+            self._cond.notify()
+
+    def close_idle(self):
+        """Close every connection not currently checked out."""
+        with self._cond:
+            while self._idle:
+                self._discard(self._idle.pop())
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'open': self._open,
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias):
+    """Return the pool for a database alias, creating it on first use."""
+    pool = _pools.get(alias)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(alias)
+            if pool is None:
+                pool = _pools[alias] = ConnectionPool(
+                    alias,
+                    size=getattr(settings, 'GAME_DB_POOL_SIZE', 20),
+                    timeout=getattr(settings, 'GAME_DB_POOL_TIMEOUT_SECONDS', 10),
+                    recycle=getattr(settings, 'GAME_DB_POOL_RECYCLE_SECONDS', 600),
+                    check_idle=getattr(settings, 'GAME_DB_POOL_CHECK_IDLE_SECONDS', 30),
+                )
+    return pool
+
+
+def pool_stats():
+    """Return {alias: stats} for every pool opened in this process."""
+    return {alias: pool.stats() for alias, pool in list(_pools.items())}
+
+
+class PooledDatabaseWrapperMixin:
+    """Takes a backend's connections from the pool and gives them back on close."""
+
+    def get_new_connection(self, conn_params):
+        connect = super().get_new_connection
+        try:
+            return get_pool(self.alias).acquire(lambda: connect(conn_params))
+        except PoolTimeout as exc:
+            raise self.Database.OperationalError(str(exc)) from exc
+
+    def _close(self):
+        if self.connection is None:
+            return
+        pool = get_pool(self.alias)
+        # Closed mid-transaction the connection's state is unknown; drop it
+        if self.in_atomic_block:
+            pool.release(self.connection, discard=True)
+            return
+        try:
+            with self.wrap_database_errors:
+                self.connection.rollback()
+        except Exception:
+            pool.release(self.connection, discard=True)
+            return
+        pool.release(self.connection)
@@ -0,0 +1,182 @@
+"""
+Frame encoding shared by views and consumers.
+
+JSON is the default. The backend is picked with ``GAME_JSON_BACKEND``:
+``'orjson'``, ``'ujson'``, ``'json'`` or ``'auto'`` (the default, which
+prefers orjson, then ujson, and falls back to the standard library).
+
+WebSocket clients may instead negotiate the ``td.msgpack.v1`` subprotocol,
+in which frames are MessagePack maps using the short field ids in
+``FIELD_IDS``. The table is sent as the first frame after the handshake.
+The bundled pages speak JSON only, so the subprotocol is for third-party
+clients and is off unless ``GAME_WS_BINARY_ENABLED`` is set; while it is
+off, broadcasts are not packed at all.
+"""
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover - optional dependency
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+JSON_SUBPROTOCOL = 'td.json.v1'
+MSGPACK_SUBPROTOCOL = 'td.msgpack.v1'
+
+# Short field ids for the MessagePack subprotocol. Keys not listed here are
+# sent unchanged.
+FIELD_IDS = {
+    'type': 't',
+    'room': 'r',
+    'code': 'c',
+    'is_active': 'a',
+    'is_full': 'f',
+    'capacity': 'cp',
+    'players': 'p',
+    'id': 'i',
+    'name': 'n',
+    'join_order': 'o',
+    'game_state': 'g',
+    'round_number': 'rn',
+    'current_turn_player_id': 'ci',
+    'current_turn_player_name': 'cn',
+    'current_choice': 'ch',
+    'is_waiting_for_question': 'wq',
+    'is_waiting_for_answer': 'wa',
+    'current_question': 'cq',
+    'question': 'q',
+    'text': 'x',
+    'source': 's',
+    'next_turn': 'nt',
+    'message': 'm',
+    'player_id': 'pi',
+    'choice': 'cc',
+    'answer_text': 'at',
+    'seq': 'sq',
+    'epoch': 'ep',
+    'last_seq': 'ls',
+}
+_FIELD_NAMES = {short: name for name, short in FIELD_IDS.items()}
+
+_django_default = DjangoJSONEncoder().default
+_backend = None
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=_django_default)
+
+
+def _ujson_dumps(obj):
+    try:
+        return ujson.dumps(obj, ensure_ascii=False).encode()
+    except TypeError:
+        return _json_dumps(obj)
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, cls=DjangoJSONEncoder, separators=(',', ':')).encode()
+
+
+def get_backend():
+    """Return (name, dumps_bytes, loads) for the configured backend."""
+    global _backend
+    if _backend is None:
+        name = getattr(settings, 'GAME_JSON_BACKEND', 'auto')
+        if name == 'auto':
+            name = 'orjson' if orjson else 'ujson' if ujson else 'json'
+        if name == 'orjson' and orjson:
+            _backend = ('orjson', _orjson_dumps, orjson.loads)
+        elif name == 'ujson' and ujson:
+            _backend = ('ujson', _ujson_dumps, ujson.loads)
+        else:
+            _backend = ('json', _json_dumps, json.loads)
+    return _backend
+
+
+def dumps_bytes(obj):
+    """Encode ``obj`` as UTF-8 JSON bytes."""
+    return get_backend()[1](obj)
+
+
+def dumps(obj):
+    """Encode ``obj`` as a JSON string, ready for ``send(text_data=...)``."""
+    return get_backend()[1](obj).decode()
+
+
+def loads(data):
+    """Decode a JSON string or bytes."""
+    return get_backend()[2](data)
+
+
+def binary_enabled():
+    return msgpack is not None and getattr(settings, 'GAME_WS_BINARY_ENABLED', False)
+
+
+def negotiate_subprotocol(offered):
+    """Pick the subprotocol to accept from those offered by the client."""
+    if MSGPACK_SUBPROTOCOL in offered and binary_enabled():
+        return MSGPACK_SUBPROTOCOL
+    if JSON_SUBPROTOCOL in offered:
+        return JSON_SUBPROTOCOL
+    return None
+
+
+def _rename(obj, names):
+    if isinstance(obj, dict):
+        return {names.get(key, key): _rename(value, names) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_rename(item, names) for item in obj]
+    return obj
+
+
+def pack(frame):
+    """Encode ``frame`` for the MessagePack subprotocol."""
+    return msgpack.packb(_rename(frame, FIELD_IDS), use_bin_type=True, default=_django_default)
+
+
+def unpack(data):
+    """Decode a MessagePack subprotocol frame back to full field names."""
+    return _rename(msgpack.unpackb(data, raw=False), _FIELD_NAMES)
+
+
+def protocol_hello():
+    """First frame sent to MessagePack clients, carrying the field id table."""
+    return msgpack.packb({FIELD_IDS['type']: 'protocol', 'fields': FIELD_IDS}, use_bin_type=True)
+
+
+def group_message(handler_type, frame, **extra):
+    """
+    Build a channel layer message carrying ``frame`` already encoded, so
+    every receiving consumer forwards the same text (or MessagePack bytes)
+    instead of re-encoding it.
+    """
+    message = {'type': handler_type, 'text': dumps(frame), **extra}
+    if binary_enabled():
+        message['packed'] = pack(frame)
+    return message
+
+
+class JsonResponse(HttpResponse):
+    """``django.http.JsonResponse`` using the configured fast encoder."""
+
+    def __init__(self, data, safe=True, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError(
+                'In order to allow non-dict objects to be serialized set the '
+                'safe parameter to False.'
+            )
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps_bytes(data), **kwargs)
@@ -0,0 +1,346 @@
+"""
+Optional in-memory game engine.
+
+With ``GAME_ENGINE_MODE = 'memory'`` the turn state of each active room
+lives in the worker that serves it. Moves are applied to a ``RoomEngine``
+under a per-room lock, without touching the database, and the consumer
+pushes the result straight away. New questions, answers and game state
+changes are queued on the shared write-behind buffer (``writebehind``),
+which persists them for every room in periodic batches. A new question is
+given an id reserved ahead (``ids``), so clients are sent it before the
+row is written; only on a database that can't reserve ids does it flush
+the buffer straight away instead.
+
+The database stays the source of truth across restarts: an engine is
+loaded from the latest persisted state the first time its room is used,
+so a crash loses at most the last flush interval of moves. Memory mode
+assumes a room is served by a single worker (one process, or sticky
+routing by room code), the same assumption the in-memory channel layer
+already makes.
+"""
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+from .ids import IdBlock
+from .models import MIN_PLAYERS, Room, Player, GameState, Question, QuestionText, Answer
+from .prefetch import prefetcher
+from .sqlite import serialized_write
+from .writebehind import writer
+
+question_ids = IdBlock(Question)
+
+GAME_STATE_FIELDS = [
+    'current_turn_player_id', 'turn_index', 'round_number', 'current_choice',
+    'is_waiting_for_question', 'is_waiting_for_answer', 'updated_at',
+]
+
+
+def engine_enabled():
+    return getattr(settings, 'GAME_ENGINE_MODE', 'db') == 'memory'
+
+
+class RoomEngine:
+    """Authoritative turn state for one room."""
+    __slots__ = (
+        'lock', 'room_id', 'code', 'is_active', 'capacity', 'players', 'names',
+        'game_state_id', 'turn_order', 'turn_index', 'round_number', 'current_choice', 'is_waiting_for_question',
+        'is_waiting_for_answer', 'question',
+    )
+
+    def __init__(self, room_id, code, is_active, capacity, players):
+        self.lock = threading.Lock()
+        self.room_id = room_id
+        self.code = code
+        self.is_active = is_active
+        self.capacity = capacity
+        self.set_players(players)
+        self.game_state_id = None
+        # Player ids in turn order and the position of the current turn
+        self.turn_order = []
+        self.turn_index = 0
+        self.round_number = 1
+        self.current_choice = None
+        self.is_waiting_for_question = False
+        self.is_waiting_for_answer = False
+        # Latest Question instance, possibly not yet persisted
+        self.question = None
+
+    @classmethod
+    def load(cls, room_id):
+        """Rebuild a room's engine from its persisted state."""
+        room = Room.objects.filter(pk=room_id).values('code', 'is_active', 'capacity').first()
+        if not room:
+            return None
+        engine = cls(room_id, room['code'], room['is_active'], room['capacity'], load_players(room_id))
+        game_state = GameState.objects.filter(room_id=room_id).first()
+        if game_state:
+            engine.set_turn_order(game_state)
+            engine.round_number = game_state.round_number
+            engine.current_choice = game_state.current_choice
+            engine.is_waiting_for_question = game_state.is_waiting_for_question
+            engine.is_waiting_for_answer = game_state.is_waiting_for_answer
+            engine.question = (
+                Question.objects.filter(game_state=game_state).select_related('question_text').order_by('-id').first()
+            )
+        return engine
+
+    def set_players(self, players):
+        # (id, name, join_order) in join order
+        self.players = players
+        self.names = {player_id: name for player_id, name, join_order in players}
+
+    def set_turn_order(self, game_state):
+        self.game_state_id = game_state.id
+        self.turn_order = list(game_state.turn_order) or [player[0] for player in self.players]
+        self.turn_index = min(game_state.turn_index, max(len(self.turn_order) - 1, 0))
+
+    @property
+    def current_player(self):
+        """(id, name) of the player whose turn it is, or None before the game starts."""
+        if not self.game_state_id or not self.turn_order:
+            return None
+        player_id = self.turn_order[self.turn_index]
+        return player_id, self.names.get(player_id)
+
+    def is_turn(self, player_id):
+        return bool(self.game_state_id and self.turn_order) and self.turn_order[self.turn_index] == player_id
+
+    def current_question(self):
+        """Return the current unanswered question as a payload, or None."""
+        if self.question is None or self.question.is_answered:
+            return None
+        return question_payload(self.question)
+
+    def _touch(self):
+        """Queue the current turn state to be persisted."""
+        player = self.current_player
+        writer.update(GameState(
+            id=self.game_state_id,
+            room_id=self.room_id,
+            current_turn_player_id=player[0] if player else None,
+            turn_index=self.turn_index,
+            round_number=self.round_number,
+            current_choice=self.current_choice,
+            is_waiting_for_question=self.is_waiting_for_question,
+            is_waiting_for_answer=self.is_waiting_for_answer,
+            updated_at=timezone.now()
+        ), GAME_STATE_FIELDS)
+
+    def start(self, when_full=False):
+        """
+        Start the game once ``MIN_PLAYERS`` have joined, or only once the
+        room is full if ``when_full``. The game state row is created
+        synchronously since later rows reference it. Returns
+        (game_state_id, created).
+        """
+        with self.lock:
+            if self.game_state_id:
+                return self.game_state_id, False
+            self.set_players(load_players(self.room_id))
+            needed = max(MIN_PLAYERS, self.capacity) if when_full else MIN_PLAYERS
+            if len(self.players) < needed:
+                return None, False
+            game_state = GameState.objects.filter(room_id=self.room_id).first()
+            created = game_state is None
+            if created:
+                game_state = serialized_write(GameState.objects.create)(
+                    room_id=self.room_id,
+                    current_turn_player_id=self.players[0][0],
+                    round_number=1,
+                    turn_order=[player[0] for player in self.players],
+                    turn_index=0
+                )
+            self.set_turn_order(game_state)
+            self.round_number = game_state.round_number
+            if created:
+                prefetcher.start_turn(self.room_id, game_state.current_turn_player_id)
+            return self.game_state_id, created
+
+    def choose(self, player_id, choice, question_text, source='API'):
+        """
+        Record a truth/dare choice and its question, saved with the
+        ``source`` of the provider that served it; return the question payload.
+        """
+        question = self._new_question(question_text, choice, source)
+        with self.lock:
+            if not self.is_turn(player_id):
+                return None
+            self.current_choice = choice
+            self.is_waiting_for_question = True
+            self._add_question(question)
+            self._touch()
+        if question.pk is None:
+            writer.flush()
+        return question_payload(question)
+
+    def inject_question(self, question_text, question_type):
+        """Replace any open question with an admin question; return its payload."""
+        question = self.queue_question(question_text, question_type)
+        if question is None:
+            return None
+        if question.pk is None:
+            writer.flush()
+        return question_payload(question)
+
+    def queue_question(self, question_text, question_type):
+        """
+        Replace any open question with an admin question, queued but not
+        flushed; return the question, which has its id already if one could
+        be reserved, else once flushed.
+        """
+        question = self._new_question(question_text, question_type, 'ADMIN')
+        with self.lock:
+            if not self.game_state_id:
+                return None
+            self._answer_current()
+            self._add_question(question)
+            self._touch()
+            return question
+
+    def submit_answer(self, player_id, answer_text):
+        """Answer the current question; return {'next_turn', 'round_number'}."""
+        with self.lock:
+            if not self.is_turn(player_id) or self.current_question() is None:
+                return None
+            player = self.current_player
+            writer.create(Answer(
+                question=self.question,
+                player_id=player_id,
+                answer_text=answer_text
+            ))
+            self._answer_current()
+            self.is_waiting_for_answer = False
+            self._touch()
+            return {'next_turn': player[1], 'round_number': self.round_number}
+
+    def next_round(self):
+        """Pass the turn on; return {'next_turn', 'next_turn_id', 'round_number'}."""
+        with self.lock:
+            if not self.game_state_id:
+                return None
+            if len(self.turn_order) >= 2:
+                self.turn_index = (self.turn_index + 1) % len(self.turn_order)
+                if self.turn_index == 0:
+                    self.round_number += 1
+            self.is_waiting_for_question = False
+            self.current_choice = None
+            self._touch()
+            player = self.current_player
+            if player:
+                prefetcher.start_turn(self.room_id, player[0])
+            return {
+                'next_turn': player[1] if player else None,
+                'next_turn_id': player[0] if player else None,
+                'round_number': self.round_number
+            }
+
+    def _new_question(self, text, question_type, source):
+        """Build a question for this room; called before taking the lock, as it may query."""
+        return Question(
+            id=question_ids.next(),
+            room_id=self.room_id,
+            question_text=QuestionText.intern(text),
+            question_type=question_type,
+            source=source
+        )
+
+    def _add_question(self, question):
+        question.game_state_id = self.game_state_id
+        self.question = question
+        writer.create(question)
+
+    def _answer_current(self):
+        if self.question is not None and not self.question.is_answered:
+            self.question.is_answered = True
+            writer.update(self.question, ['is_answered'])
+
+    def snapshot(self):
+        """Room state in the same shape as ``RoomStateService.build_snapshot``."""
+        with self.lock:
+            if not self.is_active:
+                return None
+            game_state = None
+            if self.game_state_id:
+                player = self.current_player
+                game_state = {
+                    'round_number': self.round_number,
+                    'current_turn_player_id': player[0] if player else None,
+                    'current_turn_player_name': player[1] if player else None,
+                    'current_choice': self.current_choice,
+                    'is_waiting_for_question': self.is_waiting_for_question,
+                    'is_waiting_for_answer': self.is_waiting_for_answer
+                }
+            return {
+                'type': 'room_state',
+                'room': {
+                    'code': self.code,
+                    'is_active': self.is_active,
+                    'is_full': len(self.players) >= self.capacity,
+                    'capacity': self.capacity
+                },
+                'players': [
+                    {'id': player_id, 'name': name, 'join_order': join_order}
+                    for player_id, name, join_order in self.players
+                ],
+                'game_state': game_state,
+                'current_question': self.current_question()
+            }
+
+
+def load_players(room_id):
+    return list(
+        Player.objects.filter(room_id=room_id)
+        .order_by('join_order')
+        .values_list('id', 'name', 'join_order')
+    )
+
+
+def question_payload(question):
+    return {
+        'id': question.pk,
+        'text': question.text,
+        'type': question.question_type,
+        'source': question.source
+    }
+
+
+class EngineStore:
+    """Engines for the rooms served by this worker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engines = {}
+
+    def get(self, room_id):
+        """Return the engine for a room, loading it from the database if needed."""
+        engine = self._engines.get(room_id)
+        if engine is None:
+            # Anything still queued for the room must land before it is read back
+            writer.flush()
+            loaded = RoomEngine.load(room_id)
+            if loaded is None:
+                return None
+            with self._lock:
+                engine = self._engines.setdefault(room_id, loaded)
+            metrics.incr('engine.loaded')
+        return engine
+
+    def peek(self, room_id):
+        """Return the engine for a room only if it is already loaded."""
+        return self._engines.get(room_id)
+
+    def evict(self, *room_ids):
+        """Drop rooms' engines, e.g. when players change."""
+        with self._lock:
+            for room_id in room_ids:
+                self._engines.pop(room_id, None)
+
+
+store = EngineStore()
+
+
+def get_engine(room_id):
+    return store.get(room_id)
@@ -0,0 +1,81 @@
+"""
+Primary keys handed out ahead of the insert.
+
+The in-memory engine sends a new question, id included, as soon as the
+move is applied, while the row itself is written by a later write-behind
+flush. ``IdBlock`` reserves ids from the table's own sequence,
+``GAME_ID_BLOCK_SIZE`` at a time, so they never clash with ids taken by
+other workers or by rows inserted the usual way, and only one move per
+block waits on the database.
+
+PostgreSQL draws the ids with ``nextval``. SQLite advances the table's
+``sqlite_sequence`` entry, which Django's AUTOINCREMENT primary keys never
+go below. Other backends reserve nothing; callers then flush to get an id.
+"""
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import connections, router, transaction
+
+from . import metrics
+from .sqlite import serialized_write
+
+
+def block_size():
+    return getattr(settings, 'GAME_ID_BLOCK_SIZE', 100)
+
+
+def reserve_ids(model, count):
+    """Reserve ``count`` primary keys of ``model``; return them, or [] if the backend can't."""
+    alias = router.db_for_write(model)
+    connection = connections[alias]
+    table = model._meta.db_table
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                [table, model._meta.pk.column, count]
+            )
+            return [row[0] for row in cursor.fetchall()]
+    if connection.vendor == 'sqlite':
+        return _reserve_sqlite_ids(alias, table, model._meta.pk.column, count)
+    return []
+
+
+@serialized_write
+def _reserve_sqlite_ids(alias, table, column, count):
+    with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+        cursor.execute('UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s', [count, table])
+        if not cursor.rowcount:
+            # Nothing inserted yet; the sequence starts at the largest id
+            cursor.execute(f'SELECT COALESCE(MAX("{column}"), 0) FROM "{table}"')
+            cursor.execute(
+                'INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)',
+                [table, cursor.fetchone()[0] + count]
+            )
+        cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+        last = cursor.fetchone()[0]
+    return list(range(last - count + 1, last + 1))
+
+
+class IdBlock:
+    """Primary keys of one model reserved ahead, refilled a block at a time."""
+
+    def __init__(self, model):
+        self.model = model
+        self._lock = threading.Lock()
+        self._ids = deque()
+
+    def next(self):
+        """Return an unused primary key, or None if none can be reserved."""
+        with self._lock:
+            if not self._ids:
+                self._ids.extend(reserve_ids(self.model, block_size()))
+                metrics.incr('ids.reserved_blocks')
+            return self._ids.popleft() if self._ids else None
+
+    def clear(self):
+        """Forget the ids reserved so far, e.g. once the table was flushed."""
+        with self._lock:
+            self._ids.clear()
@@ -0,0 +1,70 @@
+"""
+Microbenchmark of per-broadcast CPU cost against group size.
+
+Compares every member encoding the broadcast dict itself with the sender
+encoding it once and members forwarding the ready text.
+"""
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from game import encoding
+
+
+SAMPLE_QUESTION = {
+    'id': 1234,
+    'text': 'What is the most embarrassing thing you have ever done in front of a crowd?',
+    'type': 'truth',
+    'source': 'API',
+}
+
+
+class Command(BaseCommand):
+    help = 'Measure per-broadcast CPU cost of per-member vs pre-encoded frames'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='2,10,100,1000', help='Comma-separated group sizes')
+        parser.add_argument('--rounds', type=int, default=50, help='Broadcasts per measurement')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        rounds = options['rounds']
+        self.stdout.write(f"Encoder backend: {encoding.get_backend()[0]}")
+        self.stdout.write(f"{'members':>8} {'per-member us':>14} {'pre-encoded us':>15} {'speedup':>8}")
+        for size in sizes:
+            per_member, pre_encoded = asyncio.run(self.measure(size, rounds))
+            self.stdout.write(
+                f"{size:>8} {per_member * 1e6:>14.1f} {pre_encoded * 1e6:>15.1f} "
+                f"{per_member / pre_encoded if pre_encoded else 0:>7.1f}x"
+            )
+
+    async def measure(self, size, rounds):
+        layer = InMemoryChannelLayer(capacity=rounds + 1)
+        channels = [await layer.new_channel() for _ in range(size)]
+        for channel in channels:
+            await layer.group_add('bench', channel)
+
+        async def per_member():
+            await layer.group_send('bench', {'type': 'question_sent', 'question': SAMPLE_QUESTION})
+            for channel in channels:
+                event = await layer.receive(channel)
+                json.dumps({'type': 'question_sent', 'question': event['question']})
+
+        async def pre_encoded():
+            await layer.group_send('bench', encoding.group_message(
+                'question_sent', {'type': 'question_sent', 'question': SAMPLE_QUESTION}
+            ))
+            for channel in channels:
+                event = await layer.receive(channel)
+                event['text']
+
+        results = []
+        for broadcast in (per_member, pre_encoded):
+            started = time.process_time()
+            for _ in range(rounds):
+                await broadcast()
+            results.append((time.process_time() - started) / rounds)
+        return results
@@ -0,0 +1,75 @@
+"""
+Benchmark of database connections used by consumer-style ORM calls.
+
+Runs many concurrent ``database_sync_to_async`` calls, each a small room
+lookup, across a thread pool the size of a busy worker's executor, and
+reports throughput, how many database connections were opened and, when
+``GAME_DB_POOL_ENABLED`` is set, the pool's checkout and wait counts. Run
+it with the pool on and off to compare.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from game import metrics
+from game.dbpool import pool_stats
+from game.models import Room
+
+
+class Command(BaseCommand):
+    help = 'Measure connections opened by concurrent consumer database calls'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32, help='Executor threads')
+        parser.add_argument('--calls', type=int, default=5000, help='Database calls in total')
+        parser.add_argument('--concurrency', type=int, default=200, help='Calls in flight at once')
+
+    def handle(self, *args, **options):
+        connections.close_all()
+        metrics.reset()
+        created = []
+        connection_created.connect(lambda sender, connection, **kwargs: created.append(connection.alias), weak=False)
+
+        elapsed = asyncio.run(self.measure(options['threads'], options['calls'], options['concurrency']))
+
+        mode = 'pooled' if settings.GAME_DB_POOL_ENABLED else 'per-thread'
+        self.stdout.write(
+            f"{mode}: {options['calls']} calls on {options['threads']} threads in {elapsed * 1000:.0f}ms "
+            f"({options['calls'] / elapsed:.0f} calls/s)"
+        )
+        counters = metrics.snapshot()['counters']
+        connects = counters.get('db_pool.default.connects', len(created))
+        self.stdout.write(f"database connections opened: {connects}")
+        if settings.GAME_DB_POOL_ENABLED:
+            timings = metrics.snapshot()['timings_ms'].get('db_pool.default.wait', {})
+            self.stdout.write(
+                f"checkouts: {counters.get('db_pool.default.checkouts', 0)}, "
+                f"waits: {counters.get('db_pool.default.waits', 0)} (avg {timings.get('avg', 0)}ms), "
+                f"timeouts: {counters.get('db_pool.default.timeouts', 0)}, "
+                f"pool: {pool_stats().get('default')}"
+            )
+
+    async def measure(self, threads, calls, concurrency):
+        executor = ThreadPoolExecutor(threads)
+        asyncio.get_running_loop().set_default_executor(executor)
+        lookup = database_sync_to_async(self.lookup, thread_sensitive=False)
+        gate = asyncio.Semaphore(concurrency)
+
+        async def call():
+            async with gate:
+                await lookup()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(call() for _ in range(calls)))
+        elapsed = time.perf_counter() - started
+        executor.shutdown()
+        return elapsed
+
+    def lookup(self):
+        return Room.objects.filter(is_active=True).values_list('id', flat=True).first()
@@ -0,0 +1,85 @@
+"""
+Benchmark of game moves per second through the ORM against the in-memory
+engine.
+
+Each round is both players taking a turn of three moves (choose, answer,
+next round), with a fixed question text so the external API is left out
+of the measurement. The engine run includes the final flush of everything
+it queued. Benchmark rooms are created in the configured database and
+deleted afterwards.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from game.engine import RoomEngine
+from game.models import Room, Player, Question, QuestionText
+from game.services import TurnManagementService
+from game.writebehind import writer
+
+QUESTION_TEXT = 'What is the most embarrassing thing you have ever done in front of a crowd?'
+
+
+class Command(BaseCommand):
+    help = 'Compare moves/second of the ORM path and the in-memory engine'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=20, help='Rooms played concurrently')
+        parser.add_argument('--rounds', type=int, default=20, help='Rounds played per room')
+
+    def handle(self, *args, **options):
+        rooms, rounds = options['rooms'], options['rounds']
+        moves = rooms * rounds * 6
+        self.stdout.write(f"{rooms} rooms x {rounds} rounds = {moves} moves per run")
+        results = {}
+        for name, run in (('db', self.run_db), ('memory', self.run_memory)):
+            created = self.create_rooms(rooms)
+            try:
+                started = time.perf_counter()
+                run(created, rounds)
+                elapsed = time.perf_counter() - started
+            finally:
+                Room.objects.filter(id__in=[room.id for room, players in created]).delete()
+            results[name] = moves / elapsed
+            self.stdout.write(f"{name:>8}: {results[name]:>10.0f} moves/s ({elapsed * 1000:.0f}ms)")
+        self.stdout.write(f"speedup: {results['memory'] / results['db']:.1f}x")
+
+    def create_rooms(self, count):
+        created = []
+        for _ in range(count):
+            room = Room.objects.create(created_by='bench_engine')
+            players = [
+                Player.objects.create(name=f'bench{order}', room=room, join_order=order)
+                for order in (1, 2)
+            ]
+            TurnManagementService.initialize_game(room)
+            created.append((room, players))
+        return created
+
+    def run_db(self, rooms, rounds):
+        for _ in range(rounds):
+            for room, players in rooms:
+                for player in players:
+                    game_state = room.get_current_game_state()
+                    game_state.current_choice = 'truth'
+                    game_state.is_waiting_for_question = True
+                    game_state.save()
+                    Question.objects.create(
+                        room=room,
+                        game_state=game_state,
+                        question_text=QuestionText.intern(QUESTION_TEXT),
+                        question_type='truth',
+                        source='API'
+                    )
+                    TurnManagementService.submit_answer(room, player, 'bench answer')
+                    TurnManagementService.next_round(room)
+
+    def run_memory(self, rooms, rounds):
+        engines = [(RoomEngine.load(room.id), players) for room, players in rooms]
+        for _ in range(rounds):
+            for engine, players in engines:
+                for player in players:
+                    engine.choose(player.id, 'truth', QUESTION_TEXT)
+                    engine.submit_answer(player.id, 'bench answer')
+                    engine.next_round()
+        writer.flush()
@@ -0,0 +1,72 @@
+"""
+Benchmark of admin question injection across many rooms.
+
+Compares injecting room by room, as the single-room endpoint does, with
+the bulk injection used by the "inject to all rooms" action. Both include
+the broadcast to each room. Benchmark rooms are created in the configured
+database and deleted afterwards.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from game.models import Room, Player, GameState, generate_room_code
+from game.services import TurnManagementService
+from game.utils import broadcast_admin_question, broadcast_admin_questions
+
+
+class Command(BaseCommand):
+    help = 'Compare rooms/second of per-room and bulk admin question injection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=2000, help='Rooms to inject into')
+
+    def handle(self, *args, **options):
+        count = options['rooms']
+        results = {}
+        for name, run in (('per-room', self.run_per_room), ('bulk', self.run_bulk)):
+            rooms = self.create_rooms(count)
+            try:
+                started = time.perf_counter()
+                injected = run(rooms)
+                elapsed = time.perf_counter() - started
+            finally:
+                rooms.delete()
+            results[name] = injected / elapsed
+            self.stdout.write(f"{name:>9}: {injected} rooms in {elapsed * 1000:.0f}ms ({results[name]:.0f} rooms/s)")
+        self.stdout.write(f"speedup: {results['bulk'] / results['per-room']:.1f}x")
+
+    def create_rooms(self, count):
+        codes = set()
+        while len(codes) < count:
+            code = generate_room_code()
+            if code not in codes and not Room.objects.filter(code=code).exists():
+                codes.add(code)
+        rooms = Room.objects.bulk_create([Room(code=code, created_by='bench_inject') for code in codes])
+        players = Player.objects.bulk_create([
+            Player(name=f'bench{order}', room=room, join_order=order)
+            for room in rooms for order in (1, 2)
+        ])
+        GameState.objects.bulk_create([
+            GameState(room=room, current_turn_player=player, turn_order=[player.id, player.id + 1])
+            for room, player in zip(rooms, players[::2])
+        ])
+        return Room.objects.filter(created_by='bench_inject')
+
+    def run_per_room(self, rooms):
+        injected = 0
+        for room in rooms:
+            question = TurnManagementService.create_admin_question(room, 'Bench question?', 'truth')
+            broadcast_admin_question(room.code, {
+                'id': question.id,
+                'text': question.text,
+                'type': question.question_type,
+                'source': question.source
+            })
+            injected += 1
+        return injected
+
+    def run_bulk(self, rooms):
+        injected = TurnManagementService.bulk_create_admin_questions(rooms, 'Bench question?', 'truth')
+        broadcast_admin_questions(injected)
+        return len(injected)
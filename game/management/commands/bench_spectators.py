@@ -0,0 +1,84 @@
+"""
+Benchmark of spectator fan-out on a single room.
+
+Connects many spectator sockets to one room through the real consumer
+and channel layer, then times how long each broadcast takes to reach all
+of them. Reports how many snapshots were built for the whole audience,
+which should stay at one. The benchmark room is created in the
+configured database and deleted afterwards.
+"""
+import asyncio
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from game import metrics
+from game.models import Room, Player
+from game.push import publish
+from game.routing import websocket_urlpatterns
+from game.services import TurnManagementService
+
+
+class Command(BaseCommand):
+    help = 'Measure broadcast fan-out to many spectators of one room'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spectators', type=int, default=2000, help='Spectator sockets to connect')
+        parser.add_argument('--broadcasts', type=int, default=20, help='Broadcasts to time')
+
+    def handle(self, *args, **options):
+        room = Room.objects.create(created_by='bench_spectators')
+        for order in (1, 2):
+            Player.objects.create(name=f'bench{order}', room=room, join_order=order)
+        TurnManagementService.initialize_game(room)
+        try:
+            admission = {
+                'max_connections': options['spectators'] + 1,
+                'max_rooms': 10,
+                'max_http_in_flight': 200,
+                'max_sync_in_flight': options['spectators'] + 1,
+                'retry_after': 5,
+            }
+            with override_settings(GAME_ADMISSION=admission):
+                asyncio.run(self.measure(room.code, options['spectators'], options['broadcasts']))
+        finally:
+            room.delete()
+
+    async def measure(self, room_code, count, broadcasts):
+        metrics.reset()
+        application = URLRouter(websocket_urlpatterns)
+        spectators = [
+            WebsocketCommunicator(application, f'/ws/room/{room_code}/watch/')
+            for _ in range(count)
+        ]
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(spectator.connect(timeout=60) for spectator in spectators))
+        await asyncio.gather(*(spectator.receive_from(timeout=60) for spectator in spectators))
+        connect_elapsed = time.perf_counter() - started
+        connected = sum(1 for accepted, subprotocol in results if accepted)
+        counters = metrics.snapshot()['counters']
+        self.stdout.write(
+            f"{connected}/{count} spectators connected and sent state in {connect_elapsed * 1000:.0f}ms "
+            f"({connected / connect_elapsed:.0f}/s)"
+        )
+        self.stdout.write(f"snapshots built: {counters.get('room_push.latest_built', 0)}")
+
+        latencies = []
+        frame = {'type': 'answer_submitted', 'next_turn': 'bench1'}
+        for _ in range(broadcasts):
+            started = time.perf_counter()
+            await publish(room_code, 'answer_submitted', frame)
+            await asyncio.gather(*(spectator.receive_from(timeout=60) for spectator in spectators))
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        self.stdout.write(
+            f"fan-out to all spectators: median {latencies[len(latencies) // 2] * 1000:.1f}ms, "
+            f"max {latencies[-1] * 1000:.1f}ms, "
+            f"{latencies[len(latencies) // 2] / connected * 1e6:.1f}us per spectator"
+        )
+
+        await asyncio.gather(*(spectator.disconnect() for spectator in spectators))
@@ -0,0 +1,101 @@
+"""
+Concurrency benchmark of game moves on SQLite.
+
+Plays many rooms at once, one thread per room, each making the same
+service calls as the HTTP endpoints: choose, answer and next round, in a
+loop. Reports sustained moves per second and how many moves failed with
+"database is locked". Run it with ``GAME_SQLITE_SINGLE_WRITER`` on and off
+to compare. Benchmark rooms are created in the configured database and
+deleted afterwards.
+"""
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections
+
+from game import metrics
+from game.models import Room
+from game.services import TurnManagementService
+from game.sqlite import single_writer_enabled
+
+
+class Command(BaseCommand):
+    help = 'Measure sustained moves/second with many rooms writing to SQLite at once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=100, help='Rooms played at once')
+        parser.add_argument('--rounds', type=int, default=20, help='Rounds played in each room')
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('The default database is not SQLite')
+
+        rooms = []
+        for index in range(options['rooms']):
+            room, player = TurnManagementService.create_room(f'bench{index}', 2)
+            TurnManagementService.add_player(room, f'bench{index}b')
+            TurnManagementService.initialize_game(room)
+            rooms.append(room)
+        connections.close_all()
+        metrics.reset()
+
+        results = []
+        barrier = threading.Barrier(len(rooms) + 1)
+        threads = [
+            threading.Thread(target=self.play, args=(room, options['rounds'], barrier, results))
+            for room in rooms
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            started = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            Room.objects.filter(id__in=[room.id for room in rooms]).delete()
+
+        moves = sum(done for done, locked, failed in results)
+        locked = sum(locked for done, locked, failed in results)
+        failed = sum(failed for done, locked, failed in results)
+        mode = 'single writer' if single_writer_enabled() else 'direct writes'
+        self.stdout.write(
+            f"{mode}: {moves} moves in {len(rooms)} rooms in {elapsed * 1000:.0f}ms "
+            f"({moves / elapsed:.0f} moves/s), {locked} failed with 'database is locked', "
+            f"{failed} failed otherwise"
+        )
+        counters = metrics.snapshot()['counters']
+        if counters.get('sqlite-writer.batches'):
+            latency = metrics.snapshot()['timings_ms']['sqlite-writer.latency']
+            self.stdout.write(
+                f"writer: {counters['sqlite-writer.writes']} writes in {counters['sqlite-writer.batches']} commits "
+                f"({counters['sqlite-writer.writes'] / counters['sqlite-writer.batches']:.1f} per commit), "
+                f"latency avg {latency['avg']}ms, max {latency['max']}ms"
+            )
+
+    def play(self, room, rounds, barrier, results):
+        done = locked = failed = 0
+        barrier.wait()
+        try:
+            for _ in range(rounds):
+                player = room.get_current_game_state().current_turn_player
+                moves = (
+                    lambda: TurnManagementService.choose(room, player.id, 'truth', 'Bench question?'),
+                    lambda: TurnManagementService.submit_answer(room, player, 'Bench answer'),
+                    lambda: TurnManagementService.next_round(room),
+                )
+                for move in moves:
+                    try:
+                        move()
+                        done += 1
+                    except DatabaseError as exc:
+                        if 'locked' in str(exc):
+                            locked += 1
+                        else:
+                            # Fallout of an earlier failed move, such as answering twice
+                            failed += 1
+        finally:
+            results.append((done, locked, failed))
+            connections.close_all()
@@ -0,0 +1,79 @@
+"""
+Per-module import cost of the ASGI application.
+
+Imports the module in a fresh interpreter under ``python -X importtime``
+and reports the total, the most expensive modules and the cost per
+top-level package, so time-to-first-request can be tracked across
+changes. Worker warm-up is disabled in the child so only imports are
+measured.
+"""
+import os
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Report per-module import cost of truth_dare.asgi'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--module', default='truth_dare.asgi', help='Module to import')
+        parser.add_argument('--limit', type=int, default=25, help='Modules and packages to list')
+        parser.add_argument(
+            '--sort', choices=('cumulative', 'self'), default='self',
+            help='Rank modules by their own import time or including their imports'
+        )
+
+    def handle(self, *args, **options):
+        module = options['module']
+        env = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE,
+            'GAME_WARMUP_ENABLED': 'False',
+        }
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            capture_output=True, text=True, env=env
+        )
+        wall = time.perf_counter() - started
+        if result.returncode:
+            raise CommandError(f'Importing {module} failed:\n{result.stderr[-2000:]}')
+
+        modules = parse_importtime(result.stderr)
+        total = sum(cumulative for name, depth, own, cumulative in modules if depth == 0)
+        self.stdout.write(
+            f"{module}: {total / 1000:.1f}ms in imports across {len(modules)} modules "
+            f"({wall * 1000:.0f}ms for the whole interpreter)"
+        )
+
+        index = 3 if options['sort'] == 'cumulative' else 2
+        self.stdout.write(f"\n{'self ms':>9} {'cumul ms':>9}  module")
+        for name, depth, own, cumulative in sorted(modules, key=lambda row: row[index], reverse=True)[:options['limit']]:
+            self.stdout.write(f"{own / 1000:>9.1f} {cumulative / 1000:>9.1f}  {name}")
+
+        packages = Counter()
+        for name, depth, own, cumulative in modules:
+            packages[name.split('.')[0]] += own
+        self.stdout.write(f"\n{'self ms':>9}  package")
+        for package, own in packages.most_common(options['limit']):
+            self.stdout.write(f"{own / 1000:>9.1f}  {package}")
+
+
+def parse_importtime(output):
+    """Return (module, depth, self_us, cumulative_us) for each ``-X importtime`` line."""
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|', 2)
+        if not own.strip().isdigit():
+            # Column header
+            continue
+        stripped = name.lstrip()
+        modules.append((stripped, (len(name) - len(stripped) - 1) // 2, int(own), int(cumulative)))
+    return modules
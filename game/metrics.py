@@ -0,0 +1,217 @@
+"""
+Lightweight in-process metrics and span timing for the game hot paths.
+
+Counters, gauges and timings live in plain dicts guarded by a lock so they
+can be updated from both the event loop and the sync thread pool. A span
+covers one consumer event and accumulates the time spent waiting for the
+sync executor, running queries, calling the external API and sending frames.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection
+
+from .profiling import active_session
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_gauge_peaks = {}
+_timings = {}
+
+_current_span = ContextVar('game_current_span', default=None)
+
+
+def incr(name, value=1):
+    """Increment a counter."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge_add(name, delta):
+    """Adjust a gauge and keep track of its high-water mark."""
+    with _lock:
+        value = _gauges.get(name, 0) + delta
+        _gauges[name] = value
+        if value > _gauge_peaks.get(name, 0):
+            _gauge_peaks[name] = value
+
+
+def set_gauge(name, value):
+    """Set a gauge to an absolute value."""
+    with _lock:
+        _gauges[name] = value
+        if value > _gauge_peaks.get(name, 0):
+            _gauge_peaks[name] = value
+
+
+def get_gauge(name):
+    """Return the current value of a gauge."""
+    return _gauges.get(name, 0)
+
+
+def observe(name, seconds):
+    """Record a duration sample."""
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            _timings[name] = [1, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            if seconds > timing[2]:
+                timing[2] = seconds
+
+
+def snapshot():
+    """Return a JSON-serialisable copy of all metrics."""
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'gauge_peaks': dict(_gauge_peaks),
+            'timings_ms': {
+                name: {
+                    'count': count,
+                    'avg': round(total / count * 1000, 3),
+                    'max': round(peak * 1000, 3),
+                }
+                for name, (count, total, peak) in _timings.items()
+            },
+        }
+
+
+def reset():
+    """Clear all recorded metrics."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _gauge_peaks.clear()
+        _timings.clear()
+
+
+def tracing_enabled():
+    return getattr(settings, 'GAME_TRACING_ENABLED', True)
+
+
+class Span:
+    """Timing breakdown for a single consumer event."""
+    __slots__ = ('name', 'started', 'parts', 'queries')
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.parts = {}
+        self.queries = 0
+
+    def add(self, part, seconds):
+        self.parts[part] = self.parts.get(part, 0.0) + seconds
+
+
+@contextmanager
+def span(name):
+    """Time an event and record its per-part breakdown on exit."""
+    if not tracing_enabled():
+        yield None
+        return
+
+    current = Span(name)
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        _current_span.reset(token)
+        total = time.perf_counter() - current.started
+        observe(f'{name}.total', total)
+        for part, seconds in current.parts.items():
+            observe(f'{name}.{part}', seconds)
+        incr(f'{name}.count')
+        incr(f'{name}.queries', current.queries)
+
+        slow_ms = getattr(settings, 'GAME_TRACING_SLOW_EVENT_MS', 250)
+        if total * 1000 >= slow_ms:
+            logger.warning(
+                'Slow event %s: %.1fms total (%s, %d queries)',
+                name,
+                total * 1000,
+                ', '.join(f'{part}={seconds * 1000:.1f}ms' for part, seconds in current.parts.items()),
+                current.queries,
+            )
+
+
+@contextmanager
+def timed(part):
+    """Attribute the wrapped block's duration to ``part`` of the current span."""
+    current = _current_span.get()
+    if current is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.add(part, time.perf_counter() - started)
+
+
+def _query_timer(current):
+    def wrapper(execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            current.add('db', time.perf_counter() - started)
+            current.queries += 1
+    return wrapper
+
+
+def traced_sync_to_async(func):
+    """
+    Drop-in replacement for ``database_sync_to_async`` that records how long
+    the call waited for the sync executor and how long its queries took,
+    and keeps queued/busy gauges for the executor.
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        submitted = time.perf_counter()
+        state = {'started': False}
+        gauge_add('sync_executor.queued', 1)
+
+        def call_timed(current, waited):
+            if current is None:
+                return func(*args, **kwargs)
+            current.add('queue', waited)
+            with connection.execute_wrapper(_query_timer(current)):
+                return func(*args, **kwargs)
+
+        def run():
+            started = time.perf_counter()
+            state['started'] = True
+            gauge_add('sync_executor.queued', -1)
+            gauge_add('sync_executor.busy', 1)
+            observe('sync_executor.wait', started - submitted)
+            current = _current_span.get()
+            profile = active_session()
+            try:
+                if profile is not None:
+                    with profile.capture():
+                        return call_timed(current, started - submitted)
+                return call_timed(current, started - submitted)
+            finally:
+                gauge_add('sync_executor.busy', -1)
+
+        try:
+            return await database_sync_to_async(run)()
+        finally:
+            if not state['started']:
+                gauge_add('sync_executor.queued', -1)
+
+    return wrapper
@@ -0,0 +1,58 @@
+"""
+Middleware for the game app.
+"""
+from .admission import controller, get_limit
+from .encoding import JsonResponse
+from .profiling import ProfileSession, is_profile_requested
+
+
+class AdmissionControlMiddleware:
+    """Shed HTTP load with 503 + Retry-After once the worker is at capacity."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # Keep the admin reachable while shedding player traffic
+        if request.path.startswith('/admin/'):
+            return self.get_response(request)
+
+        if not controller.admit_request():
+            retry_after = get_limit('retry_after')
+            response = JsonResponse(
+                {'error': 'Server is busy, please retry shortly', 'retry_after': retry_after},
+                status=503
+            )
+            response['Retry-After'] = str(retry_after)
+            return response
+
+        try:
+            return self.get_response(request)
+        finally:
+            controller.release_request()
+
+
+class ProfilingMiddleware:
+    """Profile a request when a staff user asks for it."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not is_profile_requested(request):
+            return self.get_response(request)
+
+        session = ProfileSession()
+        with session.activate(), session.capture():
+            response = self.get_response(request)
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        room_code = resolver_match.kwargs.get('room_code') if resolver_match else None
+        record = session.save(
+            'HTTP',
+            request.get_full_path(),
+            room_code=room_code.upper() if room_code else None,
+            requested_by=request.user.get_username(),
+        )
+        response['X-Profile-Id'] = str(record.id)
+        return response
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-19 04:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0004_standalonerequest_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('HTTP', 'HTTP request'), ('WS', 'WebSocket event')], default='HTTP', max_length=10)),
+                ('path', models.CharField(max_length=255)),
+                ('room_code', models.CharField(blank=True, db_index=True, max_length=8, null=True)),
+                ('requested_by', models.CharField(blank=True, max_length=150, null=True)),
+                ('duration_ms', models.FloatField(default=0)),
+                ('query_count', models.IntegerField(default=0)),
+                ('query_log', models.JSONField(blank=True, default=list)),
+                ('stats_text', models.TextField(blank=True)),
+                ('profile_data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-19 04:21
+
+from django.db import migrations, models
+
+
+def backfill_turn_order(apps, schema_editor):
+    GameState = apps.get_model('game', 'GameState')
+    Player = apps.get_model('game', 'Player')
+    for game_state in GameState.objects.iterator():
+        turn_order = list(
+            Player.objects.filter(room_id=game_state.room_id)
+            .order_by('join_order')
+            .values_list('id', flat=True)
+        )
+        game_state.turn_order = turn_order
+        if game_state.current_turn_player_id in turn_order:
+            game_state.turn_index = turn_order.index(game_state.current_turn_player_id)
+        game_state.save(update_fields=['turn_order', 'turn_index'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0005_profilerecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gamestate',
+            name='turn_index',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='gamestate',
+            name='turn_order',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='capacity',
+            field=models.PositiveSmallIntegerField(default=2),
+        ),
+        migrations.RunPython(backfill_turn_order, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,91 @@
+# Generated by Django 4.2.30 on 2026-10-19 18:02
+
+import hashlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+BATCH_SIZE = 2000
+
+
+def digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def link_rows(queryset, text_field, fk_field, text_ids):
+    """Point every row of ``queryset`` at the QuestionText of its text, a batch at a time."""
+    rows = queryset.exclude(**{f'{text_field}__isnull': True}).values_list('pk', text_field)
+    batch = {}
+    for count, (pk, text) in enumerate(rows.iterator(chunk_size=BATCH_SIZE), 1):
+        batch.setdefault(text_ids[digest(text)], []).append(pk)
+        if count % BATCH_SIZE == 0:
+            flush(queryset, fk_field, batch)
+    flush(queryset, fk_field, batch)
+
+
+def flush(queryset, fk_field, batch):
+    for text_id, pks in batch.items():
+        queryset.filter(pk__in=pks).update(**{fk_field: text_id})
+    batch.clear()
+
+
+def backfill_question_texts(apps, schema_editor):
+    QuestionText = apps.get_model('game', 'QuestionText')
+    Question = apps.get_model('game', 'Question')
+    StandaloneRequest = apps.get_model('game', 'StandaloneRequest')
+    db_alias = schema_editor.connection.alias
+
+    texts = {}
+    for text in Question.objects.using(db_alias).values_list('text', flat=True).distinct().iterator():
+        texts[digest(text)] = text
+    for text in (
+        StandaloneRequest.objects.using(db_alias).exclude(current_question__isnull=True)
+        .values_list('current_question', flat=True).distinct().iterator()
+    ):
+        texts[digest(text)] = text
+    QuestionText.objects.using(db_alias).bulk_create(
+        [QuestionText(digest=key, text=text) for key, text in texts.items()],
+        batch_size=500
+    )
+    text_ids = dict(QuestionText.objects.using(db_alias).values_list('digest', 'id'))
+
+    link_rows(Question.objects.using(db_alias), 'text', 'question_text_id', text_ids)
+    link_rows(StandaloneRequest.objects.using(db_alias), 'current_question', 'current_question_text_id', text_ids)
+
+
+def restore_question_texts(apps, schema_editor):
+    QuestionText = apps.get_model('game', 'QuestionText')
+    db_alias = schema_editor.connection.alias
+    for question_text in QuestionText.objects.using(db_alias).iterator():
+        question_text.questions.using(db_alias).update(text=question_text.text)
+        question_text.standalone_requests.using(db_alias).update(current_question=question_text.text)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0006_room_capacity_turn_order'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionText',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('text', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='question_text',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='questions', to='game.questiontext'),
+        ),
+        migrations.AddField(
+            model_name='standalonerequest',
+            name='current_question_text',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='standalone_requests', to='game.questiontext'),
+        ),
+        migrations.RunPython(backfill_question_texts, restore_question_texts),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-19 18:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0007_questiontext'),
+    ]
+
+    operations = [
+        # A default lets the column be added back, and refilled, on reversal
+        migrations.AlterField(
+            model_name='question',
+            name='text',
+            field=models.TextField(default=''),
+        ),
+        migrations.RemoveField(
+            model_name='question',
+            name='text',
+        ),
+        migrations.RemoveField(
+            model_name='standalonerequest',
+            name='current_question',
+        ),
+        migrations.AlterField(
+            model_name='question',
+            name='question_text',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='questions', to='game.questiontext'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0008_remove_question_text_copies'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='question',
+            name='source',
+            field=models.CharField(choices=[('API', 'API'), ('ADMIN', 'Admin'), ('LOCAL', 'Local corpus'), ('FALLBACK', 'Built-in fallback'), ('OTHER', 'Other provider')], default='API', max_length=10),
+        ),
+    ]
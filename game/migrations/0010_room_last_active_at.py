@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 20:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0009_question_source_providers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_active_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
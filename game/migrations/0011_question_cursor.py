@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-19 22:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0010_room_last_active_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('corpus', models.CharField(max_length=64)),
+                ('multiplier', models.BigIntegerField()),
+                ('increment', models.BigIntegerField()),
+                ('state', models.BigIntegerField()),
+                ('used', models.PositiveIntegerField()),
+                ('size', models.PositiveIntegerField()),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='question_cursors', to='game.room')),
+            ],
+            options={
+                'unique_together': {('room', 'corpus')},
+            },
+        ),
+    ]
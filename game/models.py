@@ -1,7 +1,16 @@
-from django.db import models
+from collections import OrderedDict
+from django.db import models, transaction
 from django.utils import timezone
+import hashlib
 import random
 import string
+import threading
+
+from .sqlite import serialized_write
+
+
+# Players needed before a game can be started by hand
+MIN_PLAYERS = 2
 
 
 def generate_room_code():
@@ -17,6 +26,9 @@ class Room(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
     created_by = models.CharField(max_length=100, null=True, blank=True)
+    capacity = models.PositiveSmallIntegerField(default=2)
+    # Last presence sweep, on any worker, that found a player connected
+    last_active_at = models.DateTimeField(null=True, blank=True)
     
     def save(self, *args, **kwargs):
         """Override save to generate unique room code if not provided."""
@@ -56,8 +68,12 @@ class Room(models.Model):
         return self.game_states.first()
 
     def is_full(self):
-        """Check if room has 2 players."""
-        return self.players.count() >= 2
+        """Check if room has reached its capacity."""
+        return self.players.count() >= self.capacity
+
+    def can_start(self):
+        """Check if enough players have joined to start the game."""
+        return self.players.count() >= MIN_PLAYERS
 
 
 class Player(models.Model):
@@ -83,6 +99,9 @@ class GameState(models.Model):
     current_choice = models.CharField(max_length=10, null=True, blank=True)  # 'truth' or 'dare'
     is_waiting_for_question = models.BooleanField(default=False)
     is_waiting_for_answer = models.BooleanField(default=False)
+    # Player ids in join order, and the position of the current turn in it
+    turn_order = models.JSONField(default=list, blank=True)
+    turn_index = models.PositiveSmallIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -96,23 +115,135 @@ class GameState(models.Model):
         """Get the player whose turn it is."""
         return self.current_turn_player
 
+    def next_player_id(self):
+        """Id of the player whose turn comes next."""
+        if not self.turn_order:
+            return None
+        return self.turn_order[(self.turn_index + 1) % len(self.turn_order)]
+
     def get_opponent(self):
-        """Get the opponent of the current player."""
-        players = list(self.room.get_players())
-        if len(players) == 2:
-            return players[1] if self.current_turn_player == players[0] else players[0]
-        return None
+        """Get the player whose turn comes next."""
+        next_player_id = self.next_player_id()
+        if next_player_id is None or next_player_id == self.current_turn_player_id:
+            return None
+        return Player.objects.filter(id=next_player_id).first()
 
     def switch_turn(self):
-        """Switch turn to the other player."""
-        players = list(self.room.get_players())
-        if len(players) == 2:
-            if self.current_turn_player == players[0]:
-                self.current_turn_player = players[1]
-            else:
-                self.current_turn_player = players[0]
+        """Pass the turn to the next player, starting a new round after the last."""
+        if len(self.turn_order) < 2:
+            return
+        self.turn_index = (self.turn_index + 1) % len(self.turn_order)
+        if self.turn_index == 0:
+            self.round_number += 1
+        self.current_turn_player_id = self.turn_order[self.turn_index]
+        self.save()
+
+    def add_player(self, player_id):
+        """Append a player joining a game in progress to the end of the turn order."""
+        if player_id not in self.turn_order:
+            self.turn_order.append(player_id)
+            self.save(update_fields=['turn_order', 'updated_at'])
+
+    def remove_player(self, player_id):
+        """Drop a departed player from the turn order, keeping the turn where it was."""
+        if player_id not in self.turn_order:
+            return
+        position = self.turn_order.index(player_id)
+        del self.turn_order[position]
+        if position < self.turn_index:
+            self.turn_index -= 1
+        elif position == self.turn_index:
+            # The departed player's turn passes to whoever followed them
+            if self.turn_index >= len(self.turn_order):
+                self.turn_index = 0
                 self.round_number += 1
-            self.save()
+            self.is_waiting_for_question = False
+            self.is_waiting_for_answer = False
+            self.current_choice = None
+        self.current_turn_player_id = self.turn_order[self.turn_index] if self.turn_order else None
+        self.save()
+
+
+def text_digest(text):
+    """Content hash a question text is stored under."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# digest -> id of committed QuestionText rows, most recently used last
+_interned = OrderedDict()
+_interned_lock = threading.Lock()
+INTERN_CACHE_SIZE = 10000
+
+
+class QuestionText(models.Model):
+    """
+    One distinct question text. Questions and standalone requests refer to
+    it instead of each holding a copy, since the same texts recur across
+    every room.
+    """
+    digest = models.CharField(max_length=64, unique=True)
+    text = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.text[:50]
+
+    @classmethod
+    def intern(cls, text):
+        """
+        Return the row for ``text``, creating it if needed. Texts seen before
+        are resolved from an in-process cache without a query; deleting a
+        row drops it from this process's cache (``forget_interned``).
+        """
+        digest = text_digest(text)
+        with _interned_lock:
+            pk = _interned.get(digest)
+            if pk is not None:
+                _interned.move_to_end(digest)
+        if pk is not None:
+            return cls(id=pk, digest=digest, text=text)
+        return serialized_write(cls._get_or_create)(digest, text)
+
+    @classmethod
+    def _get_or_create(cls, digest, text):
+        instance, created = cls.objects.get_or_create(digest=digest, defaults={'text': text})
+        # A row created inside a transaction only exists once it commits
+        transaction.on_commit(lambda: cls._remember(digest, instance.pk))
+        return instance
+
+    @staticmethod
+    def _remember(digest, pk):
+        with _interned_lock:
+            _interned[digest] = pk
+            _interned.move_to_end(digest)
+            while len(_interned) > INTERN_CACHE_SIZE:
+                _interned.popitem(last=False)
+
+
+def forget_interned(sender, instance, **kwargs):
+    """``post_delete`` receiver dropping a deleted text from the intern cache."""
+    with _interned_lock:
+        _interned.pop(instance.digest, None)
+
+
+class QuestionCursor(models.Model):
+    """
+    A room's place in its no-repeat permutation of one corpus; the fields
+    are the ``(a, c, x, used, n)`` cursor of ``norepeat``.
+    """
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='question_cursors')
+    corpus = models.CharField(max_length=64)
+    multiplier = models.BigIntegerField()
+    increment = models.BigIntegerField()
+    state = models.BigIntegerField()
+    used = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ['room', 'corpus']
+
+    def __str__(self):
+        return f"{self.corpus} cursor for room {self.room_id}"
 
 
 class Question(models.Model):
@@ -120,11 +251,14 @@ class Question(models.Model):
     SOURCE_CHOICES = [
         ('API', 'API'),
         ('ADMIN', 'Admin'),
+        ('LOCAL', 'Local corpus'),
+        ('FALLBACK', 'Built-in fallback'),
+        ('OTHER', 'Other provider'),
     ]
 
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='questions')
     game_state = models.ForeignKey(GameState, on_delete=models.CASCADE, related_name='questions')
-    text = models.TextField()
+    question_text = models.ForeignKey(QuestionText, on_delete=models.PROTECT, related_name='questions')
     question_type = models.CharField(max_length=10)  # 'truth' or 'dare'
     source = models.CharField(max_length=10, choices=SOURCE_CHOICES, default='API')
     created_at = models.DateTimeField(auto_now_add=True)
@@ -136,6 +270,10 @@ class Question(models.Model):
     def __str__(self):
         return f"{self.question_type.upper()} Question for {self.room.code}"
 
+    @property
+    def text(self):
+        return self.question_text.text
+
 
 class Answer(models.Model):
     """Represents a player's answer to a question."""
@@ -163,8 +301,10 @@ class StandaloneRequest(models.Model):
     session_id = models.CharField(max_length=100, unique=True)
     user_name = models.CharField(max_length=100)
     question_type = models.CharField(max_length=10, null=True, blank=True)  # 'truth' or 'dare'
-    current_question = models.TextField(null=True, blank=True)
-    question_source = models.CharField(max_length=10, null=True, blank=True)  # 'API' or 'ADMIN'
+    current_question_text = models.ForeignKey(
+        QuestionText, on_delete=models.PROTECT, null=True, blank=True, related_name='standalone_requests'
+    )
+    question_source = models.CharField(max_length=10, null=True, blank=True)  # Question.SOURCE_CHOICES
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -175,3 +315,32 @@ class StandaloneRequest(models.Model):
 
     def __str__(self):
         return f"Standalone request by {self.user_name} ({self.session_id})"
+
+    @property
+    def current_question(self):
+        return self.current_question_text.text if self.current_question_text_id else None
+
+
+class ProfileRecord(models.Model):
+    """A profile captured on demand for a staff request or consumer event."""
+    KIND_CHOICES = [
+        ('HTTP', 'HTTP request'),
+        ('WS', 'WebSocket event'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default='HTTP')
+    path = models.CharField(max_length=255)
+    room_code = models.CharField(max_length=8, null=True, blank=True, db_index=True)
+    requested_by = models.CharField(max_length=150, null=True, blank=True)
+    duration_ms = models.FloatField(default=0)
+    query_count = models.IntegerField(default=0)
+    query_log = models.JSONField(default=list, blank=True)
+    stats_text = models.TextField(blank=True)
+    profile_data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.kind} profile of {self.path} ({self.duration_ms:.0f}ms)"
@@ -0,0 +1,125 @@
+"""
+Per-room no-repeat selection.
+
+A room draws corpus questions through a cursor over a pseudo-random
+permutation of the corpus instead of independently at random, so it sees
+every question once before any repeats, without its question history
+being scanned or stored.
+
+The permutation is a full-period linear congruential generator
+``x -> (a * x + c) mod m``, with ``m`` the smallest power of two not
+below the corpus size ``n``, ``c`` odd and ``a % 4 == 1``, so it visits
+every value below ``m`` exactly once per period. Values of ``n`` or more
+are skipped, which costs fewer than two steps per pick on average. A
+room's cursor is just ``(a, c, x, used, n)``, stored as a
+``QuestionCursor`` row per room and corpus, so every worker sees it and it
+lasts as long as the room; a cache could evict it, and the room would
+start repeating. A draw reads the row and writes the advanced cursor
+back only if the row still holds what it read, retrying otherwise, so it
+never holds a lock while reading (SQLite can't upgrade a read lock held
+in a transaction once another connection writes). Draws go through the
+single writer when that mode is on.
+Once all ``n`` questions have been used, or the corpus has changed size,
+the room starts a fresh permutation.
+
+An index drawn but never shown (a prefetched question the player didn't
+pick) can be handed back with ``return_index`` while it is still the
+room's latest draw: the cursor is stepped back by inverting the
+generator, so the room draws it again next.
+"""
+import random
+
+from django.db import IntegrityError, transaction
+
+from . import metrics
+from .models import QuestionCursor
+from .sqlite import serialized_write
+
+
+def new_cursor(n):
+    """Return a fresh (a, c, x, used, n) cursor over a random permutation of range(n)."""
+    m = 1 << max(n - 1, 1).bit_length()
+    a = 4 * random.randrange(m // 4) + 1 if m >= 4 else 1
+    c = 2 * random.randrange(m // 2) + 1
+    return a, c, random.randrange(m), 0, n
+
+
+def advance(cursor):
+    """Return (index, next cursor), starting a new permutation once this one is used up."""
+    a, c, x, used, n = cursor
+    if used >= n:
+        metrics.incr('norepeat.reset')
+        a, c, x, used, n = new_cursor(n)
+    mask = (1 << max(n - 1, 1).bit_length()) - 1
+    x = (a * x + c) & mask
+    while x >= n:
+        x = (a * x + c) & mask
+    return x, (a, c, x, used + 1, n)
+
+
+FIELDS = ('multiplier', 'increment', 'state', 'used', 'size')
+
+
+def _fields(cursor):
+    return dict(zip(FIELDS, cursor))
+
+
+def _load(room_id, corpus):
+    return QuestionCursor.objects.filter(room_id=room_id, corpus=corpus).values_list(*FIELDS).first()
+
+
+def _replace(room_id, corpus, current, cursor):
+    """
+    Store ``cursor`` in place of ``current``, or as the room's first cursor
+    if ``current`` is None; False if another draw got there first.
+    """
+    if current is None:
+        try:
+            with transaction.atomic():
+                QuestionCursor.objects.create(room_id=room_id, corpus=corpus, **_fields(cursor))
+        except IntegrityError:
+            if _load(room_id, corpus) is None:
+                raise
+            return False
+        return True
+    return bool(
+        QuestionCursor.objects.filter(room_id=room_id, corpus=corpus, **_fields(current))
+        .update(**_fields(cursor))
+    )
+
+
+@serialized_write
+def next_index(room_id, corpus, n):
+    """
+    Return the room's next index into a corpus of ``n`` questions, named
+    ``corpus`` (e.g. its type and rating), never repeating one until all
+    ``n`` have been drawn.
+    """
+    while True:
+        current = _load(room_id, corpus)
+        index, cursor = advance(current if current and current[4] == n else new_cursor(n))
+        if _replace(room_id, corpus, current, cursor):
+            return index
+        metrics.incr('norepeat.conflicts')
+
+
+@serialized_write
+def return_index(room_id, corpus, n, index):
+    """
+    Hand back ``index``, drawn by ``next_index`` but never used, so the
+    room draws it next. Returns False, leaving it used, if the room has
+    drawn from the corpus since.
+    """
+    current = _load(room_id, corpus)
+    if current is None or current[4] != n or current[2] != index:
+        metrics.incr('norepeat.unreturned')
+        return False
+    a, c, x, used, n = current
+    mask = (1 << max(n - 1, 1).bit_length()) - 1
+    # The state one step before ``index``; ``a`` is odd, so invertible mod m
+    x = (pow(a, -1, mask + 1) * (index - c)) & mask
+    if not _replace(room_id, corpus, current, (a, c, x, used - 1, n)):
+        metrics.incr('norepeat.unreturned')
+        return False
+    metrics.incr('norepeat.returned')
+    return True
@@ -0,0 +1,242 @@
+"""
+Speculative question prefetch.
+
+Most of the latency of a truth/dare choice is fetching its question from
+the API after the click. When a turn starts (``initialize_game``,
+``next_round`` and their engine counterparts) the prefetcher fetches one
+truth and one dare for the player whose turn it is on background
+threads, so the choice only promotes the candidate it asked for.
+
+The candidate not picked, and those of a turn that ended some other way,
+are recycled into a shared pool per question type (up to
+``GAME_PREFETCH_POOL_SIZE`` each) that later turns draw from before
+calling the API, so prefetching costs about one fetch per turn. Only
+questions from poolable providers are pooled, which leaves out the
+fallback questions and the local corpus, whose picks are per room. Those
+are handed back to their provider instead (``QuestionProvider.release``),
+by a prefetch worker, so the room's no-repeat cursor only counts the
+questions it was shown. A candidate still queued when it is given up is
+dropped without being fetched. A question taken for a choice that is then
+refused, as the turn had passed meanwhile, is given back the same way.
+
+Candidates live in the worker that started the turn; a choice served by
+another worker fetches inline and counts as a miss. The ``prefetch.*``
+metrics record hits (ready when chosen), late hits (still in flight, so
+the choice waited for it), misses, pool draws and recycles.
+"""
+import functools
+import logging
+import queue
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import metrics
+from .providers import get_chain
+
+logger = logging.getLogger(__name__)
+
+QUESTION_TYPES = ('truth', 'dare')
+
+QUEUED, FETCHING, READY, DROPPED = range(4)
+
+
+def prefetch_enabled():
+    return getattr(settings, 'GAME_QUESTION_PREFETCH', True)
+
+
+def fetch_question(question_type, room_id):
+    """Fetch a question for a room; return (text, question, provider that served it)."""
+    data, provider = get_chain().select(question_type, room_id)
+    return data.get('question', 'No question available'), data, provider
+
+
+class Candidate:
+    """A question of one type fetched, or being fetched, ahead of the choice."""
+    __slots__ = (
+        'room_id', 'question_type', 'state', 'text', 'source', 'recyclable', 'release', 'abandoned', 'ready',
+    )
+
+    def __init__(self, room_id, question_type, text=None, source=None):
+        self.room_id = room_id
+        self.question_type = question_type
+        self.state = QUEUED if text is None else READY
+        self.text = text
+        self.source = source
+        self.recyclable = text is not None
+        # Hands the question back to its provider if it goes unused
+        self.release = None
+        self.abandoned = False
+        self.ready = threading.Event()
+        if text is not None:
+            self.ready.set()
+
+
+class QuestionPrefetcher:
+    """Per-room question candidates for the current turn, and the recycle pool."""
+
+    def __init__(self, name='question-prefetch'):
+        self.name = name
+        self._lock = threading.Lock()
+        # room_id -> (player_id, {question_type: Candidate}), oldest first
+        self._turns = OrderedDict()
+        self._pool = {question_type: deque() for question_type in QUESTION_TYPES}
+        self._queue = queue.SimpleQueue()
+        self._threads = []
+
+    def start_turn(self, room_id, player_id):
+        """Prefetch a truth and a dare for ``player_id``'s turn in a room."""
+        if not prefetch_enabled() or player_id is None:
+            return
+        candidates = {}
+        to_fetch = []
+        with self._lock:
+            given_up = [self._turns.pop(room_id, None)]
+            for question_type in QUESTION_TYPES:
+                pool = self._pool[question_type]
+                if pool:
+                    metrics.incr('prefetch.pooled')
+                    candidates[question_type] = Candidate(room_id, question_type, *pool.popleft())
+                else:
+                    candidates[question_type] = candidate = Candidate(room_id, question_type)
+                    to_fetch.append(candidate)
+            self._turns[room_id] = (player_id, candidates)
+            while len(self._turns) > getattr(settings, 'GAME_PREFETCH_MAX_ROOMS', 1000):
+                given_up.append(self._turns.popitem(last=False)[1])
+            for turn in given_up:
+                if turn is not None:
+                    for candidate in turn[1].values():
+                        self._give_up(candidate)
+        self._ensure_workers()
+        for candidate in to_fetch:
+            self._queue.put(candidate)
+
+    def take(self, room_id, player_id, choice):
+        """
+        Return the ``Candidate`` holding the question for ``player_id``'s
+        ``choice``: the prefetched one when there is one, else a fresh
+        fetch. Give it back with ``give_back`` if the move is then refused.
+        """
+        with self._lock:
+            turn = self._turns.pop(room_id, None)
+            candidate = None
+            if turn is not None:
+                turn_player_id, candidates = turn
+                for question_type, other in candidates.items():
+                    if turn_player_id != player_id or question_type != choice:
+                        self._give_up(other)
+                if turn_player_id == player_id:
+                    candidate = candidates.get(choice)
+            if candidate is not None and candidate.state == QUEUED:
+                # Not picked up by a worker yet; fetching here is no slower
+                candidate.state = DROPPED
+                candidate = None
+
+        if candidate is None:
+            metrics.incr('prefetch.miss')
+        else:
+            if candidate.ready.is_set():
+                metrics.incr('prefetch.hit')
+            else:
+                metrics.incr('prefetch.late')
+                candidate.ready.wait()
+            if candidate.text is not None:
+                return candidate
+        text, question, provider = fetch_question(choice, room_id)
+        candidate = Candidate(room_id, choice, text, provider.source)
+        candidate.recyclable = provider.poolable
+        if not provider.poolable:
+            candidate.release = functools.partial(provider.release, choice, room_id, question)
+        return candidate
+
+    def give_back(self, candidate):
+        """Recycle or hand back a taken question the move didn't use, e.g. as the turn had passed."""
+        metrics.incr('prefetch.given_back')
+        with self._lock:
+            self._give_up(candidate)
+        # Handing back to a provider needs a worker, even with prefetch off
+        self._ensure_workers()
+
+    def _give_up(self, candidate):
+        """Recycle or hand back an unused candidate, now or once its fetch finishes. Lock held."""
+        if candidate.state == QUEUED:
+            candidate.state = DROPPED
+        elif candidate.state == FETCHING:
+            candidate.abandoned = True
+        elif candidate.state == READY and candidate.recyclable:
+            pool = self._pool[candidate.question_type]
+            if len(pool) < getattr(settings, 'GAME_PREFETCH_POOL_SIZE', 50):
+                pool.append((candidate.text, candidate.source))
+                metrics.incr('prefetch.recycled')
+        elif candidate.state == READY and candidate.release is not None:
+            # Left to a worker, as it may touch the cache
+            self._queue.put(candidate.release)
+            candidate.release = None
+            metrics.incr('prefetch.released')
+
+    def _ensure_workers(self):
+        if len(self._threads) >= getattr(settings, 'GAME_PREFETCH_WORKERS', 2):
+            return
+        with self._lock:
+            while len(self._threads) < getattr(settings, 'GAME_PREFETCH_WORKERS', 2):
+                thread = threading.Thread(
+                    target=self._run, name=f'{self.name}-{len(self._threads)}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._handle(job)
+            finally:
+                # Picks from the local corpus write the room's cursor
+                close_old_connections()
+
+    def _handle(self, candidate):
+        if not isinstance(candidate, Candidate):
+            try:
+                candidate()
+            except Exception:
+                logger.exception('Handing back an unused question failed')
+            return
+        with self._lock:
+            if candidate.state != QUEUED:
+                return
+            candidate.state = FETCHING
+        try:
+            text, question, provider = fetch_question(candidate.question_type, candidate.room_id)
+        except Exception:
+            logger.exception('Prefetching a %s question failed', candidate.question_type)
+            text = None
+        with self._lock:
+            candidate.text = text
+            if text is not None:
+                candidate.source = provider.source
+                candidate.recyclable = provider.poolable
+                if not provider.poolable:
+                    candidate.release = functools.partial(
+                        provider.release, candidate.question_type, candidate.room_id, question
+                    )
+            candidate.state = READY
+            if candidate.abandoned:
+                self._give_up(candidate)
+        candidate.ready.set()
+
+    def stats(self):
+        """Rooms with candidates, pool sizes, and the share of choices served by a prefetch."""
+        counters = metrics.snapshot()['counters']
+        served = counters.get('prefetch.hit', 0) + counters.get('prefetch.late', 0)
+        taken = served + counters.get('prefetch.miss', 0)
+        with self._lock:
+            return {
+                'rooms': len(self._turns),
+                'pool': {question_type: len(pool) for question_type, pool in self._pool.items()},
+                'hit_rate': round(served / taken, 3) if taken else None,
+            }
+
+
+prefetcher = QuestionPrefetcher()
@@ -0,0 +1,252 @@
+"""
+In-memory presence for room sockets.
+
+Each worker tracks which players have a socket open on it and when they
+were last heard from. Any client frame counts as a heartbeat, and clients
+send an explicit ``heartbeat`` every ``GAME_HEARTBEAT_SECONDS`` while idle.
+A background sweep drops players whose sockets went silent and releases
+rooms that have had nobody connected for ``GAME_IDLE_ROOM_RELEASE_SECONDS``.
+
+A worker only sees its own sockets, so the players of a room it finds idle
+may be connected to another worker. Each sweep stamps
+``Room.last_active_at`` on the rooms with a player connected to this
+worker, and a room is only released once neither that stamp nor its game
+state has changed within the idle period on any worker.
+"""
+import asyncio
+import logging
+import sys
+import time
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+from .engine import store as engine_store
+from .metrics import traced_sync_to_async
+from .models import Room
+from .push import publish, publisher
+from .replicas import note_room_writes
+from .sqlite import serialized_write
+from .tokens import revoke_player_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class PlayerPresence:
+    """Open sockets and last activity for one player."""
+    __slots__ = ('connections', 'last_seen', 'silent')
+
+    def __init__(self, now):
+        self.connections = 0
+        self.last_seen = now
+        self.silent = False
+
+    @property
+    def online(self):
+        return self.connections > 0 and not self.silent
+
+
+class RoomPresence:
+    """Presence of every player in one room."""
+    __slots__ = ('room_id', 'players', 'empty_since')
+
+    def __init__(self, room_id, now):
+        self.room_id = room_id
+        self.players = {}
+        self.empty_since = now
+
+    def connected(self):
+        return sorted(player_id for player_id, player in self.players.items() if player.online)
+
+
+class PresenceTracker:
+    """Presence map for all rooms with sockets on this worker."""
+
+    def __init__(self):
+        self.rooms = {}
+
+    def connect(self, room_code, room_id, player_id):
+        """Register a socket for a player; return True if they just came online."""
+        now = time.monotonic()
+        room = self.rooms.get(room_code)
+        if room is None:
+            room = self.rooms[room_code] = RoomPresence(room_id, now)
+        player = room.players.get(player_id)
+        if player is None:
+            player = room.players[player_id] = PlayerPresence(now)
+        was_online = player.online
+        player.connections += 1
+        player.last_seen = now
+        player.silent = False
+        room.empty_since = None
+        return not was_online
+
+    def disconnect(self, room_code, player_id):
+        """Drop a socket for a player; return True if they just went offline."""
+        room = self.rooms.get(room_code)
+        player = room.players.get(player_id) if room else None
+        if player is None or not player.connections:
+            return False
+        was_online = player.online
+        player.connections -= 1
+        if player.connections:
+            return False
+        if not room.connected() and room.empty_since is None:
+            room.empty_since = time.monotonic()
+        return was_online
+
+    def touch(self, room_code, player_id):
+        """Record activity from a player; return True if a silent player came back."""
+        room = self.rooms.get(room_code)
+        player = room.players.get(player_id) if room else None
+        if player is None:
+            return False
+        player.last_seen = time.monotonic()
+        if player.silent and player.connections:
+            player.silent = False
+            room.empty_since = None
+            return True
+        return False
+
+    def connected(self, room_code):
+        """Return the ids of players with a socket open."""
+        room = self.rooms.get(room_code)
+        return room.connected() if room else []
+
+    def presence_frame(self, room_code):
+        room = self.rooms.get(room_code)
+        now = time.monotonic()
+        return {
+            'type': 'presence',
+            'connected': room.connected() if room else [],
+            'idle_seconds': {
+                str(player_id): int(now - player.last_seen)
+                for player_id, player in room.players.items()
+            } if room else {},
+        }
+
+    def expire_silent(self, timeout):
+        """Mark players silent for longer than ``timeout`` as offline; return affected rooms."""
+        now = time.monotonic()
+        changed = []
+        for room_code, room in self.rooms.items():
+            for player in room.players.values():
+                if player.online and now - player.last_seen > timeout:
+                    player.silent = True
+                    if room_code not in changed:
+                        changed.append(room_code)
+            if room_code in changed and not room.connected():
+                room.empty_since = now
+        return changed
+
+    def live_room_ids(self):
+        """Return the ids of rooms with a player connected."""
+        return [room.room_id for room in self.rooms.values() if room.connected()]
+
+    def pop_idle_rooms(self, threshold):
+        """Remove and return (room_code, room_id) for rooms empty for longer than ``threshold``."""
+        now = time.monotonic()
+        idle = [
+            (room_code, room.room_id)
+            for room_code, room in self.rooms.items()
+            if room.empty_since is not None and now - room.empty_since > threshold
+        ]
+        for room_code, room_id in idle:
+            del self.rooms[room_code]
+        return idle
+
+    def memory_usage(self):
+        """Approximate bytes held by the presence map."""
+        total = sys.getsizeof(self.rooms)
+        for room in self.rooms.values():
+            total += sys.getsizeof(room) + sys.getsizeof(room.players)
+            total += sum(sys.getsizeof(player) for player in room.players.values())
+        return total
+
+
+tracker = PresenceTracker()
+_sweeper = None
+
+
+async def broadcast_presence(room_code):
+    await publish(room_code, 'presence_changed', tracker.presence_frame(room_code))
+
+
+def _release(room_ids):
+    engine_store.evict(*room_ids)
+    note_room_writes(room_ids)
+    revoke_player_tokens(room_ids=room_ids)
+    return serialized_write(Room.objects.filter(id__in=room_ids, is_active=True).update)(is_active=False)
+
+
+@traced_sync_to_async
+def release_rooms(room_ids):
+    return _release(room_ids)
+
+
+@traced_sync_to_async
+def mark_rooms_active(room_ids, now):
+    serialized_write(Room.objects.filter(id__in=room_ids).update)(last_active_at=now)
+
+
+@traced_sync_to_async
+def release_idle_rooms(room_ids, idle_since):
+    """Release those of ``room_ids`` no worker has seen active since ``idle_since``; return how many."""
+    idle = list(
+        Room.objects.filter(id__in=room_ids, is_active=True)
+        .exclude(last_active_at__gte=idle_since)
+        .exclude(game_states__updated_at__gte=idle_since)
+        .values_list('id', flat=True)
+    )
+    return _release(idle) if idle else 0
+
+
+async def sweep():
+    """Expire silent players, release idle rooms and refresh presence gauges."""
+    heartbeat = getattr(settings, 'GAME_HEARTBEAT_SECONDS', 25)
+    for room_code in tracker.expire_silent(heartbeat * 3):
+        await broadcast_presence(room_code)
+
+    now = timezone.now()
+    live = tracker.live_room_ids()
+    if live:
+        await mark_rooms_active(live, now)
+
+    threshold = getattr(settings, 'GAME_IDLE_ROOM_RELEASE_SECONDS', 600)
+    idle = tracker.pop_idle_rooms(threshold)
+    if idle:
+        for room_code, room_id in idle:
+            publisher.cancel(room_code)
+        released = await release_idle_rooms(
+            [room_id for room_code, room_id in idle], now - timedelta(seconds=threshold)
+        )
+        metrics.incr('presence.rooms_released', released)
+        metrics.incr('presence.rooms_kept', len(idle) - released)
+        logger.info('Released %d of %d idle rooms', released, len(idle))
+
+    connections = sum(
+        player.connections for room in tracker.rooms.values() for player in room.players.values()
+    )
+    metrics.set_gauge('presence.rooms', len(tracker.rooms))
+    metrics.set_gauge('presence.connections', connections)
+    metrics.set_gauge('presence.bytes', tracker.memory_usage())
+
+
+async def _sweep_forever():
+    interval = getattr(settings, 'GAME_PRESENCE_SWEEP_SECONDS', 30)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sweep()
+        except Exception:
+            logger.exception('Presence sweep failed')
+
+
+def ensure_sweeper():
+    """Start the background sweep on the running loop if it isn't running."""
+    global _sweeper
+    if _sweeper is None or _sweeper.done():
+        _sweeper = asyncio.get_running_loop().create_task(_sweep_forever())
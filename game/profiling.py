@@ -0,0 +1,132 @@
+"""
+On-demand profiling for staff requests and consumer events.
+
+A profile is only collected when a staff user asks for it with the
+``X-Profile`` header, a ``?profile=1`` query parameter or a ``"profile": true``
+field on a WebSocket message. Otherwise the only cost is that check.
+
+An HTTP profile covers the whole request. A WebSocket profile covers only
+the event's sync executor hops, not the event loop, which serves other
+sockets while the event awaits; its duration is still wall-clock.
+"""
+import cProfile
+import io
+import marshal
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connection
+
+_active_session = ContextVar('game_profile_session', default=None)
+
+
+def profiling_enabled():
+    return getattr(settings, 'GAME_PROFILING_ENABLED', True)
+
+
+def active_session():
+    """Return the profile session for the current request or event, if any."""
+    return _active_session.get()
+
+
+def is_truthy(value):
+    """Read a profile flag: ``True``, or a string such as ``1``/``true``/``yes``/``on``."""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return value is True
+
+
+def is_profile_requested(request):
+    """Check whether a staff user asked for this HTTP request to be profiled."""
+    if not (is_truthy(request.GET.get('profile')) or is_truthy(request.headers.get('X-Profile'))):
+        return False
+    user = getattr(request, 'user', None)
+    return bool(profiling_enabled() and user and user.is_staff)
+
+
+class ProfileSession:
+    """Collects profiler stats and queries across the threads serving one request."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profilers = []
+        self.queries = []
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def activate(self):
+        token = _active_session.set(self)
+        try:
+            yield self
+        finally:
+            _active_session.reset(token)
+
+    @contextmanager
+    def capture(self):
+        """Profile the current thread and log its queries for the wrapped block."""
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running on this thread
+            profiler = None
+        try:
+            with connection.execute_wrapper(self._log_query):
+                yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                with self._lock:
+                    self.profilers.append(profiler)
+
+    def _log_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self._lock:
+                self.queries.append({
+                    'sql': sql,
+                    'time_ms': round((time.perf_counter() - started) * 1000, 3),
+                })
+
+    def stats(self):
+        stats = None
+        for profiler in self.profilers:
+            if stats is None:
+                stats = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+        return stats
+
+    def save(self, kind, path, room_code=None, requested_by=None):
+        """Persist the collected profile and return the ProfileRecord."""
+        from .models import ProfileRecord
+        from .sqlite import serialized_write
+
+        duration_ms = (time.perf_counter() - self.started) * 1000
+        stats = self.stats()
+        stats_text = ''
+        profile_data = b''
+        if stats is not None:
+            stream = io.StringIO()
+            stats.stream = stream
+            stats.sort_stats('cumulative').print_stats(50)
+            stats_text = stream.getvalue()
+            profile_data = marshal.dumps(stats.stats)
+
+        return serialized_write(ProfileRecord.objects.create)(
+            kind=kind,
+            path=path[:255],
+            room_code=room_code,
+            requested_by=requested_by,
+            duration_ms=duration_ms,
+            query_count=len(self.queries),
+            query_log=self.queries,
+            stats_text=stats_text,
+            profile_data=profile_data,
+        )
@@ -0,0 +1,265 @@
+"""
+Question providers.
+
+A provider returns a question of a type ('truth' or 'dare') in the shape
+the Truth or Dare API uses (``id``, ``type``, ``rating``, ``question``),
+or None when it has none to give. ``GAME_QUESTION_PROVIDERS`` chains them
+as ``(name, weight)`` pairs: each fetch starts with a provider drawn at
+random by weight from those with a positive weight, then falls back to
+the others in the order listed. The built-in fallback questions come last
+so a fetch always returns something; those carry the id ``'fallback'``.
+
+* ``api``: the Truth or Dare HTTP API (``TRUTH_DARE_API_*``).
+* ``local``: the bundled corpus (``GAME_QUESTION_CORPUS``), a JSON list of
+  questions indexed by type and rating, so the game can run, and be
+  benchmarked, with no network at all. A room is never given the same
+  corpus question twice until it has seen them all (``norepeat``); a
+  question fetched for a room but never shown is handed back with
+  ``release``.
+
+A dotted path names any other ``QuestionProvider`` subclass. Every served
+question is counted as ``questions.<provider>.served``, every provider
+that came up empty as ``questions.<provider>.failed``. Questions are saved
+with the ``source`` of the provider that served them.
+"""
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .norepeat import next_index, return_index
+
+logger = logging.getLogger(__name__)
+
+# Lowest rating first; a configured rating also allows the milder ones
+RATINGS = ('pg', 'pg13', 'r')
+
+FALLBACK_QUESTIONS = {
+    'truth': 'What is your biggest fear?',
+    'dare': 'Do 10 jumping jacks.',
+}
+
+
+class QuestionProvider:
+    """
+    Base class; ``fetch`` returns a question dict or None. ``room_id`` is
+    the room it is for, if any. Questions from a ``poolable`` provider may
+    be handed to another room when the prefetcher has no use for them.
+    ``source`` is what questions it serves are saved with
+    (``Question.SOURCE_CHOICES``).
+    """
+    name = None
+    poolable = True
+    source = 'OTHER'
+
+    def fetch(self, question_type, room_id=None):
+        raise NotImplementedError
+
+    def release(self, question_type, room_id, question):
+        """Hand back a question fetched for ``room_id`` that was never shown."""
+
+    def load(self):
+        """Prepare the provider ahead of its first fetch."""
+
+
+class APIProvider(QuestionProvider):
+    """Questions from the Truth or Dare HTTP API, rate limited per process."""
+    name = 'api'
+    source = 'API'
+
+    def __init__(self):
+        self.base_url = settings.TRUTH_DARE_API_BASE_URL
+        self.rating = settings.TRUTH_DARE_API_RATING
+        self.rate_limit_requests = settings.TRUTH_DARE_API_RATE_LIMIT_REQUESTS
+        self.rate_limit_seconds = settings.TRUTH_DARE_API_RATE_LIMIT_SECONDS
+        self.request_times = deque()
+        self._lock = threading.Lock()
+
+    def _reserve_request(self):
+        """Count a request against the rate limit; False if over it."""
+        now = time.time()
+        with self._lock:
+            while self.request_times and now - self.request_times[0] >= self.rate_limit_seconds:
+                self.request_times.popleft()
+            if len(self.request_times) >= self.rate_limit_requests:
+                return False
+            self.request_times.append(now)
+            return True
+
+    def urls(self, question_type):
+        if question_type == 'truth':
+            return [f"{self.base_url}/truth"]
+        # Try /api/dare first, then fallback to /dare
+        return [f"{self.base_url}/api/dare", f"{self.base_url}/dare"]
+
+    def fetch(self, question_type, room_id=None):
+        if not self._reserve_request():
+            metrics.incr('questions.api.rate_limited')
+            return None
+        params = {'rating': self.rating} if self.rating else {}
+        for url in self.urls(question_type):
+            try:
+                with metrics.timed('api'):
+                    response = requests.get(url, params=params, timeout=5)
+                response.raise_for_status()
+                return response.json()
+            except Exception:
+                continue
+        return None
+
+
+class LocalCorpusProvider(QuestionProvider):
+    """Questions from the bundled JSON corpus, without repeats within a room."""
+    name = 'local'
+    source = 'LOCAL'
+    # Each room draws from its own permutation, so questions stay in it
+    poolable = False
+
+    def __init__(self):
+        self.path = settings.GAME_QUESTION_CORPUS
+        self.rating = settings.TRUTH_DARE_API_RATING
+        self._index = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Read and index the corpus; returns {(type, rating): [question, ...]}."""
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    with open(self.path, encoding='utf-8') as corpus:
+                        entries = json.load(corpus)
+                    index = {}
+                    for entry in entries:
+                        index.setdefault((entry['type'], entry['rating']), []).append(entry)
+                    self._index = index
+        return self._index
+
+    def allowed_ratings(self):
+        if self.rating not in RATINGS:
+            return RATINGS
+        return RATINGS[:RATINGS.index(self.rating) + 1]
+
+    def pools(self, question_type):
+        index = self.load()
+        return [index.get((question_type, rating), ()) for rating in self.allowed_ratings()]
+
+    def fetch(self, question_type, room_id=None):
+        pools = self.pools(question_type)
+        total = sum(len(pool) for pool in pools)
+        if not total:
+            return None
+        # An index into every allowed question, without building a merged list
+        if room_id is None:
+            pick = random.randrange(total)
+        else:
+            pick = next_index(room_id, f'{question_type}:{self.rating}', total)
+        for pool in pools:
+            if pick < len(pool):
+                return pool[pick]
+            pick -= len(pool)
+
+    def release(self, question_type, room_id, question):
+        if room_id is None:
+            return
+        pools = self.pools(question_type)
+        total = sum(len(pool) for pool in pools)
+        offset = 0
+        for pool in pools:
+            for position, entry in enumerate(pool):
+                if entry is question:
+                    return_index(room_id, f'{question_type}:{self.rating}', total, offset + position)
+                    return
+            offset += len(pool)
+
+
+class FallbackProvider(QuestionProvider):
+    """The fixed questions served when every configured provider fails."""
+    name = 'fallback'
+    source = 'FALLBACK'
+    poolable = False
+
+    def fetch(self, question_type, room_id=None):
+        return {
+            'id': 'fallback',
+            'type': question_type,
+            'rating': settings.TRUTH_DARE_API_RATING,
+            'question': FALLBACK_QUESTIONS.get(question_type, FALLBACK_QUESTIONS['dare'])
+        }
+
+
+PROVIDERS = {
+    'api': APIProvider,
+    'local': LocalCorpusProvider,
+}
+
+
+class ProviderChain:
+    """Weighted first pick, then fallback in order, then the fixed questions."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.fallback = FallbackProvider()
+
+    def order(self):
+        weighted = [(provider, weight) for provider, weight in self.entries if weight > 0]
+        if not weighted:
+            return [provider for provider, weight in self.entries]
+        first = random.choices(
+            [provider for provider, weight in weighted],
+            weights=[weight for provider, weight in weighted]
+        )[0]
+        return [first] + [provider for provider, weight in self.entries if provider is not first]
+
+    def fetch(self, question_type, room_id=None):
+        return self.select(question_type, room_id)[0]
+
+    def select(self, question_type, room_id=None):
+        """Return (question, provider that served it)."""
+        for provider in self.order():
+            try:
+                data = provider.fetch(question_type, room_id)
+            except Exception:
+                logger.exception('Question provider %s failed', provider.name)
+                data = None
+            if data and data.get('question'):
+                metrics.incr(f'questions.{provider.name}.served')
+                return data, provider
+            metrics.incr(f'questions.{provider.name}.failed')
+        metrics.incr('questions.fallback.served')
+        return self.fallback.fetch(question_type, room_id), self.fallback
+
+    def load(self):
+        for provider, weight in self.entries:
+            provider.load()
+
+
+def build_provider(name):
+    provider_class = import_string(name) if '.' in name else PROVIDERS[name]
+    provider = provider_class()
+    if provider.name is None:
+        provider.name = name
+    return provider
+
+
+_chain = None
+_chain_lock = threading.Lock()
+
+
+def get_chain():
+    """Return the process-wide chain built from ``GAME_QUESTION_PROVIDERS``."""
+    global _chain
+    if _chain is None:
+        with _chain_lock:
+            if _chain is None:
+                _chain = ProviderChain([
+                    (build_provider(name), weight)
+                    for name, weight in getattr(settings, 'GAME_QUESTION_PROVIDERS', [('api', 1)])
+                ])
+    return _chain
@@ -0,0 +1,232 @@
+"""
+Room broadcasts: sequencing, replay buffers and coalesced state pushes.
+
+Every broadcast to a room is stamped with a per-room sequence number and
+the process ``EPOCH`` and kept in a bounded ring buffer, so a reconnecting
+client that sends its last sequence number can be replayed only the events
+it missed. If the buffer has moved past that point, or the epoch differs
+after a restart, the client gets a full snapshot instead. The buffer lives
+in the process, so the epoch is random per process rather than stable: a
+restarted worker starts its sequence numbers over, and a stable epoch
+would let it replay its new events as the ones a client missed. Every
+resume after a restart or deploy therefore gets a snapshot.
+
+Mutations mark a room dirty instead of pushing state themselves. The first
+mark schedules a flush one tick later (``GAME_PUSH_COALESCE_MS``); further
+marks before the flush are absorbed. The flush builds the room state once
+and broadcasts it, pre-encoded, to the whole room group. Moves made over
+HTTP flush right away (``utils.broadcast_room_move``), as they run outside
+the event loop.
+
+Every broadcast also goes to the room's spectator group, and the latest
+state message is kept so spectators joining a room are sent it as is,
+without a snapshot being built per spectator. It is kept current by this
+worker's flushes and by the state pushes its spectator relay receives from
+other workers; a worker with no relay for the room builds a fresh one.
+"""
+import asyncio
+import logging
+import secrets
+import threading
+from collections import OrderedDict, deque
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import encoding, metrics
+from .metrics import traced_sync_to_async
+from .models import Room
+from .services import RoomStateService
+
+logger = logging.getLogger(__name__)
+
+EPOCH = secrets.token_hex(4)
+
+
+class RoomEventLog:
+    """Ring buffer of the most recent sequenced broadcasts for one room."""
+    __slots__ = ('events', 'last_seq')
+
+    def __init__(self, size):
+        self.events = deque(maxlen=size)
+        self.last_seq = 0
+
+
+class EventBuffer:
+    """Per-room event logs, bounded in both events per room and rooms kept."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rooms = OrderedDict()
+
+    def _log(self, room_code):
+        log = self._rooms.get(room_code)
+        if log is None:
+            log = RoomEventLog(getattr(settings, 'GAME_EVENT_BUFFER_SIZE', 64))
+            self._rooms[room_code] = log
+            if len(self._rooms) > getattr(settings, 'GAME_EVENT_BUFFER_ROOMS', 10000):
+                self._rooms.popitem(last=False)
+        else:
+            self._rooms.move_to_end(room_code)
+        return log
+
+    def record(self, room_code, handler_type, frame):
+        """Stamp ``frame`` with the next sequence number and return the group message."""
+        with self._lock:
+            log = self._log(room_code)
+            log.last_seq += 1
+            message = encoding.group_message(
+                handler_type,
+                {**frame, 'seq': log.last_seq, 'epoch': EPOCH},
+                room_code=room_code
+            )
+            log.events.append((log.last_seq, message))
+            return message
+
+    def head(self, room_code):
+        """Return the last sequence number broadcast to a room."""
+        log = self._rooms.get(room_code)
+        return log.last_seq if log else 0
+
+    def since(self, room_code, epoch, last_seq):
+        """
+        Return the messages after ``last_seq``, or None when they can't be
+        replayed and the client needs a full snapshot.
+        """
+        with self._lock:
+            log = self._rooms.get(room_code)
+            if epoch != EPOCH or log is None or last_seq > log.last_seq:
+                return None
+            if last_seq == log.last_seq:
+                return []
+            if not log.events or log.events[0][0] > last_seq + 1:
+                return None
+            return [message for seq, message in log.events if seq > last_seq]
+
+
+event_buffer = EventBuffer()
+
+
+def player_group(room_code):
+    return f'game_{room_code}'
+
+
+def spectator_group(room_code):
+    return f'watch_{room_code}'
+
+
+async def send_to_room(room_code, message):
+    """Send a group message to a room's players and spectators."""
+    layer = get_channel_layer()
+    await layer.group_send(player_group(room_code), message)
+    await layer.group_send(spectator_group(room_code), message)
+
+
+async def publish(room_code, handler_type, frame):
+    """Sequence, buffer and broadcast a frame to a room."""
+    await send_to_room(room_code, event_buffer.record(room_code, handler_type, frame))
+
+
+class RoomStatePublisher:
+    """Schedules at most one pending state push per room."""
+
+    def __init__(self):
+        self._pending = {}
+        self._latest = OrderedDict()
+        self._building = {}
+        # Running flushes; the loop only keeps weak references to tasks
+        self._flushing = set()
+
+    def mark_dirty(self, room_code, room_id):
+        """Record that a room changed; must be called from the event loop."""
+        metrics.incr('room_push.marked')
+        if room_code in self._pending:
+            metrics.incr('room_push.coalesced')
+            return
+
+        delay = getattr(settings, 'GAME_PUSH_COALESCE_MS', 40) / 1000
+        loop = asyncio.get_running_loop()
+        self._pending[room_code] = loop.call_later(
+            delay, lambda: self._start_flush(loop, room_code, room_id)
+        )
+
+    def _start_flush(self, loop, room_code, room_id):
+        task = loop.create_task(self.flush(room_code, room_id))
+        self._flushing.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        self._flushing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            metrics.incr('room_push.failed')
+            logger.error('Room state push failed', exc_info=task.exception())
+
+    def cancel(self, room_code):
+        handle = self._pending.pop(room_code, None)
+        if handle:
+            handle.cancel()
+        self._latest.pop(room_code, None)
+
+    async def flush(self, room_code, room_id):
+        """Build the room state once and push it to every socket in the room."""
+        self._pending.pop(room_code, None)
+        state = await traced_sync_to_async(RoomStateService.build_snapshot)(room_id)
+        if state is None:
+            return
+
+        message = event_buffer.record(room_code, 'room_state', state)
+        self.remember(room_code, message)
+        await send_to_room(room_code, message)
+        metrics.incr('room_push.sent')
+    
+    def remember(self, room_code, message):
+        """Keep ``message`` as the room's latest state."""
+        self._latest[room_code] = message
+        self._latest.move_to_end(room_code)
+        if len(self._latest) > getattr(settings, 'GAME_EVENT_BUFFER_ROOMS', 10000):
+            self._latest.popitem(last=False)
+    
+    async def latest(self, room_code, fresh=False):
+        """
+        Return the latest room state message for a room. When none has been
+        pushed yet, or ``fresh`` is set because the one kept may be out of
+        date, it is built once, however many callers are waiting on it.
+        """
+        message = None if fresh else self._latest.get(room_code)
+        if message is not None:
+            metrics.incr('room_push.latest_hit')
+            return message
+        task = self._building.get(room_code)
+        if task is None:
+            task = self._building[room_code] = asyncio.ensure_future(self._build(room_code))
+            task.add_done_callback(lambda task: self._building.pop(room_code, None))
+        return await asyncio.shield(task)
+    
+    async def _build(self, room_code):
+        metrics.incr('room_push.latest_built')
+        # Stamped with the current head rather than a new sequence number, as
+        # the message is only sent to spectators as they join
+        seq = event_buffer.head(room_code)
+        state = await traced_sync_to_async(build_snapshot_for_code)(room_code)
+        if state is None:
+            return None
+        message = encoding.group_message('room_state', {**state, 'seq': seq, 'epoch': EPOCH})
+        # Unless something was pushed while building, this is the newest state
+        if room_code not in self._latest or event_buffer.head(room_code) == seq:
+            self.remember(room_code, message)
+        return message
+
+
+def build_snapshot_for_code(room_code):
+    room_id = Room.objects.filter(
+        code=room_code, is_active=True
+    ).values_list('id', flat=True).first()
+    return RoomStateService.build_snapshot(room_id) if room_id else None
+
+
+publisher = RoomStatePublisher()
+
+
+def mark_room_dirty(room_code, room_id):
+    """Schedule a coalesced state push for a room."""
+    publisher.mark_dirty(room_code, room_id)
@@ -0,0 +1,116 @@
+"""
+In-memory token buckets for inbound socket messages and mutation endpoints.
+
+Limits are configured in ``GAME_RATE_LIMITS`` as ``name: (rate, burst)``
+where ``rate`` is tokens refilled per second and ``burst`` the bucket size.
+
+HTTP requests are charged to the player their token names, or else to the
+client address, never to anything else the client sends: a fresh session
+id per request would otherwise get a fresh bucket. Behind a proxy, set
+``GAME_CLIENT_ADDRESS_HEADER`` to the ``request.META`` key of the header
+it forwards the address in; the last address listed is used, as the one
+the proxy itself added.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+
+from . import metrics
+from .encoding import JsonResponse
+from .tokens import request_identity
+
+DEFAULT_RATE_LIMITS = {
+    'socket': (5, 10),
+    'player': (2, 6),
+}
+
+
+def get_limit(name):
+    return getattr(settings, 'GAME_RATE_LIMITS', DEFAULT_RATE_LIMITS).get(name, DEFAULT_RATE_LIMITS[name])
+
+
+class TokenBucket:
+    """A token bucket; ``consume`` returns 0 when allowed, else seconds to wait."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, cost=1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+class BucketRegistry:
+    """Buckets keyed by player or client, keeping only the most recently used."""
+
+    def __init__(self, limit_name, max_keys=50000):
+        self.limit_name = limit_name
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def consume(self, key, cost=1):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(*get_limit(self.limit_name))
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket.consume(cost)
+
+
+player_buckets = BucketRegistry('player')
+
+
+def socket_bucket():
+    """Create the bucket for a single socket connection."""
+    return TokenBucket(*get_limit('socket'))
+
+
+def client_address(request):
+    """Return the address of the client that sent ``request``."""
+    header = getattr(settings, 'GAME_CLIENT_ADDRESS_HEADER', None)
+    if header and request.META.get(header):
+        return request.META[header].split(',')[-1].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def throttled_response(retry_after):
+    response = JsonResponse(
+        {'error': 'Too many requests', 'retry_after': round(retry_after, 2)},
+        status=429
+    )
+    response['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def rate_limited(view):
+    """Throttle a mutation view per player, or per client address without a player token."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        identity = request_identity(request)
+        if identity:
+            key = f"player:{identity.player_id}"
+        else:
+            key = f"addr:{client_address(request)}"
+        retry_after = player_buckets.consume(key)
+        if retry_after:
+            metrics.incr('ratelimit.throttled.http')
+            return throttled_response(retry_after)
+        return view(request, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,109 @@
+"""
+Read-replica routing for polling and dashboard reads.
+
+When ``DATABASE_REPLICA_URL`` is configured, ``ReplicaRouter`` sends game
+reads made inside a ``replica_reads()`` block to the ``replica`` alias;
+every other read, and every write, stays on the primary. Only the game app
+is routed, so sessions and users are always read from the primary.
+
+A replica lags the primary, so a client polling right after its own move
+could read the state from before it. Every write to a room (or standalone
+request) pins it to the primary for ``GAME_REPLICA_PIN_SECONDS``. Writes
+are recorded from model signals, and from the bulk paths that bypass
+them (bulk injection, presence releases, write-behind flushes), as a cache entry per room holding the time of its latest write; a
+``replica_reads`` block for a pinned room reads from the primary instead.
+Pins are only seen by every worker when the cache is shared between them.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+REPLICA_ALIAS = 'replica'
+
+_read_alias = ContextVar('read_alias', default=None)
+
+
+def replica_enabled():
+    return REPLICA_ALIAS in settings.DATABASES
+
+
+class ReplicaRouter:
+    """Routes game reads inside ``replica_reads()`` to the replica."""
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'game':
+            return _read_alias.get()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        return True
+
+
+def _pin_key(kind, key):
+    return f'replica_pin:{kind}:{key}'
+
+
+def note_write(kind, key):
+    """Pin ``kind``/``key`` (e.g. 'room', room_id) to the primary after a write."""
+    if replica_enabled() and key is not None:
+        cache.set(_pin_key(kind, key), time.time(), getattr(settings, 'GAME_REPLICA_PIN_SECONDS', 5))
+
+
+def note_room_writes(room_ids):
+    if replica_enabled():
+        pinned_at = time.time()
+        cache.set_many(
+            {_pin_key('room', room_id): pinned_at for room_id in room_ids},
+            getattr(settings, 'GAME_REPLICA_PIN_SECONDS', 5)
+        )
+
+
+def is_pinned(kind, key):
+    return cache.get(_pin_key(kind, key)) is not None
+
+
+@contextmanager
+def replica_reads(kind=None, key=None):
+    """
+    Read game models from the replica for the duration of the block, unless
+    ``kind``/``key`` was written to recently.
+    """
+    if not replica_enabled():
+        yield None
+        return
+    if kind is not None and is_pinned(kind, key):
+        metrics.incr('replica.pinned')
+        yield 'default'
+        return
+    metrics.incr('replica.reads')
+    token = _read_alias.set(REPLICA_ALIAS)
+    try:
+        yield REPLICA_ALIAS
+    finally:
+        _read_alias.reset(token)
+
+
+def record_model_write(sender, instance, **kwargs):
+    """``post_save``/``post_delete`` receiver pinning the written row's room."""
+    from .models import Answer, Question, Room, StandaloneRequest
+
+    if isinstance(instance, Room):
+        note_write('room', instance.pk)
+    elif isinstance(instance, Answer):
+        if replica_enabled():
+            note_write('room', Question.objects.filter(
+                pk=instance.question_id
+            ).values_list('room_id', flat=True).first())
+    elif isinstance(instance, StandaloneRequest):
+        note_write('standalone', instance.session_id)
+    else:
+        note_write('room', getattr(instance, 'room_id', None))
@@ -3,5 +3,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/room/(?P<room_code>\w+)/$', consumers.GameConsumer.as_asgi()),
+    re_path(r'ws/room/(?P<room_code>\w+)/watch/$', consumers.SpectatorConsumer.as_asgi()),
     re_path(r'ws/standalone/(?P<session_id>[\w-]+)/$', consumers.StandaloneConsumer.as_asgi()),
 ]
@@ -1,111 +1,97 @@
 """
 Service layer for game logic and external API integration.
 """
-import requests
-import time
 from django.conf import settings
 from django.core.cache import cache
-from .models import Room, Player, GameState, Question, Answer
+from django.db import transaction
+from django.db.models import F, Max, OuterRef, Subquery
+from . import metrics
+from .engine import engine_enabled, get_engine, question_payload, store as engine_store
+from .models import MIN_PLAYERS, Room, Player, GameState, Question, QuestionText, Answer
+from .prefetch import prefetcher
+from .providers import get_chain
+from .replicas import note_room_writes
+from .sqlite import serialized_write
+from .tokens import revoke_player_tokens
+from .writebehind import writer
+
+
+def latest_game_state_id(room_field):
+    """Subquery for the id of the latest game state of the room in the outer query's ``room_field``."""
+    return Subquery(
+        GameState.objects.filter(room_id=OuterRef(room_field)).order_by('-id').values('id')[:1]
+    )
 
 
 class APIQuestionService:
-    """Service for fetching questions from external API."""
+    """Fetches questions through the configured provider chain (``providers``)."""
     
-    def __init__(self):
-        self.base_url = settings.TRUTH_DARE_API_BASE_URL
-        self.rating = settings.TRUTH_DARE_API_RATING
-        self.rate_limit_requests = settings.TRUTH_DARE_API_RATE_LIMIT_REQUESTS
-        self.rate_limit_seconds = settings.TRUTH_DARE_API_RATE_LIMIT_SECONDS
-        self.request_times = []
+    def fetch_truth_question(self):
+        """Fetch a truth question."""
+        return self.fetch_question_data('truth')
     
-    def _check_rate_limit(self):
-        """Check if we're within rate limit."""
-        current_time = time.time()
-        # Remove requests older than rate_limit_seconds
-        self.request_times = [t for t in self.request_times if current_time - t < self.rate_limit_seconds]
-        
-        if len(self.request_times) >= self.rate_limit_requests:
-            return False
-        return True
+    def fetch_dare_question(self):
+        """Fetch a dare question."""
+        return self.fetch_question_data('dare')
     
-    def _record_request(self):
-        """Record a request timestamp."""
-        self.request_times.append(time.time())
+    def fetch_question_data(self, question_type, room_id=None):
+        """Fetch a question of the given type, for ``room_id`` if given; the built-in fallbacks have the id 'fallback'."""
+        return get_chain().fetch(question_type, room_id)
     
-    def fetch_truth_question(self):
-        """Fetch a truth question from the API."""
-        if not self._check_rate_limit():
-            # Return a fallback question if rate limited
-            return {
-                'id': 'fallback',
-                'type': 'truth',
-                'rating': self.rating,
-                'question': 'What is your biggest fear?'
-            }
-        
-        try:
-            url = f"{self.base_url}/truth"
-            params = {'rating': self.rating} if self.rating else {}
-            response = requests.get(url, params=params, timeout=5)
-            response.raise_for_status()
-            data = response.json()
-            self._record_request()
-            return data
-        except Exception as e:
-            # Return fallback on error
-            return {
-                'id': 'fallback',
-                'type': 'truth',
-                'rating': self.rating,
-                'question': 'What is your biggest fear?'
-            }
+    def fetch_question(self, question_type, room_id=None):
+        """Fetch a question of the given type and return its text."""
+        return self.fetch_question_data(question_type, room_id).get('question', 'No question available')
     
-    def fetch_dare_question(self):
-        """Fetch a dare question from the API."""
-        if not self._check_rate_limit():
-            # Return a fallback question if rate limited
-            return {
-                'id': 'fallback',
-                'type': 'dare',
-                'rating': self.rating,
-                'question': 'Do 10 jumping jacks.'
-            }
-        
-        try:
-            # Try /api/dare first, then fallback to /dare
-            urls = [f"{self.base_url}/api/dare", f"{self.base_url}/dare"]
-            params = {'rating': self.rating} if self.rating else {}
-            
-            for url in urls:
-                try:
-                    response = requests.get(url, params=params, timeout=5)
-                    response.raise_for_status()
-                    data = response.json()
-                    self._record_request()
-                    return data
-                except:
-                    continue
-            
-            # If all URLs fail, raise exception
-            raise Exception("All API endpoints failed")
-        except Exception as e:
-            # Return fallback on error
-            return {
-                'id': 'fallback',
-                'type': 'dare',
-                'rating': self.rating,
-                'question': 'Do 10 jumping jacks.'
-            }
+    def select_question(self, question_type, room_id=None):
+        """Fetch a question's text; return (text, source) with the source of the provider that served it."""
+        data, provider = get_chain().select(question_type, room_id)
+        return data.get('question', 'No question available'), provider.source
 
 
 class TurnManagementService:
-    """Service for managing game turns and flow."""
+    """
+    Service for managing game turns and flow. Moves are written straight
+    to the database, the turn state of ``'db'`` engine mode; only the
+    in-memory engine batches its writes (``writebehind``).
+    """
+    
+    @staticmethod
+    @serialized_write
+    def create_room(player_name, capacity):
+        """Create a room with its creator as the first player; return (room, player)."""
+        room = Room.objects.create(created_by=player_name, capacity=capacity)
+        player = Player.objects.create(
+            name=player_name,
+            room=room,
+            join_order=1
+        )
+        return room, player
+    
+    @staticmethod
+    @serialized_write
+    def add_player(room, player_name):
+        """Add a player to a room, or return None if it filled up meanwhile."""
+        if room.is_full():
+            return None
+        # After the last player in, even if players who left freed up numbers
+        last_join_order = room.players.aggregate(Max('join_order'))['join_order__max'] or 0
+        player = Player.objects.create(
+            name=player_name,
+            room=room,
+            join_order=last_join_order + 1
+        )
+        # Players joining a game in progress take their turn after everyone else
+        game_state = room.get_current_game_state()
+        if game_state:
+            game_state.add_player(player.id)
+        return player
     
     @staticmethod
+    @serialized_write
     def initialize_game(room):
-        """Initialize game state when 2 players join."""
+        """Initialize game state once at least ``MIN_PLAYERS`` have joined."""
         players = list(room.get_players())
-        if len(players) != 2:
+        if len(players) < MIN_PLAYERS:
             return None
         
         # Check if game state already exists
@@ -116,10 +102,19 @@ class TurnManagementService:
         game_state = GameState.objects.create(
             room=room,
             current_turn_player=players[0],
-            round_number=1
+            round_number=1,
+            turn_order=[player.id for player in players],
+            turn_index=0
         )
+        TurnManagementService.prefetch_for_turn(game_state)
         return game_state
     
+    @staticmethod
+    def prefetch_for_turn(game_state):
+        """Prefetch questions for the player whose turn just started, once committed."""
+        room_id, player_id = game_state.room_id, game_state.current_turn_player_id
+        transaction.on_commit(lambda: prefetcher.start_turn(room_id, player_id))
+    
     @staticmethod
     def get_current_question(room):
         """Get the current unanswered question for the room."""
@@ -130,7 +125,31 @@ class TurnManagementService:
         return Question.objects.filter(
             game_state=game_state,
             is_answered=False
-        ).first()
+        ).select_related('question_text').first()
+    
+    @staticmethod
+    @serialized_write
+    def choose(room, player_id, choice, question_text, source='API'):
+        """
+        Record the current player's truth/dare choice and its question,
+        saved with the ``source`` of the provider that served it. Returns
+        the question, or None if it isn't ``player_id``'s turn.
+        """
+        game_state = room.get_current_game_state()
+        if not game_state or game_state.current_turn_player_id != player_id:
+            return None
+        
+        game_state.current_choice = choice
+        game_state.is_waiting_for_question = True
+        game_state.save()
+        
+        return Question.objects.create(
+            room=room,
+            game_state=game_state,
+            question_text=QuestionText.intern(question_text),
+            question_type=choice,
+            source=source
+        )
     
     @staticmethod
     def create_question_from_api(room, question_type):
@@ -139,24 +158,19 @@ class TurnManagementService:
         if not game_state:
             return None
         
-        api_service = APIQuestionService()
-        
-        if question_type == 'truth':
-            api_data = api_service.fetch_truth_question()
-        else:
-            api_data = api_service.fetch_dare_question()
-        
-        question = Question.objects.create(
+        question_text, source = APIQuestionService().select_question(question_type, room.id)
+        question = serialized_write(Question.objects.create)(
             room=room,
             game_state=game_state,
-            text=api_data.get('question', 'No question available'),
+            question_text=QuestionText.intern(question_text),
             question_type=question_type,
-            source='API'
+            source=source
         )
         
         return question
     
     @staticmethod
+    @serialized_write
     def create_admin_question(room, question_text, question_type):
         """Create an admin-injected question."""
         game_state = room.get_current_game_state()
@@ -172,7 +186,7 @@ class TurnManagementService:
         question = Question.objects.create(
             room=room,
             game_state=game_state,
-            text=question_text,
+            question_text=QuestionText.intern(question_text),
             question_type=question_type,
             source='ADMIN'
         )
@@ -180,6 +194,72 @@ class TurnManagementService:
         return question
     
     @staticmethod
+    @serialized_write
+    def bulk_create_admin_questions(rooms, question_text, question_type):
+        """
+        Inject the same admin question into every room in ``rooms`` that has
+        a game in progress. Open questions are closed in one UPDATE and the
+        new ones inserted with one ``bulk_create``. Rooms whose state lives
+        in an in-memory engine on this worker are injected through it.
+        Returns a list of (room_code, question_data).
+        """
+        targets = list(
+            rooms.annotate(game_state_id=latest_game_state_id('pk'))
+            .exclude(game_state_id=None)
+            .values_list('id', 'code', 'game_state_id')
+        )
+        
+        injected = []
+        if engine_enabled():
+            remaining = []
+            queued = []
+            for room_id, code, game_state_id in targets:
+                engine = engine_store.peek(room_id)
+                if engine is None:
+                    remaining.append((room_id, code, game_state_id))
+                    continue
+                question = engine.queue_question(question_text, question_type)
+                if question:
+                    queued.append((code, question))
+            # One flush for every engine room still waiting for its question's id
+            if any(question.pk is None for code, question in queued):
+                writer.flush()
+            injected.extend((code, question_payload(question)) for code, question in queued)
+            targets = remaining
+        if not targets:
+            return injected
+        
+        text = QuestionText.intern(question_text)
+        with transaction.atomic():
+            Question.objects.filter(
+                room_id__in=[room_id for room_id, code, game_state_id in targets],
+                is_answered=False,
+                game_state_id=latest_game_state_id('room_id')
+            ).update(is_answered=True)
+            questions = Question.objects.bulk_create([
+                Question(
+                    room_id=room_id,
+                    game_state_id=game_state_id,
+                    question_text=text,
+                    question_type=question_type,
+                    source='ADMIN'
+                )
+                for room_id, code, game_state_id in targets
+            ])
+        
+        # Bulk writes send no signals; pin the rooms to the primary here
+        note_room_writes([room_id for room_id, code, game_state_id in targets])
+        for (room_id, code, game_state_id), question in zip(targets, questions):
+            injected.append((code, {
+                'id': question.id,
+                'text': question.text,
+                'type': question.question_type,
+                'source': question.source
+            }))
+        return injected
+    
+    @staticmethod
+    @serialized_write
     def submit_answer(room, player, answer_text):
         """Submit an answer to the current question."""
         game_state = room.get_current_game_state()
@@ -206,6 +286,7 @@ class TurnManagementService:
         return answer
     
     @staticmethod
+    @serialized_write
     def next_round(room):
         """Move to the next round after viewing the answer."""
         game_state = room.get_current_game_state()
@@ -217,5 +298,96 @@ class TurnManagementService:
         game_state.is_waiting_for_question = False
         game_state.current_choice = None
         game_state.save()
+        TurnManagementService.prefetch_for_turn(game_state)
         
         return game_state
+    
+    @staticmethod
+    @serialized_write
+    def remove_player(player):
+        """Remove a departed player, passing their turn on if it was theirs."""
+        if engine_enabled():
+            # Land the engine's queued moves first; it reloads on next use
+            writer.flush()
+            engine_store.evict(player.room_id)
+        game_state = player.room.get_current_game_state()
+        if game_state:
+            game_state.remove_player(player.id)
+        player_id = player.id
+        player.delete()
+        transaction.on_commit(lambda: revoke_player_tokens(player_ids=[player_id]))
+
+
+class RoomStateService:
+    """Service for building the room state pushed to clients."""
+    
+    @staticmethod
+    def build_snapshot(room_id):
+        """
+        Build the full room state for a room in a fixed four queries:
+        room, players, latest game state (with current player) and the
+        current unanswered question. In engine mode the state comes from the
+        room's in-memory engine instead.
+        """
+        if engine_enabled():
+            engine = get_engine(room_id)
+            return engine.snapshot() if engine else None
+
+        room = (
+            Room.objects.filter(pk=room_id, is_active=True)
+            .values('code', 'is_active', 'capacity')
+            .first()
+        )
+        if not room:
+            return None
+        
+        players_data = list(
+            Player.objects.filter(room_id=room_id)
+            .order_by('join_order')
+            .values('id', 'name', 'join_order')
+        )
+        
+        game_state = (
+            GameState.objects.filter(room_id=room_id)
+            .select_related('current_turn_player')
+            .first()
+        )
+        game_state_data = None
+        if game_state:
+            current_player = game_state.current_turn_player
+            game_state_data = {
+                'round_number': game_state.round_number,
+                'current_turn_player_id': game_state.current_turn_player_id,
+                'current_turn_player_name': current_player.name if current_player else None,
+                'current_choice': game_state.current_choice,
+                'is_waiting_for_question': game_state.is_waiting_for_question,
+                'is_waiting_for_answer': game_state.is_waiting_for_answer
+            }
+        
+        question = (
+            Question.objects.filter(room_id=room_id, is_answered=False)
+            .filter(game_state_id=latest_game_state_id('room_id'))
+            .values('id', 'question_type', 'source', text=F('question_text__text'))
+            .first()
+        )
+        current_question = None
+        if question:
+            current_question = {
+                'id': question['id'],
+                'text': question['text'],
+                'type': question['question_type'],
+                'source': question['source']
+            }
+        
+        return {
+            'type': 'room_state',
+            'room': {
+                'code': room['code'],
+                'is_active': room['is_active'],
+                'is_full': len(players_data) >= room['capacity'],
+                'capacity': room['capacity']
+            },
+            'players': players_data,
+            'game_state': game_state_data,
+            'current_question': current_question
+        }
@@ -0,0 +1,110 @@
+"""
+Worker-local fan-out to spectators.
+
+Rather than every spectator socket joining the room's spectator group,
+each worker joins it once per watched room through a relay channel and
+forwards every message to its own spectator sockets. The channel layer
+carries one copy of a broadcast per worker instead of one per spectator,
+and the frames are forwarded already encoded. A relay whose receive fails
+logs it and tries again ``RELAY_RETRY_SECONDS`` later, rather than leaving
+the room's spectators without updates.
+"""
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+
+from . import metrics
+from .push import publisher, spectator_group
+
+logger = logging.getLogger(__name__)
+
+# Pause before a relay receives again after the channel layer failed
+RELAY_RETRY_SECONDS = 1
+
+
+class RoomAudience:
+    """The spectators of one room on this worker and their relay channel."""
+    __slots__ = ('room_code', 'members', 'channel', 'ready', 'task')
+
+    def __init__(self, room_code):
+        self.room_code = room_code
+        self.members = set()
+        self.channel = None
+        self.ready = asyncio.get_running_loop().create_future()
+        self.task = None
+
+    async def start(self):
+        layer = get_channel_layer()
+        self.channel = await layer.new_channel()
+        await layer.group_add(spectator_group(self.room_code), self.channel)
+        self.task = asyncio.get_running_loop().create_task(self._relay(layer))
+        self.ready.set_result(None)
+
+    async def stop(self):
+        self.task.cancel()
+        await get_channel_layer().group_discard(spectator_group(self.room_code), self.channel)
+
+    async def _relay(self, layer):
+        while True:
+            try:
+                message = await layer.receive(self.channel)
+            except Exception:
+                # The relay is the room's only feed on this worker; keep it going
+                metrics.incr('spectators.relay_failed')
+                logger.exception('Spectator relay for room %s failed, retrying', self.room_code)
+                await asyncio.sleep(RELAY_RETRY_SECONDS)
+                continue
+            if message['type'] == 'room_state':
+                # Pushes from other workers keep the state sent to new spectators current
+                publisher.remember(self.room_code, message)
+            for member in list(self.members):
+                try:
+                    await member.forward(message)
+                except Exception:
+                    logger.exception('Forwarding to a spectator failed')
+            metrics.incr('spectators.relayed')
+            metrics.incr('spectators.delivered', len(self.members))
+
+
+class SpectatorHub:
+    """Audiences for every room watched on this worker."""
+
+    def __init__(self):
+        self.rooms = {}
+
+    async def join(self, room_code, consumer):
+        """Add a spectator, starting the room's relay if it is the first."""
+        while True:
+            audience = self.rooms.get(room_code)
+            if audience is None:
+                audience = self.rooms[room_code] = RoomAudience(room_code)
+                try:
+                    await audience.start()
+                except BaseException as exc:
+                    del self.rooms[room_code]
+                    audience.ready.set_exception(exc)
+                    raise
+            else:
+                await asyncio.shield(audience.ready)
+            # The relay may have been stopped while this spectator waited
+            if self.rooms.get(room_code) is audience:
+                audience.members.add(consumer)
+                return
+
+    async def leave(self, room_code, consumer):
+        """Remove a spectator, stopping the room's relay after the last one."""
+        audience = self.rooms.get(room_code)
+        if audience is None:
+            return
+        audience.members.discard(consumer)
+        if not audience.members and audience.ready.done():
+            del self.rooms[room_code]
+            await audience.stop()
+
+    def count(self, room_code):
+        audience = self.rooms.get(room_code)
+        return len(audience.members) if audience else 0
+
+
+hub = SpectatorHub()
@@ -0,0 +1,205 @@
+"""
+Single-writer mode for SQLite deployments.
+
+SQLite allows one writer at a time. Concurrent requests and consumers that
+write, and especially transactions that read before they write, fail with
+"database is locked" once they outlast the busy timeout. With
+``GAME_SQLITE_SINGLE_WRITER`` set and SQLite as the default database:
+
+* every connection is switched to WAL with ``synchronous=NORMAL`` and a
+  busy timeout, so reads never wait for the writer; and
+* game writes, the service methods wrapped in ``serialized_write``, run on
+  one writer thread per process. It takes whatever has queued up (at most
+  ``GAME_SQLITE_WRITE_BATCH`` writes) and commits them in one transaction,
+  each in its own savepoint so a failing write only undoes itself.
+
+Callers block until the batch holding their write has committed, so they
+read their own writes afterwards. Writes made on the writer thread (a
+serialized write calling another) run inline.
+
+Every write to a game table goes through the writer: the services, the
+engine's game state, presence sweeps, the standalone views, interned
+question texts and profile records. The admin writes its log entry in the
+same transaction as the change, so its views can't hand the change to
+another thread; they hold the writer with ``exclusive_writes()`` instead
+and write on their own connection meanwhile. Other writes to Django's own
+tables (sessions, users) are rare and wait out the busy timeout.
+"""
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def single_writer_enabled():
+    return (
+        getattr(settings, 'GAME_SQLITE_SINGLE_WRITER', False)
+        and connections['default'].vendor == 'sqlite'
+    )
+
+
+def configure_connection(sender, connection, **kwargs):
+    """``connection_created`` receiver applying the single-writer pragmas."""
+    if connection.vendor != 'sqlite' or not getattr(settings, 'GAME_SQLITE_SINGLE_WRITER', False):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f"PRAGMA busy_timeout={int(getattr(settings, 'GAME_SQLITE_BUSY_TIMEOUT_MS', 5000))}")
+        cursor.execute('PRAGMA temp_store=MEMORY')
+
+
+class WriteJob:
+    __slots__ = ('func', 'args', 'kwargs', 'done', 'result', 'error', 'exclusive')
+
+    def __init__(self, func, args, kwargs, exclusive=False):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Run alone and outside any transaction
+        self.exclusive = exclusive
+
+
+class WriteQueue:
+    """Runs queued writes on one thread, committing them in batches."""
+
+    def __init__(self, name='sqlite-writer'):
+        self.name = name
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        # Thread inside ``hold()``, whose writes run inline meanwhile
+        self._holder = None
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def run(self, func, *args, **kwargs):
+        """Run ``func`` on the writer thread and return once its batch has committed."""
+        if threading.current_thread() in (self._thread, self._holder):
+            return func(*args, **kwargs)
+        self._start()
+        job = WriteJob(func, args, kwargs)
+        submitted = time.perf_counter()
+        self._queue.put(job)
+        job.done.wait()
+        metrics.observe(f'{self.name}.latency', time.perf_counter() - submitted)
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    @contextmanager
+    def hold(self):
+        """
+        Keep the writer idle, between batches, for the duration of the block,
+        so the calling thread can run a transaction of its own without
+        contending with it. Serialized writes made inside the block run
+        inline on the calling thread.
+        """
+        if threading.current_thread() in (self._thread, self._holder):
+            yield
+            return
+        self._start()
+        held = threading.Event()
+        released = threading.Event()
+
+        def wait():
+            held.set()
+            released.wait()
+
+        job = WriteJob(wait, (), {}, exclusive=True)
+        self._queue.put(job)
+        held.wait()
+        self._holder = threading.current_thread()
+        metrics.incr(f'{self.name}.holds')
+        try:
+            yield
+        finally:
+            self._holder = None
+            released.set()
+            job.done.wait()
+
+    def _run(self):
+        limit = getattr(settings, 'GAME_SQLITE_WRITE_BATCH', 64)
+        pending = None
+        while True:
+            job, pending = pending or self._queue.get(), None
+            if job.exclusive:
+                try:
+                    job.func(*job.args, **job.kwargs)
+                finally:
+                    job.done.set()
+                continue
+            batch = [job]
+            while len(batch) < limit:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job.exclusive:
+                    pending = job
+                    break
+                batch.append(job)
+            try:
+                self._commit(batch)
+            finally:
+                for job in batch:
+                    job.done.set()
+
+    def _commit(self, batch):
+        try:
+            with transaction.atomic():
+                for job in batch:
+                    try:
+                        with transaction.atomic():
+                            job.result = job.func(*job.args, **job.kwargs)
+                    except Exception as exc:
+                        job.error = exc
+        except Exception as exc:
+            logger.exception('%s commit of %d writes failed', self.name, len(batch))
+            for job in batch:
+                job.result = None
+                job.error = job.error or exc
+            connections['default'].close_if_unusable_or_obsolete()
+            return
+        metrics.incr(f'{self.name}.batches')
+        metrics.incr(f'{self.name}.writes', len(batch))
+
+
+write_queue = WriteQueue()
+
+
+def serialized_write(func):
+    """Run ``func`` through the single writer when the mode is on, else directly."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not single_writer_enabled():
+            return func(*args, **kwargs)
+        return write_queue.run(func, *args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def exclusive_writes():
+    """Hold the single writer for the block when the mode is on, else do nothing."""
+    if not single_writer_enabled():
+        yield
+        return
+    with write_queue.hold():
+        yield
@@ -0,0 +1,1227 @@
+import asyncio
+import datetime
+import decimal
+import json
+import tempfile
+import time
+import uuid
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import (
+    admission, dbpool, encoding, metrics, models, presence, ratelimit, replicas, routing, spectators, sqlite,
+    warmup, writebehind,
+)
+from .admission import AdmissionController
+from .backends.sqlite3.base import DatabaseWrapper as PooledSQLiteWrapper
+from .engine import get_engine, store as engine_store
+from .ids import reserve_ids
+from .metrics import traced_sync_to_async
+from .models import Room, Player, GameState, Question, QuestionText, Answer, StandaloneRequest
+from .norepeat import next_index, return_index
+from .prefetch import Candidate, QuestionPrefetcher
+from .providers import LocalCorpusProvider, ProviderChain
+from .push import event_buffer, mark_room_dirty, publisher, send_to_room
+from .services import RoomStateService, TurnManagementService, latest_game_state_id
+from .presence import PresenceTracker, release_rooms
+from .profiling import is_profile_requested
+from .ratelimit import BucketRegistry, TokenBucket
+from .tokens import issue_player_token, read_player_token
+from .writebehind import BufferedWriter, writer
+
+application = URLRouter(routing.websocket_urlpatterns)
+
+
+async def receive_frame(communicator, frame_type):
+    """Return the next frame of ``frame_type``, skipping presence and other pushes."""
+    while True:
+        frame = await communicator.receive_json_from()
+        if frame['type'] == frame_type:
+            return frame
+
+
+def executor_hops():
+    """Number of sync executor hops since the last ``metrics.reset()``."""
+    return metrics.snapshot()['timings_ms'].get('sync_executor.wait', {}).get('count', 0)
+
+
+@override_settings(GAME_TRACING_ENABLED=True, GAME_TRACING_SLOW_EVENT_MS=250)
+class TracingTests(TransactionTestCase):
+    """Spans break events down into executor wait, queries and sends."""
+
+    def setUp(self):
+        metrics.reset()
+
+    async def test_span_records_executor_hop_and_queries(self):
+        with metrics.span('test.event') as current:
+            await traced_sync_to_async(lambda: list(Room.objects.all()))()
+        self.assertEqual(current.queries, 1)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters']['test.event.count'], 1)
+        self.assertEqual(snapshot['counters']['test.event.queries'], 1)
+        for part in ('total', 'queue', 'db'):
+            self.assertEqual(snapshot['timings_ms'][f'test.event.{part}']['count'], 1)
+        self.assertEqual(executor_hops(), 1)
+        self.assertEqual(snapshot['gauges']['sync_executor.queued'], 0)
+        self.assertEqual(snapshot['gauges']['sync_executor.busy'], 0)
+        self.assertEqual(snapshot['gauge_peaks']['sync_executor.busy'], 1)
+
+    def test_slow_event_is_logged(self):
+        with override_settings(GAME_TRACING_SLOW_EVENT_MS=0):
+            with self.assertLogs('game.metrics', 'WARNING') as logs:
+                with metrics.span('test.event'):
+                    with metrics.timed('send'):
+                        pass
+        self.assertIn('Slow event test.event', logs.output[0])
+        self.assertIn('send=', logs.output[0])
+
+    def test_disabled_tracing_records_nothing(self):
+        with override_settings(GAME_TRACING_ENABLED=False):
+            with metrics.span('test.event') as current:
+                with metrics.timed('send'):
+                    pass
+        self.assertIsNone(current)
+        self.assertEqual(metrics.snapshot()['counters'], {})
+
+    def test_metrics_endpoint_is_staff_only(self):
+        user = User.objects.create_user('alice', password='secret')
+        self.client.force_login(user)
+        response = self.client.get('/api/admin/metrics/', secure=True)
+        self.assertEqual(response.status_code, 403)
+
+        User.objects.filter(pk=user.pk).update(is_staff=True)
+        metrics.incr('test.counter')
+        response = self.client.get('/api/admin/metrics/', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['counters']['test.counter'], 1)
+
+
+class EncodingTests(TestCase):
+    """Every JSON backend encodes the same frames, and broadcasts are encoded once."""
+
+    frame = {
+        'type': 'question_sent',
+        'question': {'id': 1, 'text': 'Qué es lo más raro que has comido?', 'source': 'API'},
+        'at': datetime.datetime(2026, 1, 2, 3, 4, 5),
+        'score': decimal.Decimal('1.5'),
+    }
+
+    def use_backend(self, name):
+        encoding._backend = None
+        self.addCleanup(setattr, encoding, '_backend', None)
+        with override_settings(GAME_JSON_BACKEND=name):
+            return encoding.get_backend()[0]
+
+    def test_backends_round_trip(self):
+        expected = json.loads(json.dumps(self.frame, cls=DjangoJSONEncoder))
+        for name in ('orjson', 'ujson', 'json'):
+            with self.subTest(backend=name):
+                self.use_backend(name)
+                self.assertEqual(encoding.loads(encoding.dumps(self.frame)), expected)
+                self.assertEqual(encoding.loads(encoding.dumps_bytes(self.frame)), expected)
+
+    def test_missing_backend_falls_back_to_json(self):
+        with mock.patch.object(encoding, 'orjson', None):
+            self.assertEqual(self.use_backend('orjson'), 'json')
+
+    def test_group_message_is_encoded_once(self):
+        message = encoding.group_message('question_sent', self.frame, room_code='ABC123')
+        self.assertEqual(message['type'], 'question_sent')
+        self.assertEqual(message['room_code'], 'ABC123')
+        self.assertEqual(message['text'], encoding.dumps(self.frame))
+
+    def test_json_response(self):
+        response = encoding.JsonResponse({'success': True})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.content), {'success': True})
+        with self.assertRaises(TypeError):
+            encoding.JsonResponse([1, 2])
+
+
+@skipUnless(encoding.msgpack, 'msgpack is not installed')
+@override_settings(GAME_QUESTION_PREFETCH=False, GAME_WS_BINARY_ENABLED=True)
+class SubprotocolTests(TransactionTestCase):
+    """Clients that negotiate td.msgpack.v1 get MessagePack frames with short field ids."""
+
+    frame = {'type': 'question_sent', 'question': {'id': 1, 'text': 'Why?', 'extra': [1, 2]}}
+
+    async def receive_packed(self, communicator, frame_type):
+        while True:
+            frame = encoding.unpack(await communicator.receive_from())
+            if frame['type'] == frame_type:
+                return frame
+
+    def test_pack_round_trip(self):
+        packed = encoding.pack(self.frame)
+        self.assertEqual(encoding.msgpack.unpackb(packed)['t'], 'question_sent')
+        self.assertEqual(encoding.unpack(packed), self.frame)
+        self.assertLess(len(packed), len(encoding.dumps_bytes(self.frame)))
+
+    def test_negotiation(self):
+        offered = [encoding.MSGPACK_SUBPROTOCOL, encoding.JSON_SUBPROTOCOL]
+        self.assertEqual(encoding.negotiate_subprotocol(offered), encoding.MSGPACK_SUBPROTOCOL)
+        self.assertIsNone(encoding.negotiate_subprotocol([]))
+        with override_settings(GAME_WS_BINARY_ENABLED=False):
+            self.assertEqual(encoding.negotiate_subprotocol(offered), encoding.JSON_SUBPROTOCOL)
+            self.assertNotIn('packed', encoding.group_message('question_sent', self.frame))
+        self.assertEqual(encoding.group_message('question_sent', self.frame)['packed'], encoding.pack(self.frame))
+
+    async def test_binary_socket(self):
+        room = await Room.objects.acreate(created_by='alice')
+        alice = await Player.objects.acreate(name='alice', room=room, join_order=1)
+        communicator = WebsocketCommunicator(
+            application, f'/ws/room/{room.code}/?token={issue_player_token(room, alice)}',
+            subprotocols=[encoding.MSGPACK_SUBPROTOCOL]
+        )
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual(subprotocol, encoding.MSGPACK_SUBPROTOCOL)
+
+        hello = encoding.msgpack.unpackb(await communicator.receive_from())
+        self.assertEqual(hello['fields'], encoding.FIELD_IDS)
+        frame = await self.receive_packed(communicator, 'room_state')
+        self.assertEqual(frame['players'][0]['name'], 'alice')
+
+        await communicator.send_to(bytes_data=encoding.pack({'type': 'heartbeat'}))
+        await self.receive_packed(communicator, 'heartbeat_ack')
+        await communicator.disconnect()
+
+
+@override_settings(GAME_QUESTION_PREFETCH=False)
+class BroadcastTests(TransactionTestCase):
+    """Room sockets forward a broadcast's pre-encoded text unchanged."""
+
+    async def test_broadcast_text_is_forwarded_as_is(self):
+        room = await Room.objects.acreate(created_by='alice')
+        alice = await Player.objects.acreate(name='alice', room=room, join_order=1)
+        token = issue_player_token(room, alice)
+        communicator = WebsocketCommunicator(application, f'/ws/room/{room.code}/?token={token}')
+        await communicator.connect()
+        await receive_frame(communicator, 'room_state')
+
+        message = encoding.group_message('question_sent', {'type': 'question_sent', 'question': None})
+        # Whitespace a re-encode would drop shows the text went out untouched
+        message['text'] = message['text'].replace('null', ' null ')
+        await send_to_room(room.code, message)
+        while True:
+            text = await communicator.receive_from()
+            if 'question_sent' in text:
+                break
+        self.assertEqual(text, message['text'])
+        await communicator.disconnect()
+
+
+@override_settings(GAME_QUESTION_PREFETCH=False, GAME_TRACING_ENABLED=True)
+class RoomStateTests(TransactionTestCase):
+    """``send_room_state`` is one executor hop and a fixed number of queries."""
+
+    def setUp(self):
+        # Tables are flushed between tests; forget the text ids cached by intern
+        models._interned.clear()
+        self.room = Room.objects.create(created_by='alice')
+        self.alice = Player.objects.create(name='alice', room=self.room, join_order=1)
+        self.bob = Player.objects.create(name='bob', room=self.room, join_order=2)
+        self.token = issue_player_token(self.room, self.alice)
+
+    def start_game(self):
+        game_state = GameState.objects.create(
+            room=self.room,
+            current_turn_player=self.alice,
+            turn_order=[self.alice.id, self.bob.id],
+        )
+        Question.objects.create(
+            room=self.room,
+            game_state=game_state,
+            question_text=QuestionText.intern('What is your biggest fear?'),
+            question_type='truth',
+            source='API'
+        )
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(application, f'/ws/room/{self.room.code}/?token={self.token}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_connect_with_token_is_one_hop(self):
+        metrics.reset()
+        communicator = await self.connect()
+        await receive_frame(communicator, 'room_state')
+        # The token carries the room and player, so only the snapshot is read
+        self.assertEqual(executor_hops(), 1)
+        await communicator.disconnect()
+
+    async def test_get_state_is_one_hop_with_fixed_queries(self):
+        communicator = await self.connect()
+        await receive_frame(communicator, 'room_state')
+
+        for started in (False, True):
+            if started:
+                await sync_to_async(self.start_game)()
+            metrics.reset()
+            await communicator.send_json_to({'type': 'get_state'})
+            state = await receive_frame(communicator, 'room_state')
+            self.assertEqual(executor_hops(), 1)
+            self.assertEqual(metrics.snapshot()['counters']['ws.get_state.queries'], 4)
+        self.assertEqual(state['current_question']['text'], 'What is your biggest fear?')
+        await communicator.disconnect()
+
+    def test_build_snapshot_query_count(self):
+        for started in (False, True):
+            if started:
+                self.start_game()
+            with CaptureQueriesContext(connection) as queries:
+                state = RoomStateService.build_snapshot(self.room.id)
+            self.assertEqual(len(queries), 4)
+        self.assertEqual([player['name'] for player in state['players']], ['alice', 'bob'])
+        self.assertEqual(state['game_state']['current_turn_player_name'], 'alice')
+        self.assertEqual(state['current_question']['type'], 'truth')
+
+    def test_build_snapshot_of_missing_room(self):
+        Room.objects.filter(pk=self.room.pk).update(is_active=False)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIsNone(RoomStateService.build_snapshot(self.room.id))
+        self.assertEqual(len(queries), 1)
+
+
+@override_settings(GAME_QUESTION_PREFETCH=False)
+class HttpMoveTests(TransactionTestCase):
+    """Moves made over HTTP reach the other players' sockets."""
+
+    def setUp(self):
+        models._interned.clear()
+        self.room = Room.objects.create(created_by='alice')
+        self.alice = Player.objects.create(name='alice', room=self.room, join_order=1)
+        self.bob = Player.objects.create(name='bob', room=self.room, join_order=2)
+        GameState.objects.create(
+            room=self.room,
+            current_turn_player=self.alice,
+            turn_order=[self.alice.id, self.bob.id],
+        )
+        chain = ProviderChain([(LocalCorpusProvider(), 1)])
+        patcher = mock.patch('game.providers._chain', chain)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, path, data):
+        return self.client.post(
+            f'/api/room/{self.room.code}/{path}/', data, secure=True,
+            HTTP_X_PLAYER_TOKEN=issue_player_token(self.room, self.alice)
+        )
+
+    async def test_http_moves_are_pushed(self):
+        token = issue_player_token(self.room, self.bob)
+        communicator = WebsocketCommunicator(application, f'/ws/room/{self.room.code}/?token={token}')
+        await communicator.connect()
+        await receive_frame(communicator, 'room_state')
+
+        response = await sync_to_async(self.post)('choose', {'choice': 'truth'})
+        self.assertEqual(response.status_code, 200)
+        sent = await receive_frame(communicator, 'question_sent')
+        self.assertEqual(sent['question']['text'], response.json()['question']['text'])
+        # Saved with the provider that served it
+        self.assertEqual(sent['question']['source'], 'LOCAL')
+        source = await Question.objects.values_list('source', flat=True).aget(pk=sent['question']['id'])
+        self.assertEqual(source, 'LOCAL')
+        state = await receive_frame(communicator, 'room_state')
+        self.assertEqual(state['game_state']['current_choice'], 'truth')
+
+        response = await sync_to_async(self.post)('answer', {'answer_text': 'Spiders'})
+        self.assertEqual(response.status_code, 200)
+        await receive_frame(communicator, 'answer_submitted')
+        state = await receive_frame(communicator, 'room_state')
+        self.assertIsNone(state['current_question'])
+
+        response = await sync_to_async(self.post)('next-round', {})
+        self.assertEqual(response.status_code, 200)
+        state = await receive_frame(communicator, 'room_state')
+        self.assertEqual(state['game_state']['current_turn_player_id'], self.bob.id)
+        await communicator.disconnect()
+
+
+@override_settings(GAME_WRITE_BEHIND_INTERVAL_MS=60000, GAME_QUESTION_PREFETCH=False)
+class WriteBehindTests(TransactionTestCase):
+    """Queued rows land parents first, and a bad room doesn't hold back the others."""
+
+    def setUp(self):
+        models._interned.clear()
+        self.writer = BufferedWriter('test-writebehind')
+        self.text = QuestionText.intern('What is your biggest fear?')
+
+    def make_room(self, name):
+        room = Room.objects.create(created_by=name)
+        player = Player.objects.create(name=name, room=room, join_order=1)
+        return room, player
+
+    def queue_turn(self, room, player, player_id=None):
+        """Queue a game state, a question and an answer, children first."""
+        game_state = GameState(room=room, current_turn_player=player, turn_order=[player.id])
+        question = Question(
+            room=room, game_state=game_state, question_text=self.text, question_type='truth', source='API'
+        )
+        answer = Answer(question=question, player_id=player_id or player.id, answer_text='Spiders')
+        for obj in (answer, question, game_state):
+            self.writer.create(obj)
+        return game_state, question, answer
+
+    def test_children_queued_first_are_inserted_after_parents(self):
+        room, player = self.make_room('alice')
+        game_state, question, answer = self.queue_turn(room, player)
+        self.assertEqual(self.writer.flush(), 3)
+        self.assertEqual(Answer.objects.get().question_id, question.pk)
+        self.assertEqual(Question.objects.get().game_state_id, game_state.pk)
+
+    def test_reserved_keys_survive_a_failed_batch(self):
+        room, player = self.make_room('alice')
+        game_state = GameState(room=room, current_turn_player=player, turn_order=[player.id])
+        question = Question(
+            id=reserve_ids(Question, 1)[0], room=room, game_state=game_state,
+            question_text=self.text, question_type='truth', source='API'
+        )
+        reserved = question.pk
+        self.writer.create(game_state)
+        self.writer.create(question)
+        self.writer.create(Answer(question=question, player_id=10 ** 9, answer_text='Spiders'))
+        with self.assertLogs('game.writebehind', 'ERROR'):
+            self.writer.flush()
+        # Nothing is left for the writer's thread to retry later on
+        self.writer._creates.clear()
+        self.assertIsNone(game_state.pk)
+        self.assertEqual(question.pk, reserved)
+        self.assertFalse(Question.objects.exists())
+
+    def test_failing_room_is_isolated(self):
+        good_room, good_player = self.make_room('alice')
+        bad_room, bad_player = self.make_room('bob')
+        self.queue_turn(bad_room, bad_player, player_id=10 ** 9)
+        self.queue_turn(good_room, good_player)
+
+        with self.assertLogs('game.writebehind', 'ERROR'):
+            self.assertEqual(self.writer.flush(), 3)
+        self.assertEqual(Question.objects.get().room_id, good_room.id)
+        # The bad room's rows are retried, then dropped
+        with self.assertLogs('game.writebehind', 'ERROR') as logs:
+            for attempt in range(writebehind.MAX_RETRIES - 1):
+                self.assertEqual(self.writer.flush(), 0)
+        self.assertIn(f'dropped 3 rows for room {bad_room.id}', logs.output[-1])
+        self.assertEqual(self.writer._pending, 0)
+        self.assertFalse(Question.objects.filter(room=bad_room).exists())
+
+
+@override_settings(GAME_ENGINE_MODE='memory', GAME_QUESTION_PREFETCH=False)
+class EngineQuestionTests(TransactionTestCase):
+
+    def setUp(self):
+        models._interned.clear()
+        self.room = Room.objects.create(created_by='alice')
+        self.alice = Player.objects.create(name='alice', room=self.room, join_order=1)
+        Player.objects.create(name='bob', room=self.room, join_order=2)
+        self.addCleanup(engine_store.evict, self.room.id)
+
+    def test_chosen_question_payload_has_its_id(self):
+        engine = get_engine(self.room.id)
+        engine.start()
+        # Hold off the background flush until the moves are checked
+        with writer._flush_lock:
+            with CaptureQueriesContext(connection) as queries:
+                question = engine.choose(self.alice.id, 'truth', 'What is your biggest fear?')
+                engine.choose(self.alice.id, 'dare', 'Do 10 jumping jacks.')
+            # The id was reserved ahead; the row is only written by the next flush
+            self.assertIsNotNone(question['id'])
+            self.assertFalse(Question.objects.exists())
+            self.assertFalse([query for query in queries if 'INSERT INTO "game_question" ' in query['sql']])
+        writer.flush()
+        self.assertEqual(Question.objects.order_by('id').first().pk, question['id'])
+
+    def test_reserved_ids_are_not_reused(self):
+        engine = get_engine(self.room.id)
+        engine.start()
+        with writer._flush_lock:
+            question = engine.choose(self.alice.id, 'truth', 'What is your biggest fear?')
+            # A row inserted the usual way meanwhile gets an id past the reserved block
+            other = Question.objects.create(
+                room=self.room, game_state=GameState.objects.get(room=self.room), question_text=QuestionText.intern('Why?'), question_type='truth', source='API'
+            )
+        self.assertGreater(other.pk, question['id'])
+        writer.flush()
+        self.assertEqual(Question.objects.filter(pk=question['id']).get().text, 'What is your biggest fear?')
+
+
+@override_settings(GAME_QUESTION_PREFETCH=False)
+class TurnRotationTests(TestCase):
+    """Turns rotate through any number of players, joining and leaving included."""
+
+    def make_room(self, players):
+        room, player = TurnManagementService.create_room('player-1', players)
+        for number in range(2, players + 1):
+            TurnManagementService.add_player(room, f'player-{number}')
+        return room
+
+    def turns(self, room, count):
+        """Player names on turn for the next ``count`` turns, and the final round number."""
+        names = []
+        for turn in range(count):
+            game_state = room.get_current_game_state()
+            names.append(game_state.current_turn_player.name)
+            TurnManagementService.next_round(room)
+        return names, room.get_current_game_state().round_number
+
+    def test_rotation_for_2_to_50_players(self):
+        for players in (2, 3, 7, 50):
+            with self.subTest(players=players):
+                room = self.make_room(players)
+                TurnManagementService.initialize_game(room)
+                names, round_number = self.turns(room, players * 2)
+                expected = [f'player-{number}' for number in range(1, players + 1)]
+                self.assertEqual(names, expected * 2)
+                self.assertEqual(round_number, 3)
+
+    def test_game_starts_before_the_room_is_full(self):
+        room, player = TurnManagementService.create_room('player-1', 6)
+        self.assertIsNone(TurnManagementService.initialize_game(room))
+        for number in (2, 3):
+            TurnManagementService.add_player(room, f'player-{number}')
+        self.assertIsNotNone(TurnManagementService.initialize_game(room))
+        names, round_number = self.turns(room, 3)
+        self.assertEqual(names, ['player-1', 'player-2', 'player-3'])
+        self.assertEqual(round_number, 2)
+
+    def test_join_mid_game_takes_the_last_turn(self):
+        room = self.make_room(3)
+        TurnManagementService.initialize_game(room)
+        self.turns(room, 1)
+        Room.objects.filter(pk=room.pk).update(capacity=4)
+        room.refresh_from_db()
+        TurnManagementService.add_player(room, 'player-4')
+        names = self.turns(room, 6)[0]
+        self.assertEqual(names, ['player-2', 'player-3', 'player-4', 'player-1', 'player-2', 'player-3'])
+
+    def test_removing_the_current_player_passes_the_turn(self):
+        room = self.make_room(4)
+        TurnManagementService.initialize_game(room)
+        self.turns(room, 1)
+        TurnManagementService.remove_player(room.players.get(name='player-2'))
+        names = self.turns(room, 4)[0]
+        self.assertEqual(names, ['player-3', 'player-4', 'player-1', 'player-3'])
+
+    def test_removing_the_last_player_in_order_wraps_to_a_new_round(self):
+        room = self.make_room(3)
+        TurnManagementService.initialize_game(room)
+        self.turns(room, 2)
+        TurnManagementService.remove_player(room.players.get(name='player-3'))
+        game_state = room.get_current_game_state()
+        self.assertEqual(game_state.current_turn_player.name, 'player-1')
+        self.assertEqual(game_state.round_number, 2)
+
+    def test_join_order_after_a_player_left(self):
+        room = self.make_room(3)
+        TurnManagementService.remove_player(room.players.get(name='player-2'))
+        player = TurnManagementService.add_player(room, 'player-4')
+        self.assertEqual(player.join_order, 4)
+        self.assertEqual(
+            list(room.get_players().values_list('join_order', flat=True)), [1, 3, 4]
+        )
+
+
+@override_settings(GAME_QUESTION_PREFETCH=False)
+class BulkInjectionTests(TransactionTestCase):
+    """One admin question reaches every running game, and the rooms written are pinned."""
+
+    def setUp(self):
+        models._interned.clear()
+        cache.clear()
+
+    def make_game(self, name):
+        room, player = TurnManagementService.create_room(name, 2)
+        TurnManagementService.add_player(room, f'{name}-2')
+        TurnManagementService.initialize_game(room)
+        return room, player
+
+    def test_injects_into_rooms_with_a_game(self):
+        started = [self.make_game(name)[0] for name in ('alice', 'bob')]
+        idle, player = TurnManagementService.create_room('carol', 2)
+        open_question = TurnManagementService.create_admin_question(started[0], 'Old question?', 'dare')
+
+        injected = TurnManagementService.bulk_create_admin_questions(
+            Room.objects.all(), 'Everyone: your best secret?', 'truth'
+        )
+        self.assertEqual(sorted(code for code, question in injected), sorted(room.code for room in started))
+        self.assertFalse(Question.objects.filter(room=idle).exists())
+        open_question.refresh_from_db()
+        self.assertTrue(open_question.is_answered)
+        self.assertEqual(Question.objects.filter(source='ADMIN', is_answered=False).count(), 2)
+
+    def test_answer_write_pins_its_room_in_one_query(self):
+        room, player = self.make_game('alice')
+        question = TurnManagementService.create_admin_question(room, 'Old question?', 'dare')
+        answer = Answer.objects.create(question=question, player=player, answer_text='Done')
+        answer = Answer.objects.get(pk=answer.pk)
+        cache.clear()
+        with mock.patch.object(replicas, 'replica_enabled', return_value=True):
+            with self.assertNumQueries(1):
+                replicas.record_model_write(Answer, answer)
+        self.assertTrue(replicas.is_pinned('room', room.id))
+        # Only the room id was read, not the whole question
+        self.assertFalse(Answer._meta.get_field('question').is_cached(answer))
+
+    def test_write_behind_flush_pins_its_rooms(self):
+        room, player = self.make_game('alice')
+        buffered = BufferedWriter('test-pins')
+        buffered.create(Question(
+            room=room, game_state=room.get_current_game_state(),
+            question_text=QuestionText.intern('Queued?'), question_type='truth', source='ADMIN'
+        ))
+        cache.clear()
+        with mock.patch.object(replicas, 'replica_enabled', return_value=True), \
+                mock.patch.object(writebehind, 'replica_enabled', return_value=True):
+            self.assertEqual(buffered.flush(), 1)
+        self.assertTrue(replicas.is_pinned('room', room.id))
+
+
+@override_settings(GAME_QUESTION_PREFETCH=False, GAME_IDLE_ROOM_RELEASE_SECONDS=60)
+class PresenceTests(TransactionTestCase):
+    """Presence follows sockets, and only rooms idle on every worker are released."""
+
+    def setUp(self):
+        self.tracker = PresenceTracker()
+        patcher = mock.patch.object(presence, 'tracker', self.tracker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Released rooms revoke their tokens in the cache
+        self.addCleanup(cache.clear)
+        self.room = Room.objects.create(created_by='alice')
+
+    def test_connect_touch_and_disconnect(self):
+        code = self.room.code
+        self.assertTrue(self.tracker.connect(code, self.room.id, 1))
+        self.assertFalse(self.tracker.connect(code, self.room.id, 1))
+        self.assertTrue(self.tracker.connect(code, self.room.id, 2))
+        self.assertEqual(self.tracker.connected(code), [1, 2])
+        self.assertFalse(self.tracker.disconnect(code, 1))
+        self.assertTrue(self.tracker.disconnect(code, 1))
+        self.assertEqual(self.tracker.connected(code), [2])
+        self.assertIsNone(self.tracker.rooms[code].empty_since)
+
+        self.assertEqual(self.tracker.expire_silent(-1), [code])
+        self.assertEqual(self.tracker.connected(code), [])
+        self.assertIsNotNone(self.tracker.rooms[code].empty_since)
+        self.assertTrue(self.tracker.touch(code, 2))
+        self.assertEqual(self.tracker.connected(code), [2])
+        self.assertEqual(self.tracker.live_room_ids(), [self.room.id])
+
+    def leave(self):
+        """Leave the room empty on this worker for longer than the release period."""
+        self.tracker.connect(self.room.code, self.room.id, 1)
+        self.tracker.disconnect(self.room.code, 1)
+        self.tracker.rooms[self.room.code].empty_since -= 120
+
+    async def test_room_idle_everywhere_is_released(self):
+        self.leave()
+        await presence.sweep()
+        await self.room.arefresh_from_db()
+        self.assertFalse(self.room.is_active)
+        self.assertEqual(self.tracker.rooms, {})
+
+    async def test_room_active_on_another_worker_is_kept(self):
+        # Another worker's sweep found its players connected a moment ago
+        self.leave()
+        self.room.last_active_at = timezone.now()
+        await self.room.asave(update_fields=['last_active_at'])
+        await presence.sweep()
+        await self.room.arefresh_from_db()
+        self.assertTrue(self.room.is_active)
+        self.assertEqual(self.tracker.rooms, {})
+
+    async def test_sweep_marks_rooms_with_players_active(self):
+        self.tracker.connect(self.room.code, self.room.id, 1)
+        await presence.sweep()
+        await self.room.arefresh_from_db()
+        self.assertTrue(self.room.is_active)
+        self.assertIsNotNone(self.room.last_active_at)
+
+
+@override_settings(GAME_RATE_LIMITS={'socket': (5, 10), 'player': (1, 3)})
+class RateLimitTests(TestCase):
+    """HTTP mutations are limited per player or client, whatever else the client sends."""
+
+    def setUp(self):
+        patcher = mock.patch.object(ratelimit, 'player_buckets', BucketRegistry('player'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request_question(self, **extra):
+        return self.client.post('/api/standalone/request/', {
+            'user_name': 'alice', 'question_type': 'truth', 'session_id': str(uuid.uuid4())
+        }, secure=True, **extra)
+
+    def test_new_session_ids_share_the_client_bucket(self):
+        for attempt in range(3):
+            self.assertEqual(self.request_question().status_code, 200)
+        response = self.request_question()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        # Another client has a bucket of its own
+        self.assertEqual(self.request_question(REMOTE_ADDR='10.0.0.2').status_code, 200)
+
+    @override_settings(GAME_CLIENT_ADDRESS_HEADER='HTTP_X_FORWARDED_FOR')
+    def test_address_added_by_the_proxy_is_used(self):
+        for attempt in range(3):
+            forwarded = f'192.0.2.{attempt}, 10.0.0.3'
+            self.assertEqual(self.request_question(HTTP_X_FORWARDED_FOR=forwarded).status_code, 200)
+        response = self.request_question(HTTP_X_FORWARDED_FOR='192.0.2.99, 10.0.0.3')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.request_question(HTTP_X_FORWARDED_FOR='10.0.0.4').status_code, 200)
+
+    def test_token_bucket_refills(self):
+        bucket = TokenBucket(10, 2)
+        self.assertEqual(bucket.consume(), 0)
+        self.assertEqual(bucket.consume(), 0)
+        self.assertGreater(bucket.consume(), 0)
+        bucket.updated -= 1
+        self.assertEqual(bucket.consume(), 0)
+
+
+@override_settings(GAME_QUESTION_PREFETCH=False, GAME_ADMISSION={
+    'max_connections': 1, 'max_rooms': 1, 'max_http_in_flight': 1, 'max_sync_in_flight': 5, 'retry_after': 3,
+})
+class AdmissionTests(TransactionTestCase):
+    """Work beyond the worker's caps is turned away, from new and admitted clients alike."""
+
+    def setUp(self):
+        patcher = mock.patch.object(admission, 'controller', AdmissionController())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(metrics.reset)
+        self.room = Room.objects.create(created_by='alice')
+        self.alice = Player.objects.create(name='alice', room=self.room, join_order=1)
+
+    def test_socket_and_room_caps(self):
+        controller = admission.controller
+        self.assertTrue(controller.admit_socket('ROOM1'))
+        self.assertFalse(controller.admit_socket('ROOM1'))
+        controller.release_socket('ROOM1')
+        self.assertEqual(controller.rooms, {})
+        with override_settings(GAME_ADMISSION={**settings.GAME_ADMISSION, 'max_connections': 5}):
+            self.assertTrue(controller.admit_socket('ROOM1'))
+            self.assertFalse(controller.admit_socket('ROOM2'))
+
+    def test_http_is_shed_at_capacity(self):
+        with override_settings(GAME_ADMISSION={**settings.GAME_ADMISSION, 'max_http_in_flight': 0}):
+            response = self.client.get(f'/api/room/{self.room.code}/snapshot/', secure=True)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '3')
+
+    async def test_admitted_socket_is_refused_executor_work_at_capacity(self):
+        token = issue_player_token(self.room, self.alice)
+        communicator = WebsocketCommunicator(application, f'/ws/room/{self.room.code}/?token={token}')
+        await communicator.connect()
+        await receive_frame(communicator, 'room_state')
+
+        metrics.set_gauge('sync_executor.busy', 5)
+        await communicator.send_json_to({'type': 'get_state'})
+        error = await receive_frame(communicator, 'error')
+        self.assertEqual((error['code'], error['retry_after']), ('overloaded', 3))
+        await communicator.send_json_to({'type': 'heartbeat'})
+        await receive_frame(communicator, 'heartbeat_ack')
+
+        metrics.set_gauge('sync_executor.busy', 0)
+        await communicator.send_json_to({'type': 'get_state'})
+        await receive_frame(communicator, 'room_state')
+        await communicator.disconnect()
+
+
+@override_settings(GAME_QUESTION_PREFETCH=False, GAME_PUSH_COALESCE_MS=20)
+class PushCoalescingTests(TransactionTestCase):
+    """A burst of changes to a room is pushed as one room state."""
+
+    def setUp(self):
+        self.room = Room.objects.create(created_by='alice')
+        self.alice = Player.objects.create(name='alice', room=self.room, join_order=1)
+        self.addCleanup(publisher.cancel, self.room.code)
+        metrics.reset()
+
+    async def test_burst_is_pushed_once(self):
+        token = issue_player_token(self.room, self.alice)
+        communicator = WebsocketCommunicator(application, f'/ws/room/{self.room.code}/?token={token}')
+        await communicator.connect()
+        await receive_frame(communicator, 'room_state')
+
+        for _ in range(5):
+            mark_room_dirty(self.room.code, self.room.id)
+        state = await receive_frame(communicator, 'room_state')
+        self.assertEqual(state['players'][0]['name'], 'alice')
+        self.assertTrue(await communicator.receive_nothing(0.1))
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['room_push.marked'], 5)
+        self.assertEqual(counters['room_push.coalesced'], 4)
+        self.assertEqual(counters['room_push.sent'], 1)
+        await communicator.disconnect()
+
+    async def test_failed_flush_is_logged(self):
+        with mock.patch.object(RoomStateService, 'build_snapshot', side_effect=RuntimeError('boom')):
+            with self.assertLogs('game.push', 'ERROR'):
+                mark_room_dirty(self.room.code, self.room.id)
+                await asyncio.sleep(0.2)
+        self.assertEqual(metrics.snapshot()['counters']['room_push.failed'], 1)
+        self.assertFalse(publisher._flushing)
+
+
+class SpectatorTests(TransactionTestCase):
+    """Spectators joining later are sent the room's current state."""
+
+    def setUp(self):
+        self.room = Room.objects.create(created_by='alice')
+        self.alice = Player.objects.create(name='alice', room=self.room, join_order=1)
+        self.bob = Player.objects.create(name='bob', room=self.room, join_order=2)
+        self.addCleanup(publisher.cancel, self.room.code)
+
+    def start_game(self):
+        GameState.objects.create(
+            room=self.room, current_turn_player=self.bob, turn_order=[self.bob.id, self.alice.id]
+        )
+        return RoomStateService.build_snapshot(self.room.id)
+
+    async def watch(self):
+        communicator = WebsocketCommunicator(application, f'/ws/room/{self.room.code}/watch/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, await receive_frame(communicator, 'room_state')
+
+    async def test_relayed_push_from_another_worker_reaches_later_spectators(self):
+        first, state = await self.watch()
+        self.assertIsNone(state['game_state'])
+
+        # A push flushed by another worker only arrives through the relay
+        state = await sync_to_async(self.start_game)()
+        await send_to_room(self.room.code, event_buffer.record(self.room.code, 'room_state', state))
+        await receive_frame(first, 'room_state')
+
+        second, state = await self.watch()
+        self.assertEqual(state['game_state']['current_turn_player_id'], self.bob.id)
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_relay_survives_a_failed_receive(self):
+        layer = get_channel_layer()
+        receive = layer.receive
+        failures = []
+
+        async def flaky_receive(channel):
+            relays = {audience.channel for audience in spectators.hub.rooms.values()}
+            if channel in relays and not failures:
+                failures.append(channel)
+                raise RuntimeError('layer down')
+            return await receive(channel)
+
+        with mock.patch.object(layer, 'receive', flaky_receive), \
+                mock.patch.object(spectators, 'RELAY_RETRY_SECONDS', 0), \
+                self.assertLogs('game.spectators', 'ERROR'):
+            communicator, state = await self.watch()
+            state = await sync_to_async(self.start_game)()
+            await send_to_room(self.room.code, event_buffer.record(self.room.code, 'room_state', state))
+            state = await receive_frame(communicator, 'room_state')
+        self.assertEqual(state['game_state']['current_turn_player_id'], self.bob.id)
+        self.assertEqual(len(failures), 1)
+        await communicator.disconnect()
+
+    async def test_first_spectator_on_a_worker_gets_a_fresh_state(self):
+        first, state = await self.watch()
+        await first.disconnect()
+        await sync_to_async(self.start_game)()
+
+        second, state = await self.watch()
+        self.assertEqual(state['game_state']['current_turn_player_id'], self.bob.id)
+        await second.disconnect()
+
+
+class PageShellTests(TestCase):
+    """Page shells are cached briefly and then revalidated by ETag."""
+
+    def test_shell_is_revalidated(self):
+        path = '/room/ABC123/game/'
+        response = self.client.get(path, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age=60', response['Cache-Control'])
+        etag = response['ETag']
+
+        response = self.client.get(path, secure=True, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class WarmUpTests(TransactionTestCase):
+    """Warm-up runs every step and leaves database connections ready in the pool."""
+
+    def pooled_connection(self, alias):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_dict = dict(connection.settings_dict, NAME=f'{directory.name}/{alias}.sqlite3')
+        self.addCleanup(dbpool._pools.pop, alias, None)
+        self.addCleanup(lambda: dbpool.get_pool(alias).close_idle())
+        return PooledSQLiteWrapper(settings_dict, alias)
+
+    def test_every_step_is_timed(self):
+        timings = warmup.warm_up()
+        self.assertEqual(list(timings), ['urls', 'templates', 'database', 'questions'])
+
+    @override_settings(GAME_DB_POOL_WARM_SIZE=3)
+    def test_pool_is_left_with_idle_connections(self):
+        warmup.warm_pool(self.pooled_connection('warm-test'))
+        stats = dbpool.get_pool('warm-test').stats()
+        self.assertEqual((stats['open'], stats['idle'], stats['in_use']), (3, 3, 0))
+
+    @override_settings(GAME_DB_POOL_WARM_SIZE=3)
+    def test_later_checkouts_reuse_warm_connections(self):
+        pooled = self.pooled_connection('warm-reuse')
+        warmup.warm_pool(pooled)
+        pooled.ensure_connection()
+        pooled.close()
+        self.assertEqual(dbpool.get_pool('warm-reuse').stats()['open'], 3)
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    """Connections are reused across checkouts, capped, and profiling is asked for explicitly."""
+
+    class Raw:
+        def cursor(self):
+            return mock.Mock()
+
+        def close(self):
+            pass
+
+    def make_pool(self, size=2, timeout=1, recycle=600):
+        return dbpool.ConnectionPool('test', size=size, timeout=timeout, recycle=recycle, check_idle=30)
+
+    def test_released_connection_is_reused(self):
+        pool = self.make_pool()
+        connect = mock.Mock(side_effect=self.Raw)
+        raw = pool.acquire(connect)
+        pool.release(raw)
+        self.assertIs(pool.acquire(connect), raw)
+        self.assertEqual(connect.call_count, 1)
+
+    def test_checkout_waits_then_times_out_when_full(self):
+        pool = self.make_pool(size=1, timeout=0.05)
+        pool.acquire(self.Raw)
+        with self.assertRaises(dbpool.PoolTimeout):
+            pool.acquire(self.Raw)
+        self.assertEqual(pool.stats()['open'], 1)
+
+    def test_old_connection_is_replaced(self):
+        pool = self.make_pool(recycle=0)
+        raw = pool.acquire(self.Raw)
+        pool.release(raw)
+        self.assertIsNot(pool.acquire(self.Raw), raw)
+        self.assertEqual(pool.stats()['open'], 1)
+
+    def test_profile_flag_is_read_as_a_boolean(self):
+        factory = RequestFactory()
+        for query, expected in (('1', True), ('true', True), ('0', False), ('false', False), ('', False)):
+            with self.subTest(query=query):
+                request = factory.get('/', {'profile': query})
+                request.user = mock.Mock(is_staff=True)
+                self.assertIs(is_profile_requested(request), expected)
+        request = factory.get('/', HTTP_X_PROFILE='off')
+        request.user = mock.Mock(is_staff=True)
+        self.assertFalse(is_profile_requested(request))
+
+
+@override_settings(GAME_SQLITE_SINGLE_WRITER=True)
+class SingleWriterTests(TransactionTestCase):
+    """Game writes from the views go through the single writer, and the admin holds it."""
+
+    def setUp(self):
+        models._interned.clear()
+        cache.clear()
+        patcher = mock.patch.object(sqlite.write_queue, 'run', wraps=sqlite.write_queue.run)
+        self.run_write = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_admin_writes_hold_the_writer(self):
+        User.objects.create_superuser('admin', password='secret')
+        self.client.login(username='admin', password='secret')
+        with mock.patch.object(sqlite.write_queue, 'hold', wraps=sqlite.write_queue.hold) as hold:
+            response = self.client.post('/admin/game/room/add/', {
+                'is_active': 'on', 'created_by': 'admin', 'capacity': '4',
+                'last_active_at_0': '', 'last_active_at_1': '',
+            }, secure=True)
+            self.assertEqual(response.status_code, 302)
+            room = Room.objects.get()
+            player = TurnManagementService.add_player(room, 'alice')
+            self.run_write.reset_mock()
+
+            # remove_player is a serialized write; it runs inline while held
+            self.client.post(f'/admin/game/player/{player.pk}/delete/', {'post': 'yes'}, secure=True)
+            self.client.post(f'/admin/game/room/{room.pk}/delete/', {'post': 'yes'}, secure=True)
+        self.assertEqual(hold.call_count, 3)
+        self.assertEqual(self.written(), ['remove_player'])
+        self.assertFalse(Room.objects.exists())
+
+    def written(self):
+        return [call.args[0].__name__ for call in self.run_write.call_args_list]
+
+    def test_standalone_request_goes_through_the_writer(self):
+        response = self.client.post('/api/standalone/request/', {
+            'user_name': 'alice', 'question_type': 'truth'
+        }, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.written(), ['get_or_create'])
+        self.assertTrue(StandaloneRequest.objects.filter(session_id=response.json()['session_id']).exists())
+
+    def test_failing_write_only_undoes_itself(self):
+        def fail():
+            Room.objects.create(created_by='bad')
+            raise ValueError('bad write')
+
+        with self.assertRaises(ValueError):
+            sqlite.write_queue.run(fail)
+        sqlite.write_queue.run(Room.objects.create, created_by='good')
+        self.assertEqual(list(Room.objects.values_list('created_by', flat=True)), ['good'])
+
+
+@override_settings(GAME_QUESTION_PREFETCH=False)
+class ReplicaRoutingTests(TestCase):
+    """Reads in a replica block go to the replica unless their room was just written."""
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(replicas, 'replica_enabled', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_in_the_block_go_to_the_replica(self):
+        router = replicas.ReplicaRouter()
+        with replicas.replica_reads('room', 1) as alias:
+            self.assertEqual(alias, replicas.REPLICA_ALIAS)
+            self.assertEqual(router.db_for_read(Room), replicas.REPLICA_ALIAS)
+            self.assertIsNone(router.db_for_read(User))
+        self.assertIsNone(router.db_for_read(Room))
+        self.assertEqual(router.db_for_write(Room), 'default')
+
+    def test_written_room_reads_from_the_primary(self):
+        replicas.note_write('room', 1)
+        with replicas.replica_reads('room', 1) as alias:
+            self.assertEqual(alias, 'default')
+            self.assertIsNone(replicas.ReplicaRouter().db_for_read(Room))
+        with replicas.replica_reads('room', 2) as alias:
+            self.assertEqual(alias, replicas.REPLICA_ALIAS)
+
+    def test_latest_game_state_is_the_newest_row(self):
+        room, alice = TurnManagementService.create_room('alice', 2)
+        older = GameState.objects.create(room=room, current_turn_player=alice, turn_order=[alice.id])
+        newer = GameState.objects.create(room=room, current_turn_player=alice, turn_order=[alice.id])
+        # Not the order a created_at sort would give
+        GameState.objects.filter(pk=older.pk).update(created_at=timezone.now() + datetime.timedelta(hours=1))
+        annotated = Room.objects.annotate(game_state_id=latest_game_state_id('pk')).get(pk=room.pk)
+        self.assertEqual(annotated.game_state_id, newer.pk)
+
+
+@override_settings(GAME_QUESTION_PREFETCH=False)
+class PlayerTokenTests(TestCase):
+    """Tokens stop working once their player is removed or their room released."""
+
+    def setUp(self):
+        # Revocations outlive the rows; don't let them leak into other tests
+        self.addCleanup(cache.clear)
+        self.room, self.alice = TurnManagementService.create_room('alice', 2)
+        self.bob = TurnManagementService.add_player(self.room, 'bob')
+        TurnManagementService.initialize_game(self.room)
+
+    def next_round(self, player):
+        return self.client.post(
+            f'/api/room/{self.room.code}/next-round/', secure=True,
+            HTTP_X_PLAYER_TOKEN=issue_player_token(self.room, player)
+        )
+
+    def test_removed_player_token_is_rejected(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            TurnManagementService.remove_player(self.bob)
+        self.assertEqual(self.next_round(self.bob).status_code, 403)
+        self.assertEqual(self.next_round(self.alice).status_code, 200)
+
+    def test_released_room_tokens_are_rejected(self):
+        async_to_sync(release_rooms)([self.room.id])
+        self.assertEqual(self.next_round(self.alice).status_code, 403)
+        self.assertIsNone(read_player_token(issue_player_token(self.room, self.bob)))
+
+    def test_revocation_survives_cache_eviction(self):
+        token = issue_player_token(self.room, self.bob)
+        self.assertIsNotNone(read_player_token(token))
+        with self.captureOnCommitCallbacks(execute=True):
+            TurnManagementService.remove_player(self.bob)
+        # Push the revocation out of the size-limited cache
+        for number in range(settings.CACHES['default'].get('OPTIONS', {}).get('MAX_ENTRIES', 300) * 2):
+            cache.set(f'filler:{number}', number)
+        self.assertIsNone(read_player_token(token))
+
+    def test_valid_token_is_checked_against_the_database_on_a_miss(self):
+        token = issue_player_token(self.room, self.alice)
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(read_player_token(token))
+        # Once the entries set at issue are gone, the database is asked once
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertIsNotNone(read_player_token(token))
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(read_player_token(token))
+
+
+@override_settings(GAME_QUESTION_PREFETCH=False, GAME_PREFETCH_WORKERS=1)
+class PrefetchTests(TransactionTestCase):
+    """A question taken for a choice that is then refused isn't lost."""
+
+    def setUp(self):
+        models._interned.clear()
+        self.provider = LocalCorpusProvider()
+        patcher = mock.patch('game.providers._chain', ProviderChain([(self.provider, 1)]))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.prefetcher = QuestionPrefetcher('test-prefetch')
+        patcher = mock.patch('game.views.prefetcher', self.prefetcher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(cache.clear)
+        metrics.reset()
+
+    def wait_for(self, counter):
+        for _ in range(500):
+            if metrics.snapshot()['counters'].get(counter):
+                return
+            time.sleep(0.01)
+        self.fail(f'{counter} was never counted')
+
+    def test_refused_choice_hands_its_question_back(self):
+        room, alice = TurnManagementService.create_room('alice', 2)
+        TurnManagementService.add_player(room, 'bob')
+        TurnManagementService.initialize_game(room)
+
+        # The turn passes between the view's check and the write
+        with mock.patch.object(TurnManagementService, 'choose', return_value=None) as choose:
+            response = self.client.post(
+                f'/api/room/{room.code}/choose/', {'choice': 'truth'}, secure=True,
+                HTTP_X_PLAYER_TOKEN=issue_player_token(room, alice)
+            )
+        self.assertEqual(response.status_code, 400)
+        refused_text = choose.call_args.args[3]
+        self.wait_for('norepeat.returned')
+        # Handed back to the corpus, so it's the room's next truth
+        self.assertEqual(self.provider.fetch('truth', room.id)['question'], refused_text)
+
+    def test_given_back_pooled_question_is_drawn_by_the_next_turn(self):
+        picked = Candidate(1, 'truth', 'Pooled question?', 'API')
+        self.prefetcher.give_back(picked)
+        with override_settings(GAME_QUESTION_PREFETCH=True):
+            self.prefetcher.start_turn(2, 5)
+        self.assertEqual(self.prefetcher.take(2, 5, 'truth').text, 'Pooled question?')
+
+
+# One worker: the in-memory test database refuses concurrent writes to a
+# table outright instead of waiting, and a truth and a dare draw at once
+@override_settings(GAME_QUESTION_PREFETCH=True, GAME_PREFETCH_WORKERS=1)
+class NoRepeatTests(TransactionTestCase):
+    """Rooms don't repeat questions, and prefetched ones nobody picked don't use up a room's corpus."""
+
+    def setUp(self):
+        self.provider = LocalCorpusProvider()
+        patcher = mock.patch('game.providers._chain', ProviderChain([(self.provider, 1)]))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(cache.clear)
+        metrics.reset()
+        self.room = Room.objects.create(created_by='alice')
+
+    def test_returned_index_is_drawn_next(self):
+        for n in (1, 2, 5, 104):
+            index = next_index(self.room.id, 'test', n)
+            self.assertTrue(return_index(self.room.id, 'test', n, index))
+            drawn = [next_index(self.room.id, 'test', n) for _ in range(n)]
+            self.assertEqual(drawn[0], index)
+            self.assertEqual(sorted(drawn), list(range(n)))
+
+    def test_index_is_kept_once_drawn_past(self):
+        index = next_index(self.room.id, 'test', 5)
+        next_index(self.room.id, 'test', 5)
+        self.assertFalse(return_index(self.room.id, 'test', 5, index))
+
+    def test_cursors_outlive_cache_eviction(self):
+        rooms = Room.objects.bulk_create(Room(code=f'R{number:05d}') for number in range(400))
+        n = 5
+        first = {room.id: next_index(room.id, 'test', n) for room in rooms}
+        # More entries than the default cache holds
+        for number in range(settings.CACHES['default'].get('OPTIONS', {}).get('MAX_ENTRIES', 300) * 2):
+            cache.set(f'filler:{number}', number)
+        for room in rooms:
+            drawn = [first[room.id]] + [next_index(room.id, 'test', n) for _ in range(n - 1)]
+            self.assertEqual(sorted(drawn), list(range(n)))
+
+    def test_unchosen_candidate_is_handed_back(self):
+        prefetcher = QuestionPrefetcher('test-prefetch')
+        room_id = self.room.id
+        prefetcher.start_turn(room_id, 1)
+        candidates = prefetcher._turns[room_id][1]
+        for candidate in candidates.values():
+            self.assertTrue(candidate.ready.wait(5))
+        dare = candidates['dare'].text
+
+        picked = prefetcher.take(room_id, 1, 'truth')
+        self.assertEqual((picked.text, picked.source), (candidates['truth'].text, 'LOCAL'))
+        for _ in range(500):
+            if metrics.snapshot()['counters'].get('norepeat.returned'):
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.provider.fetch('dare', room_id)['question'], dare)
+
+
+@override_settings(GAME_ENGINE_MODE='memory', GAME_QUESTION_PREFETCH=False)
+class QuestionTextTests(TransactionTestCase):
+    """Repeated texts share one row, resolved without a query once known."""
+
+    def setUp(self):
+        models._interned.clear()
+        self.addCleanup(models._interned.clear)
+
+    def test_known_text_is_resolved_without_a_query(self):
+        first = QuestionText.intern('What is your biggest fear?')
+        with self.assertNumQueries(0):
+            second = QuestionText.intern('What is your biggest fear?')
+        self.assertEqual(second.pk, first.pk)
+        self.assertEqual(QuestionText.objects.count(), 1)
+
+    def test_deleted_text_is_forgotten(self):
+        text = QuestionText.intern('What is your biggest fear?')
+        text.delete()
+        again = QuestionText.intern('What is your biggest fear?')
+        self.assertTrue(QuestionText.objects.filter(pk=again.pk).exists())
+
+    def test_engine_interns_outside_its_lock(self):
+        room = Room.objects.create(created_by='alice')
+        alice = Player.objects.create(name='alice', room=room, join_order=1)
+        Player.objects.create(name='bob', room=room, join_order=2)
+        self.addCleanup(engine_store.evict, room.id)
+        engine = get_engine(room.id)
+        engine.start()
+
+        intern = QuestionText.intern
+        held = []
+
+        def interning(text):
+            held.append(engine.lock.locked())
+            return intern(text)
+
+        # Hold off the background flush, whose inserts would lock the table mid-intern
+        with writer._flush_lock, mock.patch.object(QuestionText, 'intern', side_effect=interning):
+            engine.choose(alice.id, 'truth', 'What is your biggest fear?')
+            engine.inject_question('Everyone: your best secret?', 'truth')
+        self.assertEqual(held, [False, False])
+        writer.flush()
+        self.assertEqual(Question.objects.count(), 2)
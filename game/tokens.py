@@ -0,0 +1,148 @@
+"""
+Signed player tokens.
+
+``create_room`` and ``join_room`` hand the new player a token carrying
+their room id, room code and player id, signed with ``SECRET_KEY`` and
+valid for ``GAME_PLAYER_TOKEN_MAX_AGE`` seconds. Mutation views and
+``GameConsumer`` take a player's identity from the token alone, so they
+no longer look up the room and player on every call, and a player can no
+longer act as another by sending their id.
+
+Clients send the token in the ``X-Player-Token`` header (or a
+``player_token`` form field) and as the ``token`` query parameter of the
+room socket.
+
+A token stops working before it expires once its player is removed or its
+room is released. The database decides: a token is valid while its player
+row exists and its room is active. That check is cached per room and per
+player for ``GAME_PLAYER_TOKEN_CHECK_SECONDS``, so a token costs one cache
+read and a query only when those entries are missing. Removing a player or
+releasing a room drops its entries and records the revocation in the
+cache, which is checked first. The cache may evict either kind of entry at
+any time; a missing one only means asking the database again. Revocations
+reach other workers at once only when the cache is shared between them,
+and within ``GAME_PLAYER_TOKEN_CHECK_SECONDS`` otherwise.
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+
+from . import metrics
+
+SALT = 'game.player-token'
+
+PlayerIdentity = namedtuple('PlayerIdentity', 'room_id room_code player_id')
+
+
+def token_max_age():
+    return getattr(settings, 'GAME_PLAYER_TOKEN_MAX_AGE', 86400)
+
+
+def _revoked_room_key(room_id):
+    return f'player_token_revoked:room:{room_id}'
+
+
+def _revoked_player_key(player_id):
+    return f'player_token_revoked:player:{player_id}'
+
+
+def _valid_room_key(room_id):
+    return f'player_token_valid:room:{room_id}'
+
+
+def _valid_player_key(player_id):
+    return f'player_token_valid:player:{player_id}'
+
+
+def revoke_player_tokens(room_ids=(), player_ids=()):
+    """Reject the tokens of these rooms' players, and of these players, from now on."""
+    cache.delete_many(
+        [_valid_room_key(room_id) for room_id in room_ids]
+        + [_valid_player_key(player_id) for player_id in player_ids]
+    )
+    revoked = {_revoked_room_key(room_id): True for room_id in room_ids}
+    revoked.update({_revoked_player_key(player_id): True for player_id in player_ids})
+    if revoked:
+        cache.set_many(revoked, token_max_age())
+
+
+def _mark_valid(room_id, player_id):
+    cache.set_many(
+        {_valid_room_key(room_id): True, _valid_player_key(player_id): True},
+        getattr(settings, 'GAME_PLAYER_TOKEN_CHECK_SECONDS', 300)
+    )
+
+
+def cached_revocation(room_id, player_id):
+    """
+    Whether the cache knows the player's tokens to be revoked (True) or
+    valid (False); None when only the database can tell. Safe to call from
+    the event loop.
+    """
+    found = cache.get_many([
+        _revoked_room_key(room_id), _revoked_player_key(player_id),
+        _valid_room_key(room_id), _valid_player_key(player_id),
+    ])
+    if _revoked_room_key(room_id) in found or _revoked_player_key(player_id) in found:
+        return True
+    if _valid_room_key(room_id) in found and _valid_player_key(player_id) in found:
+        return False
+    return None
+
+
+def is_revoked(room_id, player_id):
+    """Whether the player was removed or the room released since the token was issued."""
+    revoked = cached_revocation(room_id, player_id)
+    if revoked is not None:
+        return revoked
+
+    from .models import Player
+
+    metrics.incr('player_token.checked')
+    if not Player.objects.filter(pk=player_id, room_id=room_id, room__is_active=True).exists():
+        return True
+    _mark_valid(room_id, player_id)
+    return False
+
+
+def issue_player_token(room, player):
+    """Return a signed token identifying ``player`` in ``room``."""
+    _mark_valid(room.id, player.id)
+    return signing.dumps({'r': room.id, 'c': room.code, 'p': player.id}, salt=SALT)
+
+
+def read_player_token(token, room_code=None, check_revoked=True):
+    """
+    Return the ``PlayerIdentity`` a token carries, or None if it is
+    missing, forged, expired, revoked or (given ``room_code``) for another
+    room. Without ``check_revoked`` the caller checks ``is_revoked`` itself,
+    e.g. from the event loop, which must not query the database.
+    """
+    if not token:
+        return None
+    try:
+        data = signing.loads(token, salt=SALT, max_age=token_max_age())
+        identity = PlayerIdentity(int(data['r']), data['c'], int(data['p']))
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        metrics.incr('player_token.rejected')
+        return None
+    if room_code is not None and identity.room_code != room_code.upper():
+        metrics.incr('player_token.rejected')
+        return None
+    if check_revoked and is_revoked(identity.room_id, identity.player_id):
+        metrics.incr('player_token.revoked')
+        return None
+    return identity
+
+
+def request_identity(request, room_code=None):
+    """Return the identity of the player token sent with ``request``, if valid."""
+    if not hasattr(request, '_player_identity'):
+        token = request.headers.get('X-Player-Token') or request.POST.get('player_token')
+        request._player_identity = read_player_token(token)
+    identity = request._player_identity
+    if identity and room_code is not None and identity.room_code != room_code.upper():
+        return None
+    return identity
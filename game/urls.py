@@ -12,7 +12,10 @@ urlpatterns = [
     path('api/room/<str:room_code>/next-round/', views.next_round, name='next_round'),
     path('api/room/<str:room_code>/start-game/', views.start_game, name='start_game'),
     path('api/room/<str:room_code>/status/', views.room_status, name='room_status'),
+    path('api/room/<str:room_code>/snapshot/', views.room_snapshot, name='room_snapshot'),
     path('api/admin/room/<str:room_code>/inject-question/', views.admin_inject_question, name='admin_inject_question'),
+    path('api/admin/rooms/inject-question/', views.admin_bulk_inject_question, name='admin_bulk_inject_question'),
+    path('api/admin/metrics/', views.admin_metrics, name='admin_metrics'),
     path('standalone/', views.standalone_page, name='standalone_page'),
     path('api/standalone/request/', views.request_standalone_question, name='request_standalone_question'),
     path('api/standalone/<str:session_id>/status/', views.get_standalone_status, name='get_standalone_status'),
@@ -1,33 +1,68 @@
 """
 Utility functions for WebSocket broadcasting.
 """
+import asyncio
+
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+from .encoding import group_message
+from .push import event_buffer, publish, publisher, send_to_room
+
+
+def broadcast_room_move(room_code, room_id, handler_type=None, frame=None):
+    """
+    Push a move made over HTTP to the room's sockets, as the consumer
+    handlers do for moves made over the socket: the move's own event, if
+    it has one, then the room state.
+    """
+    async def send():
+        if handler_type:
+            await publish(room_code, handler_type, frame)
+        await publisher.flush(room_code, room_id)
+    
+    if get_channel_layer():
+        async_to_sync(send)()
 
 
 def broadcast_admin_question(room_code, question_data):
     """Broadcast admin-injected question to all clients in the room."""
     channel_layer = get_channel_layer()
     if channel_layer:
-        async_to_sync(channel_layer.group_send)(
-            f'game_{room_code}',
-            {
-                'type': 'admin_question_injected',
-                'room_code': room_code,
-                'question': question_data
-            }
+        async_to_sync(send_to_room)(
+            room_code,
+            event_buffer.record(
+                room_code,
+                'admin_question_injected',
+                {'type': 'admin_question_injected', 'question': question_data}
+            )
         )
 
 
+def broadcast_admin_questions(injected):
+    """Broadcast admin-injected questions to many rooms concurrently."""
+    async def send_all():
+        await asyncio.gather(*(
+            send_to_room(room_code, event_buffer.record(
+                room_code,
+                'admin_question_injected',
+                {'type': 'admin_question_injected', 'question': question_data}
+            ))
+            for room_code, question_data in injected
+        ))
+    
+    if get_channel_layer() and injected:
+        async_to_sync(send_all)()
+
+
 def broadcast_standalone_question(session_id, question_data):
     """Broadcast admin-injected question to standalone user."""
     channel_layer = get_channel_layer()
     if channel_layer:
         async_to_sync(channel_layer.group_send)(
             f'standalone_{session_id}',
-            {
-                'type': 'admin_question_injected',
-                'session_id': session_id,
-                'question': question_data
-            }
+            group_message(
+                'admin_question_injected',
+                {'type': 'admin_question_injected', 'question': question_data},
+                session_id=session_id
+            )
         )
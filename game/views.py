@@ -1,14 +1,29 @@
+from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
-import json
+from django.utils.cache import get_conditional_response, patch_cache_control, set_response_etag
+from functools import wraps
+import time
 import uuid
-from .models import Room, Player, GameState, Question, Answer, StandaloneRequest
+from .models import Room, Player, GameState, Question, QuestionText, Answer, StandaloneRequest
 from .services import TurnManagementService, APIQuestionService
-from .utils import broadcast_admin_question, broadcast_standalone_question
+from .engine import engine_enabled, get_engine, store as engine_store
+from .dbpool import pool_stats
+from .encoding import JsonResponse
+from .push import EPOCH, build_snapshot_for_code, event_buffer
+from .utils import (
+    broadcast_admin_question, broadcast_admin_questions, broadcast_room_move, broadcast_standalone_question
+)
+from . import metrics
+from .ratelimit import rate_limited
+from .prefetch import prefetcher
+from .replicas import replica_reads
+from .sqlite import serialized_write
+from .tokens import issue_player_token, request_identity
 
 
 @ensure_csrf_cookie
@@ -24,16 +39,19 @@ def create_room(request):
     if not player_name:
         return JsonResponse({'error': 'Player name is required'}, status=400)
     
-    room = Room.objects.create(created_by=player_name)
-    player = Player.objects.create(
-        name=player_name,
-        room=room,
-        join_order=1
-    )
+    capacity = request.POST.get('capacity', '2')
+    if not capacity.isdigit() or not 2 <= int(capacity) <= settings.ROOM_MAX_CAPACITY:
+        return JsonResponse(
+            {'error': f'Capacity must be between 2 and {settings.ROOM_MAX_CAPACITY}'},
+            status=400
+        )
+    
+    room, player = TurnManagementService.create_room(player_name, int(capacity))
     
     return JsonResponse({
         'room_code': room.code,
-        'player_id': player.id
+        'player_id': player.id,
+        'token': issue_player_token(room, player)
     })
 
 
@@ -57,132 +75,187 @@ def join_room(request):
     if room.is_full():
         return JsonResponse({'error': 'Room is full'}, status=400)
     
-    player = Player.objects.create(
-        name=player_name,
-        room=room,
-        join_order=room.players.count() + 1
-    )
+    player = TurnManagementService.add_player(room, player_name)
+    if not player:
+        return JsonResponse({'error': 'Room is full'}, status=400)
+    if engine_enabled():
+        engine_store.evict(room.id)
+    broadcast_room_move(room.code, room.id)
     
     return JsonResponse({
         'room_code': room.code,
-        'player_id': player.id
+        'player_id': player.id,
+        'token': issue_player_token(room, player)
     })
 
 
+def player_required(view):
+    """
+    Reject a room mutation unless it carries a valid player token for that
+    room; the view reads the player from ``request_identity(request)``.
+    """
+    @wraps(view)
+    def wrapper(request, room_code, *args, **kwargs):
+        if not request_identity(request, room_code):
+            return JsonResponse({'error': 'Invalid or expired player token'}, status=403)
+        return view(request, room_code, *args, **kwargs)
+    return wrapper
+
+
+def page_shell(view):
+    """
+    Mark a view's response as a page shell: identical for every visitor,
+    so browsers and proxies may keep it for ``GAME_SHELL_MAX_AGE`` seconds.
+    The shell carries its script inline, so the max-age is kept short and
+    then the copy is revalidated against an ETag of the page: a deploy
+    that changes the script is picked up within the max-age, and an
+    unchanged shell costs a 304.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if response.status_code != 200:
+            return response
+        set_response_etag(response)
+        patch_cache_control(response, public=True, max_age=getattr(settings, 'GAME_SHELL_MAX_AGE', 60))
+        return get_conditional_response(request, etag=response['ETag'], response=response)
+    return wrapper
+
+
+@page_shell
 def waiting_room(request, room_code):
-    """Waiting room page."""
-    room = get_object_or_404(Room, code=room_code.upper())
-    players = room.get_players()
-    player_id = request.GET.get('player_id')
-    
-    context = {
-        'room': room,
-        'players': players,
-        'player_id': player_id,
-        'is_full': room.is_full()
-    }
-    return render(request, 'game/waiting_room.html', context)
+    """Waiting room page shell; players and room state come from the snapshot endpoint."""
+    return render(request, 'game/waiting_room.html', {'room_code': room_code.upper()})
 
 
-@ensure_csrf_cookie
+@page_shell
 def game_screen(request, room_code):
-    """Main game screen."""
-    room = get_object_or_404(Room, code=room_code.upper())
-    player_id = request.GET.get('player_id')
-    
-    if not player_id:
-        return redirect('home')
-    
-    try:
-        player = Player.objects.get(id=player_id, room=room)
-    except Player.DoesNotExist:
-        return redirect('home')
-    
-    # Auto-start game if 2 players joined but game hasn't started
-    game_state = room.get_current_game_state()
-    if not game_state and room.is_full():
-        game_state = TurnManagementService.initialize_game(room)
-    
-    current_question = TurnManagementService.get_current_question(room)
-    
-    context = {
-        'room': room,
-        'player': player,
-        'game_state': game_state,
-        'current_question': current_question,
-        'is_my_turn': game_state and game_state.current_turn_player == player if game_state else False,
-        'needs_start': room.is_full() and not game_state,
-    }
-    return render(request, 'game/game_screen.html', context)
+    """Main game screen shell; the game state comes from the snapshot endpoint."""
+    return render(request, 'game/game_screen.html', {'room_code': room_code.upper()})
+
+
+@require_http_methods(["GET"])
+@ensure_csrf_cookie
+def room_snapshot(request, room_code):
+    """
+    Room state the page shells bootstrap from, stamped with the room's
+    broadcast position so their socket resumes from there. Cached for
+    ``GAME_SNAPSHOT_CACHE_SECONDS``, so a reconnect storm builds it once.
+    """
+    room_code = room_code.upper()
+    key = f'room_snapshot:{room_code}'
+    state = cache.get(key)
+    if state is None:
+        # Taken before building: events in between are replayed, not lost
+        seq = event_buffer.head(room_code)
+        state = build_snapshot_for_code(room_code)
+        if state is None:
+            return JsonResponse({'error': 'Room not found'}, status=404)
+        state = {**state, 'seq': seq, 'epoch': EPOCH}
+        cache.set(key, state, getattr(settings, 'GAME_SNAPSHOT_CACHE_SECONDS', 1))
+        metrics.incr('room_snapshot.built')
+    else:
+        metrics.incr('room_snapshot.hit')
+    return JsonResponse(state)
 
 
 @require_http_methods(["POST"])
 @csrf_exempt
+@rate_limited
+@player_required
 def choose_truth_dare(request, room_code):
     """Handle truth/dare choice."""
-    room = get_object_or_404(Room, code=room_code.upper())
-    player_id = request.POST.get('player_id')
+    identity = request_identity(request)
     choice = request.POST.get('choice')  # 'truth' or 'dare'
     
-    if not player_id or choice not in ['truth', 'dare']:
+    if choice not in ['truth', 'dare']:
         return JsonResponse({'error': 'Invalid request'}, status=400)
     
-    try:
-        player = Player.objects.get(id=player_id, room=room)
-    except Player.DoesNotExist:
-        return JsonResponse({'error': 'Player not found'}, status=404)
+    if engine_enabled():
+        engine = get_engine(identity.room_id)
+        if not engine or not engine.is_turn(identity.player_id):
+            return JsonResponse({'error': 'Not your turn'}, status=400)
+        picked = prefetcher.take(identity.room_id, identity.player_id, choice)
+        question = engine.choose(identity.player_id, choice, picked.text, picked.source)
+        if question:
+            broadcast_room_move(
+                identity.room_code, identity.room_id,
+                'question_sent', {'type': 'question_sent', 'question': question}
+            )
+            return JsonResponse({'success': True, 'question': question})
+        prefetcher.give_back(picked)
+        return JsonResponse({'error': 'Not your turn'}, status=400)
     
+    # The token stands in for the room and player lookups
+    room = Room(id=identity.room_id, code=identity.room_code)
     game_state = room.get_current_game_state()
-    if not game_state or game_state.current_turn_player != player:
+    if not game_state or game_state.current_turn_player_id != identity.player_id:
         return JsonResponse({'error': 'Not your turn'}, status=400)
     
-    game_state.current_choice = choice
-    game_state.is_waiting_for_question = True
-    game_state.save()
-    
-    # Create question from API
-    question = TurnManagementService.create_question_from_api(room, choice)
+    # Taken before writing anything, so a fetch never holds up a write
+    picked = prefetcher.take(identity.room_id, identity.player_id, choice)
+    question = TurnManagementService.choose(room, identity.player_id, choice, picked.text, picked.source)
     
     if question:
-        return JsonResponse({
-            'success': True,
-            'question': {
-                'id': question.id,
-                'text': question.text,
-                'type': question.question_type,
-                'source': question.source
-            }
-        })
+        question_data = {
+            'id': question.id,
+            'text': question.text,
+            'type': question.question_type,
+            'source': question.source
+        }
+        broadcast_room_move(
+            identity.room_code, identity.room_id,
+            'question_sent', {'type': 'question_sent', 'question': question_data}
+        )
+        return JsonResponse({'success': True, 'question': question_data})
     
-    return JsonResponse({'error': 'Failed to fetch question'}, status=500)
+    # The turn passed after the check above
+    prefetcher.give_back(picked)
+    return JsonResponse({'error': 'Not your turn'}, status=400)
 
 
 @require_http_methods(["POST"])
 @csrf_exempt
+@rate_limited
+@player_required
 def submit_answer(request, room_code):
     """Submit answer to current question."""
-    room = get_object_or_404(Room, code=room_code.upper())
-    player_id = request.POST.get('player_id')
+    identity = request_identity(request)
     answer_text = request.POST.get('answer_text', '').strip()
     
-    if not player_id or not answer_text:
-        return JsonResponse({'error': 'Player ID and answer text are required'}, status=400)
-    
-    try:
-        player = Player.objects.get(id=player_id, room=room)
-    except Player.DoesNotExist:
-        return JsonResponse({'error': 'Player not found'}, status=404)
-    
+    if not answer_text:
+        return JsonResponse({'error': 'Answer text is required'}, status=400)
+    
+    if engine_enabled():
+        engine = get_engine(identity.room_id)
+        if not engine or not engine.is_turn(identity.player_id):
+            return JsonResponse({'error': 'Not your turn'}, status=400)
+        result = engine.submit_answer(identity.player_id, answer_text)
+        if result:
+            broadcast_room_move(
+                identity.room_code, identity.room_id,
+                'answer_submitted', {'type': 'answer_submitted', 'next_turn': result['next_turn']}
+            )
+            return JsonResponse({'success': True, **result})
+        return JsonResponse({'error': 'Failed to submit answer'}, status=500)
+    
+    room = Room(id=identity.room_id, code=identity.room_code)
     game_state = room.get_current_game_state()
-    if not game_state or game_state.current_turn_player != player:
+    if not game_state or game_state.current_turn_player_id != identity.player_id:
         return JsonResponse({'error': 'Not your turn'}, status=400)
     
+    player = Player(id=identity.player_id, room_id=identity.room_id)
     answer = TurnManagementService.submit_answer(room, player, answer_text)
     
     if answer:
+        next_turn = game_state.current_turn_player.name if game_state.current_turn_player else None
+        broadcast_room_move(
+            identity.room_code, identity.room_id,
+            'answer_submitted', {'type': 'answer_submitted', 'next_turn': next_turn}
+        )
         return JsonResponse({
             'success': True,
-            'next_turn': game_state.current_turn_player.name if game_state.current_turn_player else None,
+            'next_turn': next_turn,
             'round_number': game_state.round_number
         })
     
@@ -191,30 +264,23 @@ def submit_answer(request, room_code):
 
 @require_http_methods(["POST"])
 @csrf_exempt
+@player_required
 def start_game(request, room_code):
-    """Manually start the game when 2 players have joined."""
-    room = get_object_or_404(Room, code=room_code.upper())
-    
-    # Try to get player_id from POST or JSON body
-    player_id = None
-    if request.POST.get('player_id'):
-        player_id = request.POST.get('player_id')
-    elif request.body:
-        try:
-            body_data = json.loads(request.body)
-            player_id = body_data.get('player_id')
-        except:
-            pass
+    """Manually start the game once at least 2 players have joined."""
+    room = get_object_or_404(Room, id=request_identity(request).room_id)
     
-    if not room.is_full():
-        return JsonResponse({'error': 'Room is not full yet'}, status=400)
+    if not room.can_start():
+        return JsonResponse({'error': 'Not enough players yet'}, status=400)
     
     # Initialize game if not already started
     game_state = room.get_current_game_state()
+    if not game_state and engine_enabled():
+        game_state, created = get_engine(room.id).start()
     if not game_state:
         game_state = TurnManagementService.initialize_game(room)
         if not game_state:
             return JsonResponse({'error': 'Failed to initialize game'}, status=500)
+    broadcast_room_move(room.code, room.id)
     
     return JsonResponse({
         'success': True,
@@ -225,8 +291,15 @@ def start_game(request, room_code):
 
 @require_http_methods(["GET"])
 def room_status(request, room_code):
-    """Get current room status."""
+    """Get current room status, read from the replica when the room allows it."""
+    # The room itself comes from the primary, so a room just created is found
     room = get_object_or_404(Room, code=room_code.upper())
+    with replica_reads('room', room.id):
+        return build_room_status(room)
+
+
+def build_room_status(room):
+    """Status payload for ``room_status``."""
     game_state = room.get_current_game_state()
     
     players_data = []
@@ -247,7 +320,7 @@ def room_status(request, room_code):
             question = Question.objects.filter(
                 game_state=game_state,
                 is_answered=True
-            ).first()
+            ).select_related('question_text').first()
         
         if question:
             current_question = {
@@ -271,6 +344,7 @@ def room_status(request, room_code):
     return JsonResponse({
         'room_code': room.code,
         'is_full': room.is_full(),
+        'capacity': room.capacity,
         'is_active': room.is_active,
         'game_started': game_state is not None,
         'players': players_data,
@@ -284,14 +358,15 @@ def room_status(request, room_code):
     })
 
 
-@ensure_csrf_cookie
+@page_shell
 def standalone_page(request):
-    """Standalone truth/dare question page."""
+    """Standalone truth/dare question page shell."""
     return render(request, 'game/standalone.html')
 
 
 @require_http_methods(["POST"])
 @csrf_exempt
+@rate_limited
 def request_standalone_question(request):
     """Request a truth/dare question (standalone, not in a game) - puts user on hold for admin."""
     user_name = request.POST.get('user_name', '').strip()
@@ -306,7 +381,7 @@ def request_standalone_question(request):
         session_id = str(uuid.uuid4())
     
     # Get or create standalone request
-    standalone_request, created = StandaloneRequest.objects.get_or_create(
+    standalone_request, created = serialized_write(StandaloneRequest.objects.get_or_create)(
         session_id=session_id,
         defaults={
             'user_name': user_name,
@@ -321,10 +396,10 @@ def request_standalone_question(request):
         standalone_request.user_name = user_name
         standalone_request.question_type = question_type
         standalone_request.status = 'PENDING'
-        standalone_request.current_question = None
+        standalone_request.current_question_text = None
         standalone_request.question_source = None
         standalone_request.is_active = True
-        standalone_request.save()
+        serialized_write(standalone_request.save)()
     
     # User is now waiting for admin approval
     return JsonResponse({
@@ -339,7 +414,10 @@ def request_standalone_question(request):
 def get_standalone_status(request, session_id):
     """Get status of a standalone request."""
     try:
-        standalone_request = StandaloneRequest.objects.get(session_id=session_id)
+        with replica_reads('standalone', session_id):
+            standalone_request = StandaloneRequest.objects.select_related(
+                'current_question_text'
+            ).get(session_id=session_id)
         return JsonResponse({
             'success': True,
             'user_name': standalone_request.user_name,
@@ -360,29 +438,34 @@ def admin_dashboard(request):
     # Show pending and recently approved requests
     standalone_requests = StandaloneRequest.objects.filter(
         is_active=True
-    ).exclude(status='COMPLETED').order_by('-updated_at')
-    return render(request, 'game/admin_dashboard.html', {
-        'rooms': active_rooms,
-        'standalone_requests': standalone_requests
-    })
+    ).exclude(status='COMPLETED').select_related('current_question_text').order_by('-updated_at')
+    # The querysets are evaluated while rendering
+    with replica_reads():
+        return render(request, 'game/admin_dashboard.html', {
+            'rooms': active_rooms,
+            'standalone_requests': standalone_requests
+        })
 
 
 @require_http_methods(["POST"])
 @csrf_exempt
+@player_required
 def start_game(request, room_code):
-    """Manually start the game when 2 players have joined."""
-    room = get_object_or_404(Room, code=room_code.upper())
-    player_id = request.POST.get('player_id') or request.body and json.loads(request.body).get('player_id')
+    """Manually start the game once at least 2 players have joined."""
+    room = get_object_or_404(Room, id=request_identity(request).room_id)
     
-    if not room.is_full():
-        return JsonResponse({'error': 'Room is not full yet'}, status=400)
+    if not room.can_start():
+        return JsonResponse({'error': 'Not enough players yet'}, status=400)
     
     # Initialize game if not already started
     game_state = room.get_current_game_state()
+    if not game_state and engine_enabled():
+        game_state, created = get_engine(room.id).start()
     if not game_state:
         game_state = TurnManagementService.initialize_game(room)
         if not game_state:
             return JsonResponse({'error': 'Failed to initialize game'}, status=500)
+    broadcast_room_move(room.code, room.id)
     
     return JsonResponse({
         'success': True,
@@ -393,13 +476,25 @@ def start_game(request, room_code):
 
 @require_http_methods(["POST"])
 @csrf_exempt
+@rate_limited
+@player_required
 def next_round(request, room_code):
     """Move to next round after viewing answer."""
-    room = get_object_or_404(Room, code=room_code.upper())
+    identity = request_identity(request)
+    room = Room(id=identity.room_id, code=identity.room_code)
+    
+    if engine_enabled():
+        engine = get_engine(room.id)
+        result = engine.next_round() if engine else None
+        if result:
+            broadcast_room_move(room.code, room.id)
+            return JsonResponse({'success': True, **result})
+        return JsonResponse({'error': 'Failed to move to next round'}, status=500)
     
     game_state = TurnManagementService.next_round(room)
     
     if game_state:
+        broadcast_room_move(room.code, room.id)
         return JsonResponse({
             'success': True,
             'next_turn': game_state.current_turn_player.name if game_state.current_turn_player else None,
@@ -422,16 +517,19 @@ def admin_inject_question(request, room_code):
     if not question_text or question_type not in ['truth', 'dare']:
         return JsonResponse({'error': 'Invalid question data'}, status=400)
     
-    question = TurnManagementService.create_admin_question(room, question_text, question_type)
-    
-    if question:
-        # Broadcast to WebSocket clients
-        question_data = {
+    if engine_enabled():
+        question_data = get_engine(room.id).inject_question(question_text, question_type)
+    else:
+        question = TurnManagementService.create_admin_question(room, question_text, question_type)
+        question_data = question and {
             'id': question.id,
             'text': question.text,
             'type': question.question_type,
             'source': question.source
         }
+    
+    if question_data:
+        # Broadcast to WebSocket clients
         broadcast_admin_question(room_code.upper(), question_data)
         
         return JsonResponse({
@@ -442,6 +540,39 @@ def admin_inject_question(request, room_code):
     return JsonResponse({'error': 'Failed to inject question'}, status=500)
 
 
+@require_http_methods(["POST"])
+@csrf_exempt
+@login_required
+def admin_bulk_inject_question(request):
+    """Admin endpoint to inject a question into all active rooms or the listed ones."""
+    question_text = request.POST.get('question_text', '').strip()
+    question_type = request.POST.get('question_type', 'truth')
+    room_codes = [
+        code.strip().upper()
+        for code in request.POST.get('room_codes', '').split(',')
+        if code.strip()
+    ]
+    
+    if not question_text or question_type not in ['truth', 'dare']:
+        return JsonResponse({'error': 'Invalid question data'}, status=400)
+    
+    started = time.perf_counter()
+    rooms = Room.objects.filter(is_active=True)
+    if room_codes:
+        rooms = rooms.filter(code__in=room_codes)
+    injected = TurnManagementService.bulk_create_admin_questions(rooms, question_text, question_type)
+    broadcast_admin_questions(injected)
+    elapsed = time.perf_counter() - started
+    
+    metrics.incr('admin.bulk_injected_rooms', len(injected))
+    return JsonResponse({
+        'success': True,
+        'rooms': len(injected),
+        'elapsed_ms': round(elapsed * 1000, 1),
+        'rooms_per_second': round(len(injected) / elapsed) if elapsed else None
+    })
+
+
 @require_http_methods(["POST"])
 @csrf_exempt
 @login_required
@@ -453,27 +584,20 @@ def admin_send_api_question(request, session_id):
         return JsonResponse({'error': 'Session not found'}, status=404)
     
     # Fetch question from API based on requested type
-    api_service = APIQuestionService()
-    question_type = standalone_request.question_type
-    
-    if question_type == 'truth':
-        api_data = api_service.fetch_truth_question()
-    else:
-        api_data = api_service.fetch_dare_question()
-    
-    question_text = api_data.get('question', 'No question available')
+    question_type = 'truth' if standalone_request.question_type == 'truth' else 'dare'
+    question_text, source = APIQuestionService().select_question(question_type)
     
     # Update standalone request with API question
-    standalone_request.current_question = question_text
-    standalone_request.question_source = 'API'
+    standalone_request.current_question_text = QuestionText.intern(question_text)
+    standalone_request.question_source = source
     standalone_request.status = 'APPROVED'
-    standalone_request.save()
+    serialized_write(standalone_request.save)()
     
     # Broadcast to WebSocket clients
     question_data = {
         'text': question_text,
         'type': question_type,
-        'source': 'API'
+        'source': source
     }
     broadcast_standalone_question(session_id, question_data)
     
@@ -500,11 +624,11 @@ def admin_inject_standalone_question(request, session_id):
         return JsonResponse({'error': 'Invalid question data'}, status=400)
     
     # Update standalone request with admin question
-    standalone_request.current_question = question_text
+    standalone_request.current_question_text = QuestionText.intern(question_text)
     standalone_request.question_type = question_type
     standalone_request.question_source = 'ADMIN'
     standalone_request.status = 'APPROVED'
-    standalone_request.save()
+    serialized_write(standalone_request.save)()
     
     # Broadcast to WebSocket clients
     question_data = {
@@ -518,3 +642,12 @@ def admin_inject_standalone_question(request, session_id):
         'success': True,
         'question': question_data
     })
+
+
+@require_http_methods(["GET"])
+@login_required
+def admin_metrics(request):
+    """Admin endpoint exposing in-process hot-path metrics."""
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff access required'}, status=403)
+    return JsonResponse({**metrics.snapshot(), 'db_pools': pool_stats(), 'prefetch': prefetcher.stats()})
@@ -0,0 +1,108 @@
+"""
+Worker warm-up.
+
+A fresh worker otherwise pays for its first requests: the URLconf and the
+views behind it are imported on first resolve, templates are compiled on
+first render, the database driver connects (and the ORM builds its first
+query) on first use, a connection pool opens its connections one checkout
+at a time, and the question corpus is read on the first pick. The ASGI
+entry point calls ``warm_up`` once at startup, when
+``GAME_WARMUP_ENABLED`` is set, so these costs land before the worker
+takes traffic.
+
+Every step is timed as ``warmup.<step>``; a failing step is logged and the
+rest still run, so a warm-up problem never keeps a worker from starting.
+"""
+import logging
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.template.loader import get_template
+from django.urls import reverse
+
+from . import metrics
+from .dbpool import PooledDatabaseWrapperMixin, get_pool
+
+logger = logging.getLogger(__name__)
+
+
+def warm_urls():
+    """Import the URLconf, and with it every view module."""
+    # Reversing builds the resolver's lookup tables over every pattern
+    reverse('home')
+
+
+def warm_templates():
+    """Compile every project template into the cached template loader."""
+    for template_dir in settings.TEMPLATES[0]['DIRS']:
+        for path in sorted(Path(template_dir).rglob('*.html')):
+            get_template(path.relative_to(template_dir).as_posix())
+
+
+def warm_database():
+    """
+    Connect to every database and run a first query through the ORM, then
+    fill the connection pool when there is one.
+    """
+    from .models import Room
+
+    for alias in connections:
+        Room.objects.using(alias).filter(is_active=True).exists()
+        warm_pool(connections[alias])
+    # Connections are per thread, so this thread's own is of no use to
+    # requests and consumers; a pooled one goes back to the pool on close
+    connections.close_all()
+
+
+def warm_pool(connection):
+    """Open ``GAME_DB_POOL_WARM_SIZE`` connections of a pooled database and leave them idle in its pool."""
+    if not isinstance(connection, PooledDatabaseWrapperMixin):
+        return
+    count = min(getattr(settings, 'GAME_DB_POOL_WARM_SIZE', 4), get_pool(connection.alias).size)
+    # Held open together so the pool can't hand the same one out twice
+    opened = [type(connection)(connection.settings_dict, connection.alias) for _ in range(count)]
+    try:
+        for other in opened:
+            other.ensure_connection()
+    finally:
+        for other in opened:
+            other.close()
+
+
+def warm_questions():
+    """Build the question provider chain and load the local corpus."""
+    from .providers import get_chain
+
+    get_chain().load()
+
+
+STEPS = (
+    ('urls', warm_urls),
+    ('templates', warm_templates),
+    ('database', warm_database),
+    ('questions', warm_questions),
+)
+
+
+def warm_up():
+    """Run every warm-up step; return {step: seconds} for the steps that succeeded."""
+    if not getattr(settings, 'GAME_WARMUP_ENABLED', True):
+        return {}
+
+    timings = {}
+    for name, step in STEPS:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception:
+            logger.exception('Warm-up step %s failed', name)
+            continue
+        timings[name] = time.perf_counter() - started
+        metrics.observe(f'warmup.{name}', timings[name])
+    logger.info(
+        'Worker warm-up: %s',
+        ', '.join(f'{name} {seconds * 1000:.0f}ms' for name, seconds in timings.items())
+    )
+    return timings
@@ -0,0 +1,284 @@
+"""
+Buffered write-behind for model rows.
+
+Callers queue inserts and updates instead of saving rows one by one. A
+background thread flushes everything queued, from every room, every
+``GAME_WRITE_BEHIND_INTERVAL_MS`` (sooner once ``GAME_WRITE_BEHIND_MAX_PENDING``
+rows are waiting) as one transaction of ``bulk_create`` per model followed
+by ``bulk_update`` per model and field set. Models are inserted parents
+first (a game state before its questions, a question before its answers),
+whatever order they were queued in. Repeated updates of the same row
+within an interval collapse into one.
+
+If the batch fails, each room's rows are written in a transaction of their
+own, so one bad row only holds back its room. A room's rows that keep
+failing are dropped after ``MAX_RETRIES`` flushes, counted as
+``<name>.dropped`` and logged.
+
+Queued rows are flushed at interpreter exit and on SIGTERM/SIGINT, so a
+graceful shutdown loses nothing; a crash loses at most one interval.
+
+Only the in-memory engine (``GAME_ENGINE_MODE = 'memory'``) writes through
+the buffer. In the default ``'db'`` mode the database is the turn state,
+so ``TurnManagementService`` writes each move synchronously: the state
+pushed right after a move is read back from it, and would miss a move
+still waiting in the buffer.
+"""
+import atexit
+import logging
+import signal
+import threading
+import weakref
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from . import metrics
+from .replicas import note_room_writes, replica_enabled
+from .sqlite import serialized_write
+
+logger = logging.getLogger(__name__)
+
+# Consecutive failed flushes after which a room's queued rows are dropped
+MAX_RETRIES = 3
+
+
+class BufferedWriter:
+    """Queues model inserts and updates and writes them in periodic batches."""
+
+    def __init__(self, name='writebehind'):
+        self.name = name
+        # Reentrant so a shutdown signal landing mid-call can still flush
+        self._lock = threading.RLock()
+        self._flush_lock = threading.RLock()
+        self._creates = OrderedDict()
+        self._updates = OrderedDict()
+        self._pending = 0
+        # room_id -> consecutive failed flushes
+        self._failures = {}
+        # Rows queued with their primary key already set, which they keep
+        self._keyed = weakref.WeakSet()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def create(self, obj):
+        """Queue ``obj`` for insertion; it gets its primary key when flushed, unless it has one."""
+        with self._lock:
+            if obj.pk is not None:
+                self._keyed.add(obj)
+            self._creates.setdefault(type(obj), []).append(obj)
+            self._queued()
+
+    def update(self, obj, fields):
+        """Queue ``fields`` of ``obj`` to be written, replacing earlier queued values."""
+        with self._lock:
+            key = (type(obj), tuple(fields))
+            rows = self._updates.setdefault(key, {})
+            rows[obj.pk if obj.pk is not None else id(obj)] = obj
+            self._queued()
+
+    def _queued(self):
+        self._pending += 1
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        if self._pending >= getattr(settings, 'GAME_WRITE_BEHIND_MAX_PENDING', 5000):
+            self._wake.set()
+
+    def _run(self):
+        interval = getattr(settings, 'GAME_WRITE_BEHIND_INTERVAL_MS', 50) / 1000
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('%s flush failed', self.name)
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        """Write everything queued in one transaction, or one per room if that fails; return the rows written."""
+        with self._flush_lock:
+            with self._lock:
+                creates, self._creates = self._creates, OrderedDict()
+                updates, self._updates = self._updates, OrderedDict()
+                self._pending = 0
+            if not creates and not updates:
+                return 0
+
+            # Rows inserted in this batch already carry their latest values
+            inserted = {id(obj) for objs in creates.values() for obj in objs}
+            updates = {
+                key: [obj for obj in rows.values() if id(obj) not in inserted]
+                for key, rows in updates.items()
+            }
+            try:
+                with metrics.timed(f'{self.name}.flush'):
+                    write_batch(creates, updates)
+            except Exception:
+                unsave([obj for objs in creates.values() for obj in objs], self._keyed)
+                logger.exception('%s batch failed, writing room by room', self.name)
+                rows = self._flush_by_room(creates, updates)
+            else:
+                rows = count_rows(creates, updates)
+                self._failures.clear()
+                if replica_enabled():
+                    # Bulk writes send no signals; pin the rooms to the primary here
+                    note_room_writes(batch_rooms(creates, updates))
+            metrics.incr(f'{self.name}.flushes')
+            metrics.incr(f'{self.name}.rows', rows)
+            return rows
+
+    def _flush_by_room(self, creates, updates):
+        """Write each room's rows in a transaction of its own; return the rows written."""
+        written = 0
+        for room_id, (room_creates, room_updates) in split_by_room(creates, updates).items():
+            rows = count_rows(room_creates, room_updates)
+            try:
+                write_batch(room_creates, room_updates)
+            except Exception:
+                unsave([obj for objs in room_creates.values() for obj in objs], self._keyed)
+                failures = self._failures.get(room_id, 0) + 1
+                if failures < MAX_RETRIES:
+                    self._failures[room_id] = failures
+                    self._requeue(room_creates, room_updates)
+                    logger.exception('%s rows for room %s failed, retrying', self.name, room_id)
+                else:
+                    self._failures.pop(room_id, None)
+                    metrics.incr(f'{self.name}.dropped', rows)
+                    logger.exception('%s dropped %d rows for room %s', self.name, rows, room_id)
+            else:
+                self._failures.pop(room_id, None)
+                if room_id is not None:
+                    note_room_writes([room_id])
+                written += rows
+        return written
+
+    def _requeue(self, creates, updates):
+        """Put a failed batch back ahead of anything queued since."""
+        with self._lock:
+            for model, objs in self._creates.items():
+                creates.setdefault(model, []).extend(objs)
+            self._creates = creates
+            for (model, fields), objs in updates.items():
+                rows = {obj.pk if obj.pk is not None else id(obj): obj for obj in objs}
+                rows.update(self._updates.get((model, fields), {}))
+                self._updates[(model, fields)] = rows
+            self._pending = sum(map(len, self._creates.values())) + sum(map(len, self._updates.values()))
+        metrics.incr(f'{self.name}.retried')
+
+
+@serialized_write
+def write_batch(creates, updates):
+    with transaction.atomic():
+        for model in insert_order(creates):
+            model.objects.bulk_create(creates[model])
+        for (model, fields), objs in updates.items():
+            if objs:
+                model.objects.bulk_update(objs, fields)
+
+
+def count_rows(creates, updates):
+    return sum(map(len, creates.values())) + sum(map(len, updates.values()))
+
+
+def insert_order(creates):
+    """The models in ``creates``, each after those it has a foreign key to."""
+    remaining = list(creates)
+    ordered = []
+    while remaining:
+        for model in remaining:
+            parents = {
+                field.related_model for field in model._meta.concrete_fields
+                if field.many_to_one and field.related_model is not model
+            }
+            if not parents.intersection(remaining):
+                break
+        else:
+            # A cycle; bulk_create will refuse whichever rows still lack parents
+            model = remaining[0]
+        remaining.remove(model)
+        ordered.append(model)
+    return ordered
+
+
+def row_room(obj):
+    """The room a queued row belongs to, through its cached parents if need be."""
+    room_id = getattr(obj, 'room_id', None)
+    if room_id is not None:
+        return room_id
+    for field in obj._meta.concrete_fields:
+        if field.many_to_one and field.is_cached(obj):
+            related = field.get_cached_value(obj)
+            if related is not None:
+                return row_room(related)
+    return None
+
+
+def batch_rooms(creates, updates):
+    """The rooms the rows of a batch belong to."""
+    rows = [obj for objs in creates.values() for obj in objs]
+    rows.extend(obj for objs in updates.values() for obj in objs)
+    return {room_id for room_id in map(row_room, rows) if room_id is not None}
+
+
+def split_by_room(creates, updates):
+    """Split a batch into {room_id: (creates, updates)}."""
+    rooms = OrderedDict()
+    for model, objs in creates.items():
+        for obj in objs:
+            room_creates = rooms.setdefault(row_room(obj), ({}, {}))[0]
+            room_creates.setdefault(model, []).append(obj)
+    for key, objs in updates.items():
+        for obj in objs:
+            room_updates = rooms.setdefault(row_room(obj), ({}, {}))[1]
+            room_updates.setdefault(key, []).append(obj)
+    return rooms
+
+
+def unsave(objs, keyed=()):
+    """Undo the primary keys a rolled back ``bulk_create`` assigned, keeping those in ``keyed``."""
+    for obj in objs:
+        obj._state.adding = True
+        if obj.pk is not None and obj in keyed:
+            continue
+        obj.pk = None
+    for obj in objs:
+        for field in obj._meta.concrete_fields:
+            if field.is_relation and field.is_cached(obj):
+                related = field.get_cached_value(obj)
+                if related is not None and related.pk is None:
+                    # Bypass the descriptor, which would drop the cached object
+                    obj.__dict__[field.attname] = None
+
+
+writer = BufferedWriter()
+
+
+def flush_on_shutdown():
+    try:
+        writer.flush()
+    except Exception:
+        logger.exception('Write-behind flush at shutdown failed')
+
+
+def install_shutdown_hooks():
+    """Flush queued rows at exit and when the process is asked to stop."""
+    atexit.register(flush_on_shutdown)
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(signum)
+        if previous == signal.SIG_IGN:
+            continue
+
+        def handler(signum, frame, previous=previous):
+            flush_on_shutdown()
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                raise SystemExit(128 + signum)
+
+        signal.signal(signum, handler)
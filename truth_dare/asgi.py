@@ -29,3 +29,8 @@ application = ProtocolTypeRouter({
         )
     ),
 })
+
+# Pay for first-request imports, template compiles and connects up front
+from game.warmup import warm_up
+
+warm_up()
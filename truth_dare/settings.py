@@ -41,12 +41,14 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # Add WhiteNoise for static files
+    'game.middleware.AdmissionControlMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'game.middleware.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'truth_dare.urls'
@@ -92,6 +94,16 @@ else:
         }
     }
 
+# Optional read replica for polling and dashboard reads; see game.replicas
+if os.environ.get('DATABASE_REPLICA_URL'):
+    DATABASES['replica'] = dj_database_url.parse(
+        os.environ['DATABASE_REPLICA_URL'],
+        conn_max_age=600,
+        conn_health_checks=True,
+    )
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+    DATABASE_ROUTERS = ['game.replicas.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -153,8 +165,129 @@ TRUTH_DARE_API_RATING = os.environ.get('TRUTH_DARE_API_RATING', 'pg')  # Options
 TRUTH_DARE_API_RATE_LIMIT_REQUESTS = 5
 TRUTH_DARE_API_RATE_LIMIT_SECONDS = 5
 
+# Question sources as name:weight (game.providers). Each fetch starts with a
+# source drawn by weight among those above 0, then falls back to the rest in
+# order. 'local' is the bundled corpus; 'local:1' alone needs no network.
+GAME_QUESTION_PROVIDERS = [
+    (name, int(weight))
+    for name, weight in (
+        entry.strip().rsplit(':', 1)
+        for entry in os.environ.get('GAME_QUESTION_PROVIDERS', 'api:1,local:0').split(',')
+    )
+]
+GAME_QUESTION_CORPUS = os.environ.get('GAME_QUESTION_CORPUS', str(BASE_DIR / 'game' / 'data' / 'questions.json'))
+
+# Hot-path tracing for consumer events
+GAME_TRACING_ENABLED = os.environ.get('GAME_TRACING_ENABLED', 'True') == 'True'
+GAME_TRACING_SLOW_EVENT_MS = int(os.environ.get('GAME_TRACING_SLOW_EVENT_MS', '250'))
+
+# On-demand profiling for staff (X-Profile header or ?profile=1)
+GAME_PROFILING_ENABLED = os.environ.get('GAME_PROFILING_ENABLED', 'True') == 'True'
+
+# JSON encoder used by views and consumers: auto, orjson, ujson or json
+GAME_JSON_BACKEND = os.environ.get('GAME_JSON_BACKEND', 'auto')
+# Allow WebSocket clients to negotiate the td.msgpack.v1 binary subprotocol.
+# The bundled pages only speak JSON; enable this for third-party clients.
+GAME_WS_BINARY_ENABLED = os.environ.get('GAME_WS_BINARY_ENABLED', 'False') == 'True'
+
+# Room state pushes triggered within this window are coalesced into one
+GAME_PUSH_COALESCE_MS = int(os.environ.get('GAME_PUSH_COALESCE_MS', '40'))
+
+# Per-room ring buffer of sequenced broadcasts replayed to resuming clients
+GAME_EVENT_BUFFER_SIZE = int(os.environ.get('GAME_EVENT_BUFFER_SIZE', '64'))
+GAME_EVENT_BUFFER_ROOMS = int(os.environ.get('GAME_EVENT_BUFFER_ROOMS', '10000'))
+
+# Socket heartbeats, presence sweeps and idle room release. Each sweep marks
+# the rooms with players on the worker as active, so the sweep interval must
+# stay well below the release period for rooms spread over several workers
+GAME_HEARTBEAT_SECONDS = int(os.environ.get('GAME_HEARTBEAT_SECONDS', '25'))
+GAME_PRESENCE_SWEEP_SECONDS = int(os.environ.get('GAME_PRESENCE_SWEEP_SECONDS', '30'))
+GAME_IDLE_ROOM_RELEASE_SECONDS = int(os.environ.get('GAME_IDLE_ROOM_RELEASE_SECONDS', '600'))
+
+# Token buckets as (tokens per second, burst): per socket connection, and per
+# player across socket mutations and the HTTP mutation endpoints
+GAME_RATE_LIMITS = {
+    'socket': (5, 10),
+    'player': (2, 6),
+}
+# request.META key of the header a reverse proxy puts the client address in
+# (e.g. 'HTTP_X_FORWARDED_FOR'); unset uses REMOTE_ADDR
+GAME_CLIENT_ADDRESS_HEADER = os.environ.get('GAME_CLIENT_ADDRESS_HEADER') or None
+
+# Per-worker admission control caps; beyond these new work gets 503/close
+GAME_ADMISSION = {
+    'max_connections': int(os.environ.get('GAME_MAX_CONNECTIONS', '2000')),
+    'max_rooms': int(os.environ.get('GAME_MAX_ROOMS', '1000')),
+    'max_http_in_flight': int(os.environ.get('GAME_MAX_HTTP_IN_FLIGHT', '200')),
+    'max_sync_in_flight': int(os.environ.get('GAME_MAX_SYNC_IN_FLIGHT', '100')),
+    'retry_after': 5,
+}
+
+# 'db' applies every move through the ORM; 'memory' keeps each room's turn
+# state in its worker and persists it through the write-behind buffer
+GAME_ENGINE_MODE = os.environ.get('GAME_ENGINE_MODE', 'db')
+# Question ids the engine reserves per database round trip
+GAME_ID_BLOCK_SIZE = int(os.environ.get('GAME_ID_BLOCK_SIZE', '100'))
+
+# Write-behind buffer flush interval, and queued rows that force an early flush.
+# Only 'memory' engine mode writes through the buffer
+GAME_WRITE_BEHIND_INTERVAL_MS = int(os.environ.get('GAME_WRITE_BEHIND_INTERVAL_MS', '50'))
+GAME_WRITE_BEHIND_MAX_PENDING = int(os.environ.get('GAME_WRITE_BEHIND_MAX_PENDING', '5000'))
+
+# Browser/proxy max-age of the game page shells before they are revalidated
+# by ETag (they carry their script inline, so keep it short), and how long
+# the room snapshot they bootstrap from is cached
+GAME_SHELL_MAX_AGE = int(os.environ.get('GAME_SHELL_MAX_AGE', '60'))
+GAME_SNAPSHOT_CACHE_SECONDS = int(os.environ.get('GAME_SNAPSHOT_CACHE_SECONDS', '1'))
+
+# Warm URLs, templates and database connections when an ASGI worker starts
+GAME_WARMUP_ENABLED = os.environ.get('GAME_WARMUP_ENABLED', 'True') == 'True'
+
+# Bounded connection pool per database shared by every thread in a worker;
+# connections go back to it after each request and consumer database call
+GAME_DB_POOL_ENABLED = os.environ.get('GAME_DB_POOL_ENABLED', 'False') == 'True'
+GAME_DB_POOL_SIZE = int(os.environ.get('GAME_DB_POOL_SIZE', '20'))
+GAME_DB_POOL_TIMEOUT_SECONDS = float(os.environ.get('GAME_DB_POOL_TIMEOUT_SECONDS', '10'))
+GAME_DB_POOL_RECYCLE_SECONDS = int(os.environ.get('GAME_DB_POOL_RECYCLE_SECONDS', '600'))
+GAME_DB_POOL_CHECK_IDLE_SECONDS = int(os.environ.get('GAME_DB_POOL_CHECK_IDLE_SECONDS', '30'))
+# Connections per pool opened by the worker warm-up
+GAME_DB_POOL_WARM_SIZE = int(os.environ.get('GAME_DB_POOL_WARM_SIZE', '4'))
+
+if GAME_DB_POOL_ENABLED:
+    POOLED_ENGINES = {
+        'django.db.backends.postgresql': 'game.backends.postgresql',
+        'django.db.backends.sqlite3': 'game.backends.sqlite3',
+    }
+    for database in DATABASES.values():
+        if database['ENGINE'] in POOLED_ENGINES:
+            database['ENGINE'] = POOLED_ENGINES[database['ENGINE']]
+            database['CONN_MAX_AGE'] = 0
+
+# Replica reads of a room go to the primary for this long after its last write
+GAME_REPLICA_PIN_SECONDS = int(os.environ.get('GAME_REPLICA_PIN_SECONDS', '5'))
+
+# SQLite only: WAL pragmas, and game writes serialized through one writer
+# thread per worker that commits up to GAME_SQLITE_WRITE_BATCH at a time
+GAME_SQLITE_SINGLE_WRITER = os.environ.get('GAME_SQLITE_SINGLE_WRITER', 'False') == 'True'
+GAME_SQLITE_WRITE_BATCH = int(os.environ.get('GAME_SQLITE_WRITE_BATCH', '64'))
+GAME_SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('GAME_SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+# Signed player tokens issued on create/join expire after this many seconds
+GAME_PLAYER_TOKEN_MAX_AGE = int(os.environ.get('GAME_PLAYER_TOKEN_MAX_AGE', str(24 * 60 * 60)))
+# How long a token's player and room are known to be valid without asking
+# the database again
+GAME_PLAYER_TOKEN_CHECK_SECONDS = int(os.environ.get('GAME_PLAYER_TOKEN_CHECK_SECONDS', '300'))
+
+# Fetch a truth and a dare in the background when a turn starts; unused
+# ones are pooled (up to GAME_PREFETCH_POOL_SIZE per type) for later turns
+GAME_QUESTION_PREFETCH = os.environ.get('GAME_QUESTION_PREFETCH', 'True') == 'True'
+GAME_PREFETCH_WORKERS = int(os.environ.get('GAME_PREFETCH_WORKERS', '2'))
+GAME_PREFETCH_POOL_SIZE = int(os.environ.get('GAME_PREFETCH_POOL_SIZE', '50'))
+GAME_PREFETCH_MAX_ROOMS = int(os.environ.get('GAME_PREFETCH_MAX_ROOMS', '1000'))
+
 # Room Configuration
 ROOM_CODE_LENGTH = 6
+ROOM_MAX_CAPACITY = int(os.environ.get('ROOM_MAX_CAPACITY', '50'))
 ROOM_EXPIRY_HOURS = 24
 
 # Security Settings for Production